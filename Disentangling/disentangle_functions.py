@@ -8,14 +8,24 @@ import glob
 import os
 import numpy as np
 from astropy.io import ascii
-from scipy.interpolate import interp1d
-import pandas as pd
+from scipy.interpolate import interp1d, make_interp_spline
+from scipy.ndimage import median_filter
+from scipy.sparse import csr_matrix
+import scipy.sparse as sparse
+from scipy.sparse.linalg import lsqr
+from scipy.optimize import minimize, minimize_scalar
+from scipy.fft import next_fast_len
 import matplotlib.pyplot as plt
 import astropy.io.fits as fits
 import scipy.special as sc
-from astropy.table import Table
 import sys
 import pickle
+import json
+import hashlib
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from matplotlib.ticker import (MultipleLocator, AutoMinorLocator)
 import matplotlib.pylab as pylab
 params = {'legend.fontsize': 'x-large',
@@ -39,88 +49,221 @@ clight = 2.9979E5
                       
 ## A bunch of functions...
 
-def Normalise(spec, points = []):
-    ContIndices = np.array([np.argmin(np.abs(spec[:,0] - points[i])) for i in np.arange(len(points))])  
-    Contfluxes = np.array([np.average(spec[:,1][max(ContIndices[i] - 7, 0): min(ContIndices[i] + 7, len(spec[:,0]))]) for i in np.arange(len(ContIndices))])
-    #print spec[:,0][ContIndices]
-    #print Contfluxes
-    #dasd
-    ContSpline = interp1d(spec[:,0][ContIndices], Contfluxes, bounds_error = False, fill_value = 'extrapolate')(spec[:,0])
-    return np.array([spec[:,0], spec[:,1] / ContSpline]).T 
+# Renormalises spec (2D array waves vs. flux) by the continuum: linear spline (extrapolated) through the average fluxes of the pixels 
+# [i-7, i+7) around the pixels i closest to the wavelengths points. See Normalise_Batch.
+def Normalise(spec, points = [], ClipItr=0, ClipSigma=3.):
+    return Normalise_Batch([spec], points, ClipItr, ClipSigma)[0]
+
+
+# Renormalises a list of spectra Specs (see Normalise); epochs sharing the same wavelength grid are normalised at once. 
+# If ClipItr > 0: up to ClipItr iterations in which pixels deviating by more than ClipSigma standard deviations from the average of their 
+# window are excluded from the average (e.g. cosmics or lines in the continuum windows). Returns a list of the normalised spectra.
+def Normalise_Batch(Specs, points = [], ClipItr=0, ClipSigma=3., HalfWidth=7):
+    Normalised = [None]*len(Specs)
+    Groups = OrderedDict()
+    for i, spec in enumerate(Specs):
+        waves = np.ascontiguousarray(spec[:,0], dtype=float)
+        Groups.setdefault(hashlib.sha1(waves.tobytes()).hexdigest(), []).append(i)
+    for Members in Groups.values():
+        waves = np.asarray(Specs[Members[0]][:,0], dtype=float)
+        Fluxes = np.array([Specs[i][:,1] for i in Members], dtype=float)
+        Cont = Continuum_Grid(waves, Fluxes, points, ClipItr, ClipSigma, HalfWidth)
+        for i, Flux, ContFlux in zip(Members, Fluxes, Cont):
+            Normalised[i] = np.array([waves, Flux / ContFlux]).T
+    return Normalised
+
+
+# Continuum (see Normalise_Batch) of the fluxes Fluxes (2D array: epochs x pixels) sharing the wavelengths waves
+def Continuum_Grid(waves, Fluxes, points, ClipItr=0, ClipSigma=3., HalfWidth=7):
+    N = len(waves)
+# Pixels closest to points (the bluer one on ties); points sharing a pixel are used once
+    Right = np.clip(np.searchsorted(waves, points), 1, N - 1)
+    ContIndices = np.unique(np.where(np.abs(waves[Right - 1] - points) <= np.abs(waves[Right] - points), Right - 1, Right))
+    Lo = np.maximum(ContIndices - HalfWidth, 0)
+    Hi = np.minimum(ContIndices + HalfWidth, N)
+# Window averages from cumulative sums (of the unclipped pixels)
+    Mask = np.ones(Fluxes.shape)
+    Cum = np.zeros((len(Fluxes), N + 1))
+    for itr in range(ClipItr + 1):
+        np.cumsum(Fluxes*Mask if itr else Fluxes, axis=1, out=Cum[:, 1:])
+        S = Cum[:, Hi] - Cum[:, Lo]
+        Num = np.broadcast_to(Hi - Lo, S.shape)
+        if itr:
+            np.cumsum(Mask, axis=1, out=Cum[:, 1:])
+            Num = np.maximum(Cum[:, Hi] - Cum[:, Lo], 1)
+        Contfluxes = S / Num
+        if itr == ClipItr:
+            break
+        np.cumsum(Fluxes**2*Mask, axis=1, out=Cum[:, 1:])
+        S2 = Cum[:, Hi] - Cum[:, Lo]
+        Std = np.sqrt(np.maximum(S2 / Num - Contfluxes**2, 0))
+        Window = np.minimum(Lo[:, None] + np.arange(2*HalfWidth), Hi[:, None] - 1)
+        Rows = np.arange(len(Fluxes))[:, None, None]
+        Clip = (np.abs(Fluxes[Rows, Window] - Contfluxes[:, :, None]) > ClipSigma*Std[:, :, None]) & (Mask[Rows, Window] > 0)
+        if not np.any(Clip):
+            break
+        Mask[np.broadcast_to(Rows, Clip.shape)[Clip], np.broadcast_to(Window, Clip.shape)[Clip]] = 0.
+    if len(ContIndices) == 1:
+        return np.repeat(Contfluxes, N, axis=1)
+# Linear spline through (waves[ContIndices], Contfluxes) for all epochs, extrapolated beyond the outer points
+    x = waves[ContIndices]
+    Seg = np.clip(np.searchsorted(x, waves, side='right') - 1, 0, len(x) - 2)
+    t = (waves - x[Seg]) / (x[Seg+1] - x[Seg])
+    return Contfluxes[:, Seg] + (Contfluxes[:, Seg+1] - Contfluxes[:, Seg]) * t
 
 
     print(("Data written to %s" % outfilename))
 
 
+# Cleans cosmics (narrow positive spikes) from Spec (2D array waves vs. flux) in up to 10 passes. Candidates: pixels above the continuum whose
+# flux gradient exceeds thold times the mean absolute gradient, outside ForbiddenRanges (e.g. emission lines). A candidate is accepted if it
+# is the peak side of a spike within +-cosize pixels which drops on both sides to the local level; the spike is then replaced by a straight line.
+# All candidates of a pass are tested at once on sliding windows (candidates whose windows exceed the spectrum are skipped).
 def Cosclean(Spec, thold=6, cosize=10, ForbiddenRanges = [[3970, 3975], [4020, 4030], [4103., 4108.], [4342, 4347], [4365, 4369],  [4391, 4393], [4470, 4477.]]):
+    waves = np.copy(Spec[:,0])
+    N = len(waves)
+    WaveCond = np.zeros(N, dtype=bool)
+    for wrange in ForbiddenRanges:
+        WaveCond += (waves > wrange[0]) * (waves < wrange[1])
     for itr in range(10):
-        waves = np.copy(Spec[:,0])
         fluxes = np.copy(Spec[:,1])
-        for wrange in ForbiddenRanges:
-            if 'WaveCond' not in locals():
-                WaveCond = (waves > wrange[0]) * (waves < wrange[1])
-            else:
-                WaveCond += (waves > wrange[0]) * (waves < wrange[1])
         fluxes[WaveCond] = 1.        
         fluxdiff = np.append(0, np.diff(fluxes))
         sigma =  thold*np.mean(np.absolute(fluxdiff))
-#Find points whose gradients are larger than thold*average
-        gradient_condition = (np.absolute(fluxdiff) > sigma)     
-#Weak point are of no interest
-        flux_condition = fluxes > 1.0
-        posgrad = fluxdiff>0
-        flagged_args = np.where(gradient_condition & flux_condition)[0]
+#Find points whose gradients are larger than thold*average; weak points are of no interest
+        flagged_args = np.where((np.absolute(fluxdiff) > sigma) & (fluxes > 1.0))[0]
         if (not len(flagged_args)):
             print("There are no cosmics detected with the given threshhold and size")
             return Spec
+        i = flagged_args[(flagged_args >= cosize) & (flagged_args < N - cosize)]
+        if N < 2*cosize + 1 or len(i) == 0:
+            continue
+# Windows of +-cosize pixels around each pixel: Windows[k] = fluxes[k-cosize:k+cosize+1]
+        Windows = np.lib.stride_tricks.sliding_window_view(fluxes, 2*cosize + 1)
+        Win = Windows[i - cosize]
+# Rising flank: nothing higher before; falling flank: nothing higher after
+        Rising = fluxdiff[i] > 0
+        Flank = np.where(Rising, np.any(Win[:, :cosize] > fluxes[i][:, None], axis=1), np.any(Win[:, cosize+1:] > fluxes[i][:, None], axis=1))
+        ipeak = i - cosize + np.argmax(Win, axis=1)
+        Valid = ~Flank & (ipeak >= cosize) & (ipeak < N - cosize)
+        i, ipeak = i[Valid], ipeak[Valid]
+        fpeak = fluxes[ipeak][:, None]
+        cosmic = Windows[ipeak - cosize]
+        cosb = cosmic[:, :cosize + 1]
+        cosr = cosmic[:, cosize:]
+        fmeadb = np.mean(cosb, axis=1)[:, None]
+        fmeadr = np.mean(cosr, axis=1)[:, None]
+        cosbdiff = np.append(np.diff(cosb, axis=1), np.zeros((len(i), 1)), axis=1)
+        cosrdiff = np.append(np.zeros((len(i), 1)), np.diff(cosr, axis=1), axis=1)
+        sigmab = np.mean(np.absolute(cosbdiff), axis=1)[:, None]
+        sigmar = np.mean(np.absolute(cosrdiff), axis=1)[:, None]
+# Edges of the spike: last small pixel before the steep rise (blue), first small pixel after the steep drop (red)
+        Condb = (np.roll(cosbdiff, -1, axis=1) > sigmab) & (cosb - fmeadb < 0.1*(fpeak - fmeadb)) & (cosb > 0.5)
+        Condr = (cosrdiff < -sigmar) & (cosr - fmeadr < 0.1*(fpeak - fmeadr)) & (cosr > 0.5)
+        argb = ipeak - np.argmax(Condb[:, ::-1], axis=1)
+        argr = ipeak + np.argmax(Condr, axis=1)
+        Valid = np.any(Condb, axis=1) & np.any(Condr, axis=1)
+        Valid &= (np.abs(fluxes[argb] - fpeak[:, 0]) >= sigmab[:, 0]) & (np.abs(fluxes[argr] - fpeak[:, 0]) >= sigmar[:, 0])
+# Repairs in order of wavelength; a candidate within the last repaired spike is skipped
         blimit = 0
-        N = len(waves)
-        for i in flagged_args:
-            if waves[i] < blimit or i<cosize or i>N-cosize:
-                continue
-            cosmic = fluxes[i-cosize:i+cosize+1]    
-            if posgrad[i]:
-                if np.any(cosmic[:cosize] - fluxes[i] > 0):
-                    continue
-            else:
-                if np.any(cosmic[cosize+1:] - fluxes[i] > 0):
-                    continue    
-            ipeak = i - cosize + np.argmax(fluxes[i-cosize:i+cosize+1])
-            fpeak = fluxes[ipeak]
-            cosmic = fluxes[ipeak - cosize : ipeak + cosize + 1]
-            cosb = cosmic[:cosize + 1]
-            cosr = cosmic[cosize:]
-            fmeadb = np.mean(cosb)
-            fmeadr = np.mean(cosr)
-            cosbdiff = np.append(np.diff(cosb), 0)
-            cosrdiff = np.append(0, np.diff(cosr))
-            sigmab = np.mean(np.absolute(cosbdiff))
-            sigmar = np.mean(np.absolute(cosrdiff))       
-            condsmallb = cosb - fmeadb < 0.1*(fpeak - fmeadb)
-            condsmallr = cosr - fmeadr < 0.1*(fpeak - fmeadr)
-            argb = np.where((np.roll(cosbdiff,-1) > sigmab) & (condsmallb) & (cosb > 0.5))[0]
-            argr = np.where((cosrdiff < -sigmar) & (condsmallr) & (cosr > 0.5))[0]
-            if len(argb) == 0  or len(argr) == 0:
-                continue
-            argb = ipeak - cosize + argb[-1]
-            argr = ipeak + argr[0]
-            if abs(fluxes[argb] - fpeak) < sigmab or abs(fluxes[argr] - fpeak) < sigmar:
+        for ib, ir, ic in zip(argb[Valid], argr[Valid], i[Valid]):
+            if waves[ic] < blimit:
                 continue
-            Spec[argb:argr+1,1] = np.interp(waves[argb:argr+1], [waves[argb], waves[argr]], [fluxes[argb], fluxes[argr]]) 
-            blimit = waves[argr]
+            Spec[ib:ir+1,1] = np.interp(waves[ib:ir+1], [waves[ib], waves[ir]], [fluxes[ib], fluxes[ir]]) 
+            blimit = waves[ir]
     return Spec
 
 
+# Cleans cosmics from a stack of spectra Specs (list of 2D arrays waves vs. flux, e.g. all epochs), using the other epochs as reference:
+# the median of the other epochs (interpolated to the wavelengths of each epoch) is subtracted, and narrow positive outliers of the residual
+# (above its running median over 2*cosize+1 pixels by more than thold robust standard deviations; pixels above the continuum, outside ForbiddenRanges) 
+# are flagged, grown by one pixel and replaced by linear interpolation over the neighbouring pixels. Requires at least three epochs.
+# Returns a list of cleaned copies of the spectra.
+def Cosclean_Stack(Specs, thold=6, cosize=10, ForbiddenRanges = [[3970, 3975], [4020, 4030], [4103., 4108.], [4342, 4347], [4365, 4369],  [4391, 4393], [4470, 4477.]]):
+    Cleaned = [np.array(Spec, dtype=float) for Spec in Specs]
+    if len(Specs) < 3:
+        print("WARNING: Cosclean_Stack requires at least three epochs; spectra not cleaned")
+        return Cleaned
+    for k, Spec in enumerate(Cleaned):
+        waves, fluxes = Spec[:,0], Spec[:,1]
+        Others = np.array([np.interp(waves, Specs[j][:,0], Specs[j][:,1], left=np.nan, right=np.nan) for j in np.arange(len(Specs)) if j != k])
+# Pixels not covered by any other epoch get zero residual
+        Covered = np.any(np.isfinite(Others), axis=0)
+        Resid = np.zeros(len(waves))
+        Resid[Covered] = fluxes[Covered] - np.nanmedian(Others[:, Covered], axis=0)
+        Resid = Resid - median_filter(Resid, size=2*cosize + 1, mode='nearest')
+        Sigma = 1.4826 * np.median(np.abs(Resid - np.median(Resid)))
+        WaveCond = np.zeros(len(waves), dtype=bool)
+        for wrange in ForbiddenRanges:
+            WaveCond += (waves > wrange[0]) * (waves < wrange[1])
+        Flagged = (Resid > thold*Sigma) & (fluxes > 1.0) & ~WaveCond
+        Flagged = Flagged | np.append(Flagged[1:], False) | np.append(False, Flagged[:-1])
+        if np.any(Flagged) and not np.all(Flagged):
+            Spec[Flagged,1] = np.interp(waves[Flagged], waves[~Flagged], fluxes[~Flagged])
+    return Cleaned
+
+
     
-# Solves the Kepler equation
+# Solves the Kepler equation E - ecc*sin(E) = M for the eccentric anomaly E (M, ecc: scalars or arrays; broadcast). 
+# E (initial guess) is kept for compatibility only: Kepler_Solve uses its own starter.
 def Kepler(E, M, ecc):
-      E2 = (M - ecc*(E*np.cos(E) - np.sin(E))) / (1. - ecc*np.cos(E))
-      eps = np.abs(E2 - E) 
-      if np.all(eps < 1E-10):
-            return E2
+      return Kepler_Solve(M, ecc)
+
+
+# Vectorised Halley solver of the Kepler equation: M is reduced to [-pi, pi), starter E0 = M + 0.85*ecc*sign(M) (Danby), and only elements 
+# that have not converged to |dE| < Tol are iterated further. Returns E for the unreduced M.
+def Kepler_Solve(M, ecc, Tol=1E-10, MaxItr=30):
+      M, ecc = np.broadcast_arrays(np.asarray(M, dtype=float), np.asarray(ecc, dtype=float))
+      Shape = M.shape
+      M, ecc = M.ravel(), ecc.ravel()
+      Offset = 2*np.pi * np.floor((M + np.pi) / (2*np.pi))
+      Mred = M - Offset
+      E = Mred + 0.85 * ecc * np.sign(Mred)
+      Todo = np.arange(len(M))
+      for itr in range(MaxItr):
+            Ei, ei, Mi = E[Todo], ecc[Todo], Mred[Todo]
+            esinE, ecosE = ei*np.sin(Ei), ei*np.cos(Ei)
+            f = Ei - esinE - Mi
+            df = 1. - ecosE
+            dE = f / (df - 0.5*f*esinE/df)
+            E[Todo] = Ei - dE
+            Todo = Todo[np.abs(dE) >= Tol]
+            if len(Todo) == 0:
+                  break
+      E = (E + Offset).reshape(Shape)
+      return E[()] if E.ndim == 0 else E
+
+
+# Tables of E(M) on uniform grids of M in [-pi, pi] for given ecc (Kepler_Tabulated), kept for later calls (at most 16 eccentricities)
+KeplerTables = OrderedDict()
+
+# Eccentric anomaly for many M at one eccentricity ecc: linear interpolation in a table of NumM points of E(M) (computed once per ecc), 
+# refined by one Halley step (Polish; accuracy ~1E-11 for NumM=4096 up to ecc=0.95). Use for RV curves at very many phases.
+# The table is too coarse near periastron for higher eccentricities: for ecc > MaxEcc, E is computed with Kepler_Solve instead.
+def Kepler_Tabulated(M, ecc, NumM=4096, Polish=True, MaxEcc=0.95):
+      if ecc > MaxEcc:
+            return Kepler_Solve(M, ecc)
+      Key = (float(ecc), NumM)
+      if Key in KeplerTables:
+            KeplerTables.move_to_end(Key)
       else:
-            return Kepler(E2, M, ecc)
-
+            KeplerTables[Key] = Kepler_Solve(np.linspace(-np.pi, np.pi, NumM), ecc)
+            if len(KeplerTables) > 16:
+                  KeplerTables.popitem(last=False)
+      ETable = KeplerTables[Key]
+      M = np.asarray(M, dtype=float)
+      Offset = 2*np.pi * np.floor((M + np.pi) / (2*np.pi))
+      Mred = M - Offset
+      x = (Mred + np.pi) * ((NumM - 1) / (2*np.pi))
+      Inds = np.clip(x.astype(int), 0, NumM - 2)
+      t = x - Inds
+      E = ETable[Inds] + (ETable[Inds+1] - ETable[Inds]) * t
+      if Polish:
+            esinE, ecosE = ecc*np.sin(E), ecc*np.cos(E)
+            f = E - esinE - Mred
+            df = 1. - ecosE
+            E = E - f / (df - 0.5*f*esinE/df)
+      return E + Offset
 
 
 
@@ -141,11 +284,113 @@ def v1andv2(nu, Orbital_Params, Config = 'in'):
         vOut = Gamma + KOut*(np.cos(OmegapiOut + nu) + eccOut* np.cos(OmegapiOut))   
         vBin = Gamma - K_bin*(np.cos(OmegapiOut + nu) + eccOut* np.cos(OmegapiOut))     
         return vOut, vBin
+      elif Config=='in2':
+        Omegapi2 = omega2/180. * np.pi  
+        v3 = Gamma + K3*(np.cos(Omegapi2 + nu) + e2* np.cos(Omegapi2))   
+        v4 = Gamma - K4*(np.cos(Omegapi2 + nu) + e2* np.cos(Omegapi2))    
+        return v3, v4
+
+
+
+# RVs of all components in the observer's frame, for CompNum = 2: binary; 3: inner binary + tertiary on the outer orbit (see v1andv2);
+# 4: 2+2 quadruple, binary 1 (K1, K2; true anomalies nusdata) and binary 2 (K3, K4; nusdata2 from Period_2, T0_2, ecc_2) on the outer orbit
+# (nusdataOut), KOut = outer semi-amplitude of binary 2
+def Comp_Vrads(nusdata, Orbital_Params, CompNum=2, nusdataOut=None, nusdata2=None):
+    vrads1, vrads2 = v1andv2(nusdata, Orbital_Params)
+    if CompNum==2:
+        return [vrads1, vrads2]
+    vradsOut, vradsBin = v1andv2(nusdataOut, Orbital_Params, Config='Tertiary')
+    if CompNum==3:
+        return [vrads1+vradsBin, vrads2+vradsBin, vradsOut]
+    vrads3, vrads4 = v1andv2(nusdata2, Orbital_Params, Config='in2')
+    return [vrads1+vradsBin, vrads2+vradsBin, vrads3+vradsOut, vrads4+vradsOut]
+
+
+# Phases and true anomalies of the dates MJDs for an orbit with period Period, periastron time T0 and eccentricity ecc;
+# kept for later calls (at most 256 orbits), such that grids over other parameters (omega, Gamma, Ks) reuse them
+AnomalyCache = OrderedDict()
+
+def Orbit_Anomalies(MJDs, Period, T0, ecc):
+    MJDs = np.asarray(MJDs, dtype=float)
+    Key = (hashlib.sha1(np.ascontiguousarray(MJDs).tobytes()).hexdigest(), float(Period), float(T0), float(ecc))
+    if Key in AnomalyCache:
+        AnomalyCache.move_to_end(Key)
+        return AnomalyCache[Key]
+    phis = (MJDs-T0)/Period - ((MJDs-T0)/Period).astype(int)
+    Es = Kepler(1., 2 * np.pi * phis, ecc)
+    eccfac = np.sqrt((1 + ecc) / (1 - ecc))
+    nus = 2. * np.arctan(eccfac * np.tan(0.5 * Es))
+    AnomalyCache[Key] = (phis, nus)
+    if len(AnomalyCache) > 256:
+        AnomalyCache.popitem(last=False)
+    return phis, nus
+
+
+# Orbital parameters that determine the anomalies of the inner ('nusdata', 'phis') and outer ('nusdataOut', 'phisOut') orbit
+AnomalyParams = {'in': ['Period', 'T0', 'ecc'], 'Out': ['PeriodOut', 'T0Out', 'eccOut']}
+
+# Arguments of disentangle / disentangle3Comp (DisArgs) with the anomalies of the orbits in Orbital_Params (see Orbit_Anomalies)
+def Orbit_DisArgs(DisArgs, Orbital_Params, CompNum=2):
+    phis, nusdata = Orbit_Anomalies(DisArgs['MJDs'], *[Orbital_Params[Key] for Key in AnomalyParams['in']])
+    DisArgs = dict(DisArgs, nusdata=nusdata, phis=phis)
+    if CompNum==3:
+        phisOut, nusdataOut = Orbit_Anomalies(DisArgs['MJDs'], *[Orbital_Params[Key] for Key in AnomalyParams['Out']])
+        DisArgs = dict(DisArgs, nusdataOut=nusdataOut, phisOut=phisOut)
+    return DisArgs
+
+
+# False if the orbit(s) of Orbital_Params are not physical: period <= 0, eccentricity outside [0, 1), negative K, 
+# or (CompNum = 3) a negative or undefined semi-amplitude of the inner binary on the outer orbit (see v1andv2)
+def Orbit_Physical(Orbital_Params, CompNum=2):
+    if not (Orbital_Params['Period'] > 0 and 0 <= Orbital_Params['ecc'] < 1 and Orbital_Params['K1'] >= 0 and Orbital_Params['K2'] >= 0):
+        return False
+    if CompNum==3:
+        if not (Orbital_Params['PeriodOut'] > 0 and 0 <= Orbital_Params['eccOut'] < 1 and Orbital_Params['KOut'] > 0):
+            return False
+        with np.errstate(invalid='ignore'):
+            K_bin = ( Orbital_Params['Period']/Orbital_Params['PeriodOut'] * ( (1 - Orbital_Params['ecc']**2)/(1 - Orbital_Params['eccOut']**2) )**(3./2.) * (Orbital_Params['K1'] + Orbital_Params['K2'])**3 / Orbital_Params['KOut'] )**0.5 - Orbital_Params['KOut']
+        return bool(K_bin >= 0)
+    return True
+
+
+# Extreme RVs (min, max) of the inner binary with K1 = K1max, K2 = K2max over the valid points of a grid over orbital parameters (Keys, Axes, 
+# Valid, see Grid_disentangling_Orbit). Used as VradRange of Reduce_Waves, the chi2 of all grid points is computed on the same pixels.
+def Orbit_Vrad_Range(MJDs, Keys, Axes, Valid, Orbital_Params, K1max, K2max):
+    VrMin, VrMax = np.inf, -np.inf
+    for inds in zip(*np.nonzero(Valid)):
+        Params = dict(Orbital_Params, **{Key: Axis[k] for Key, Axis, k in zip(Keys, Axes, inds)})
+        Params['K1'], Params['K2'] = K1max, K2max
+        phis, nusdata = Orbit_Anomalies(MJDs, *[Params[Key] for Key in AnomalyParams['in']])
+        vrA, vrB = v1andv2(nusdata, Params)
+        VrMin, VrMax = min(VrMin, np.amin(vrA), np.amin(vrB)), max(VrMax, np.amax(vrA), np.amax(vrB))
+    return float(VrMin), float(VrMax)
     
     
 
 
 
+# Reduced chi2, normalised to its minimum, corresponding to the confidence level P1 (default: 1sig=68%) for nu DoFs
+def Chi2_Threshold(nu, P1=0.68):
+# The probability distribution of (non-reduced) chi2 peaks at nu. Compute array around this value    
+    xarr = np.arange(nu/10., nu*10, 1)
+# The cumulative probability distribution of chi^2 (i.e., Prob(chi2)<x) with nu DoFs is the regularised incomplete Gamma function Gamma(nu/2, x/2)
+# Hence, we look for the index and x value at which Prob(chi2) < P1
+    ys1 = sc.gammainc(nu/2., xarr/2) - P1
+    minarg1 = np.argmin(np.abs(ys1))
+    return xarr[minarg1]/nu   
+
+
+# Error on K from a parabola a*K^2 + b*K + c fitted to the reduced chi2 around its minimum; identical to the error of Chi2con:
+# after normalising by the parabola minimum, the error is the distance from the minimum at which the parabola reaches Chi2_Threshold
+def Parabola_Error(a, b, c, nu, P1=0.68):
+    ParbMin = c - b**2/4./a
+    return np.sqrt((Chi2_Threshold(nu, P1) - 1.) * ParbMin / a)
+
+
+# Axis labels of orbital parameters for Chi2con (comp = parameter name; grids over orbital parameters, see Grid_disentangling_Orbit)
+OrbitParamLabels = {'Period': r'$P$ [d]', 'T0': r'$T_0$ [d]', 'ecc': r'$e$', 'omega': r'$\omega$ [deg]', 'Gamma': r'$\Gamma$ [km/s]', 'K1': r'$K_1$ [km/s]', 'K2': r'$K_2$ [km/s]',
+                    'PeriodOut': r'$P_\mathrm{out}$ [d]', 'T0Out': r'$T_{0,\mathrm{out}}$ [d]', 'eccOut': r'$e_\mathrm{out}$', 'omegaOut': r'$\omega_\mathrm{out}$ [deg]', 'KOut': r'$K_3$ [km/s]'}
+
 #Calculate K corresponding to chi2 minimum by fitting parabola to minimum region + confidence interval (default: 1sig=68%)    
 # redchi2: array of reduced chi2, i.e chi2/DoF (DoF = Degrees of Freedom)
 # nu = DoF
@@ -154,7 +399,9 @@ def Chi2con(redchi2, nu, Kscomp, Rangestr, P1=0.68, comp='secondary', ParbSize =
     indmin = np.argmin(redchi2)    
     i1 = max(0, indmin-ParbSize)
     i2 = min(len(Kscomp)-1, indmin+ParbSize)
-    a,b,c = np.polyfit(Kscomp[i1:i2], redchi2[i1:i2], 2)      
+# Orbital-parameter axes are short: include the last point of the window in the fits
+    j2 = i2 + 1 if comp in OrbitParamLabels else i2
+    a,b,c = np.polyfit(Kscomp[i1:j2], redchi2[i1:j2], 2)      
     if a < 0:
         print("Could not fit sensible parabola (a < 0); try changing the fitting range by increasing/decreasing ParbSize argument")
         plt.scatter(Kscomp, redchi2)
@@ -163,16 +410,10 @@ def Chi2con(redchi2, nu, Kscomp, Rangestr, P1=0.68, comp='secondary', ParbSize =
     ParbMin = c - b**2/4./a
 # Now compute non-reduced, normalised chi2 distribution  
     chi2 = redchi2 * nu /  ParbMin
-# The probability distribution of (non-reduced) chi2 peaks at nu. Compute array around this value    
-    xarr = np.arange(nu/10., nu*10, 1)
-# The cumulative probability distribution of chi^2 (i.e., Prob(chi2)<x) with nu DoFs is the regularised incomplete Gamma function Gamma(nu/2, x/2)
-# Hence, we look for the index and x value at which Prob(chi2) < P1
-    ys1 = sc.gammainc(nu/2., xarr/2) - P1
-    minarg1 = np.argmin(np.abs(ys1))
 # This is the chi2 value corresponding to P1 (typically 1-sigma)    
-    chi2P1 = xarr[minarg1]/nu   
+    chi2P1 = Chi2_Threshold(nu, P1)
 # Now fit parabola to reduced chi2, after normalisation:
-    a,b,c = np.polyfit(Kscomp[i1:i2], chi2[i1:i2]/nu, 2)  
+    a,b,c = np.polyfit(Kscomp[i1:j2], chi2[i1:j2]/nu, 2)  
     chi2fine = np.arange(Kscomp[i1], Kscomp[i2], 0.01)
     parb = a*chi2fine**2 + b*chi2fine  + c
     plt.scatter(Kscomp, chi2/nu*ParbMin)
@@ -194,26 +435,29 @@ def Chi2con(redchi2, nu, Kscomp, Rangestr, P1=0.68, comp='secondary', ParbSize =
         plt.xlabel(r'$K_3$ [km/s]')        
         np.savetxt('disentangled/' + Rangestr + '_' + 'grid_dis_K3.txt', np.c_[Kscomp, redchi2], header='#1sigma = ' + str(chi2P1*ParbMin))    
         plt.savefig('disentangled/' + Rangestr +  '_Grid_disentangling_K3.pdf', bbox_inches='tight')       
+    elif comp in OrbitParamLabels:
+        plt.xlabel(OrbitParamLabels[comp])        
+        np.savetxt('disentangled/' + Rangestr + '_' + 'grid_dis_' + comp + '.txt', np.c_[Kscomp, redchi2], header='#1sigma = ' + str(chi2P1*ParbMin))    
+        plt.savefig('disentangled/' + Rangestr +  '_Grid_disentangling_' + comp + '.pdf', bbox_inches='tight')       
     else:
         sys.exit("type of companion not defined -- error in subroutine Chi2con...")        
     plt.show()    
     return chi2P1, K2min, K2err
 
 # Reead HERMES data
-def read_HERMES(infile):
+def read_HERMES(infile, hdul):
     print(("%s: Input file is a HERMES file." % infile))
-    header = fits.getheader(infile)
+    header = hdul[0].header
+    flux = hdul[0].data
     # for files with standard wavelegth array
     if ((header['CTYPE1'] == 'WAVELENGTH') or (header['CTYPE1'] == 'AWAV')):
-        flux = fits.getdata(infile)
         crval = header['CRVAL1']
         cdelt = header['CDELT1']
         naxis1 = header['NAXIS1']
         wave = crval + np.arange(0, naxis1) * cdelt
 
     # for files that are given in logarithmic wl array
-    if (header['CTYPE1'] == 'log(wavelength)'):
-        flux = fits.getdata(infile)
+    elif (header['CTYPE1'] == 'log(wavelength)'):
         crval = header['CRVAL1']
         cdelt = header['CDELT1']
         naxis1 = header['NAXIS1']
@@ -223,7 +467,7 @@ def read_HERMES(infile):
         print("Could not read in HERMES fits file - unknown file type.")
         sys.exit()
     flux = np.nan_to_num(flux, 1.)
-    return np.array([wave, flux]).T
+    return wave, flux, None
 
 #Ensures that arr values where arr > lim  are set to 0 in domains specified in Poslim array
 def Limit(waves, arr, lim, Poslim):
@@ -240,23 +484,27 @@ def Limit(waves, arr, lim, Poslim):
 
 
 # Shrinks the wavelength domain on which obs-mod is calculated to avoid edge issues
-def Reduce_Waves(waves, nusdata, Orbital_Params, K1max, K2max):
+# VradRange = (min, max) RV [km/s] used instead of the extreme RVs of this orbit (e.g. a pixel set common to a grid of orbits, see Orbit_Vrad_Range)
+def Reduce_Waves(waves, nusdata, Orbital_Params, K1max, K2max, VradRange=None):
     Orbital_Params_max = Orbital_Params.copy()
     Orbital_Params_max['K1'] = K1max
     Orbital_Params_max['K2'] = K2max    
     vrA, vrB = v1andv2(nusdata, Orbital_Params_max)
+    VrMin, VrMax = min(min(vrA), min(vrB)), max(max(vrA), max(vrB))
+    if VradRange is not None:
+        VrMin, VrMax = VradRange
     Inds = np.where(np.diff(waves) > waves[1]-waves[0])
     WaveCalcCond = waves < 0
     if len(Inds) == 0:
-        LamMin = waves[0]*(1. +  max(max(vrA), max(vrB))/clight)
-        LamMax = waves[-1]*(1. +  min(min(vrA), min(vrB))/clight)
+        LamMin = waves[0]*(1. +  VrMax/clight)
+        LamMax = waves[-1]*(1. +  VrMin/clight)
         WaveCalcCond = (waves > LamMin) * (waves < LamMax)
     else:
         Inds = np.append(0, Inds[0])
         Inds = np.append(Inds, len(waves)-1)
         for j in np.arange(len(Inds)-1):
-            LamMin = waves[Inds[j]+1]*(1. +  max(max(vrA), max(vrB))/clight)
-            LamMax = waves[Inds[j+1]]*(1. +  min(min(vrA), min(vrB))/clight)
+            LamMin = waves[Inds[j]+1]*(1. +  VrMax/clight)
+            LamMax = waves[Inds[j+1]]*(1. +  VrMin/clight)
             WaveCalcCond = WaveCalcCond + (waves > LamMin) * (waves < LamMax)
 ##Reduce nebular lines regions:
     #if NebLineCutchi2 == True:
@@ -269,16 +517,16 @@ def Reduce_Waves(waves, nusdata, Orbital_Params, K1max, K2max):
     return WaveCalcCond
 
 
-def Prepare_Plot_Extremes(fig, axes, waves, SpecShiftArr, Nebshift, ObsSpec, specsum, specname, PhiArr, MJD, pltExtyMin, pltExtyMax, StarName, Rangestr, KNowArr, PanelCount, linewidth=3, NebLines=False, Panel=0, linewidExt=3, ExtremesFigSize=(7,8), ResizeExtremesFac_min = 1., ResizeExtremesFac_max = 1., TitleFileName=False, DisLine=None, ObsCol = 'blue', PrimCol='black', SecCol='green', TerCol='purple', SumCol='red', NebCol='pink' ):
+def Prepare_Plot_Extremes(fig, axes, waves, SpecShiftArr, Nebshift, ObsSpec, specsum, specname, PhiArr, MJD, pltExtyMin, pltExtyMax, StarName, Rangestr, KNowArr, PanelCount, linewidth=3, NebLines=False, Panel=0, linewidExt=3, ExtremesFigSize=(7,8), ResizeExtremesFac_min = 1., ResizeExtremesFac_max = 1., TitleFileName=False, DisLine=None, ObsCol = 'blue', PrimCol='black', SecCol='green', TerCol='purple', SumCol='red', NebCol='pink', QuatCol='orange' ):
     axes[Panel].plot(waves, SpecShiftArr[0], label='Prim Dis.', color=PrimCol, linestyle = 'dotted', linewidth=linewidExt)
     axes[Panel].plot(waves, SpecShiftArr[1], label='Sec. Dis.', color=SecCol, linewidth=linewidExt)   
     if NebLines:
         axes[Panel].plot(waves, Nebshift, label='Nebular Dis.', color=NebCol)               
-    if len(SpecShiftArr)==3:
-        axes[Panel].plot(waves, SpecShiftArr[2], label='Ter. Dis.', color=TerCol, linewidth=linewidExt)           
+    for SpecShift, Label, Col in zip(SpecShiftArr[2:], ['Ter. Dis.', 'Quat. Dis.'], [TerCol, QuatCol]):
+        axes[Panel].plot(waves, SpecShift, label=Label, color=Col, linewidth=linewidExt)           
     if len(SpecShiftArr)==2:
         axes[Panel].plot(waves, ObsSpec, color=ObsCol, label=str(round(MJD,1)) + r', $\varphi=$' + str(round(PhiArr[0], 2)))
-    elif len(SpecShiftArr)==3:
+    else:
         axes[Panel].plot(waves, ObsSpec, color=ObsCol, label=str(round(MJD,1)) + r', $\varphi_{\rm in}=$' + str(round(PhiArr[0], 2)) + r', $\varphi_{\rm Out}=$' + str(round(PhiArr[1], 2))    )        
     axes[Panel].plot(waves, specsum, label='Sum Dis.', color=SumCol, linestyle = '--', linewidth=linewidExt)    
     if TitleFileName == True:
@@ -297,7 +545,7 @@ def Prepare_Plot_Extremes(fig, axes, waves, SpecShiftArr, Nebshift, ObsSpec, spe
     PanelCount +=1
     if len(SpecShiftArr)==2:
         FinPanelNum = 2
-    elif len(SpecShiftArr)==3:
+    else:
         FinPanelNum = 4
     if PanelCount==FinPanelNum:
         axes[Panel].set_xlabel(r'Wavelength$\,[\AA]$')
@@ -309,9 +557,9 @@ def Prepare_Plot_Extremes(fig, axes, waves, SpecShiftArr, Nebshift, ObsSpec, spe
             except:
                 NameFile =  'disentangled/' + StarName + '_' + Rangestr + '_Extremes_' + str(np.round(Orbital_Params['K1'])) + '_' + str(np.round(K2s[kcount])) + '.pdf'   
                 plt.savefig(NameFile, bbox_inches='tight')   
-        elif len(SpecShiftArr)==3:
+        else:
             try:
-                NameFile =  'disentangled/' + StarName + '_' + Rangestr + '_Extremes_' + str(np.round(KNowArr[0])) + '_' + str(np.round(KNowArr[1])) + '_' + str(np.round(KNowArr[2])) +  '.pdf'   
+                NameFile =  'disentangled/' + StarName + '_' + Rangestr + '_Extremes_' + '_'.join([str(np.round(K)) for K in KNowArr]) +  '.pdf'   
                 plt.savefig(NameFile, bbox_inches='tight')                                       
             except:
                 sys.error("No idea why this should fail... Maybe you do? Existing 'Prepare_Plot_Extremes' routine")           
@@ -319,287 +567,493 @@ def Prepare_Plot_Extremes(fig, axes, waves, SpecShiftArr, Nebshift, ObsSpec, spe
     return PanelCount
 
 
-# Calculate difference 
-def CalcDiffs(DisSpecVector, vrA, vrB,  waves, ObsSpecs, nusdata,  Orbital_Params, K1s, K2s, MJDs, phis, specnames, Rangestr, StarName, ScalingNeb, Resid=False, Reduce=False, ShowItr=False, PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0,  linewidExt=3, NebLines = False, NebFac=1, S2NpixelRange=5, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1, ResizeExtremesFac_min=1, TitleFileName=False, DisLine=None):
-    global kcount, k1, k2, DoFs, K1now, K2now
-    RVExtmaxInd, RVExtminInd = np.argmax(vrA), np.argmin(vrA)     
-    A, B, NebSpec = DisSpecVector
-    if Resid:
-        Residuals = []    
-    if 'DoFs' not in globals():
-        DoFs=1
-    WaveCalcCond = Reduce_Waves(waves, nusdata, Orbital_Params, K1s[-1], K2s[-1])
-    Sum = 0     
-    if 'kcount' not in globals():
-        kcount = 0
+# Parts of the chi2 that depend only on the data set and the K range, computed once and kept for later calls (at most 16 data sets):
+# WaveCalcCond = pixels covered at all epochs (Reduce_Waves), Obs = observations on these pixels (epochs x pixels),
+# Sigma = noise per epoch estimated from the S2NpixelRange pixels at both edges of Obs.
+Chi2Setups = OrderedDict()
+
+def Chi2_Setup(waves, ObsSpecs, nusdata, Orbital_Params, K1max, K2max, S2NpixelRange=5, VradRange=None):
+    OrbKey = json.dumps({Key: Val for Key, Val in Orbital_Params.items() if Key not in ['K1', 'K2']}, sort_keys=True, default=str)
+    Key = (id(ObsSpecs), len(ObsSpecs), hashlib.sha1(np.ascontiguousarray(waves).tobytes()).hexdigest(), 
+           hashlib.sha1(np.ascontiguousarray(nusdata).tobytes()).hexdigest(), float(K1max), float(K2max), OrbKey, S2NpixelRange, 
+           None if VradRange is None else tuple(float(Vr) for Vr in VradRange))
+    if Key in Chi2Setups:
+        Chi2Setups.move_to_end(Key)
+        return Chi2Setups[Key]['Setup']
+    WaveCalcCond = Reduce_Waves(waves, nusdata, Orbital_Params, K1max, K2max, VradRange)
+    Obs = Shift_Obs(ObsSpecs, np.ones(len(ObsSpecs)), waves[WaveCalcCond])
+    Sigma = (np.std(Obs[:, :S2NpixelRange], axis=1) + np.std(Obs[:, -S2NpixelRange:], axis=1))/2.
+    Setup = {'WaveCalcCond': WaveCalcCond, 'Obs': Obs, 'Sigma': Sigma}
+# The entry keeps a reference to ObsSpecs, so that its id is not reused by another list of spectra
+    Chi2Setups[Key] = {'ObsSpecs': ObsSpecs, 'Setup': Setup}
+    if len(Chi2Setups) > 16:
+        Chi2Setups.popitem(last=False)
+    return Setup
+
+
+# Disentangled spectra DisSpecVector (components, nebular spectrum last) shifted to all epochs on the pixels waves[WaveCalcCond].
+# Returns the shifted components (components x epochs x pixels), the shifted nebular spectrum (epochs x pixels) and their sum (epochs x pixels)
+def Chi2_Model(DisSpecVector, vradsArr, waves, WaveCalcCond, ScalingNeb, NebLines=False, NebFac=1):
+    ShiftSpecs = []
+    for vrads, Spec in zip(vradsArr, DisSpecVector):
+        Facshift = np.sqrt( (1 + vrads/clight) / (1 - vrads/clight))
+        ShiftSpecs.append(Batch_Lerp(Spec, Lerp_Table(waves[None, :]*Facshift[:, None], waves[WaveCalcCond])))
+    ShiftSpecs = np.array(ShiftSpecs)
+    if NebLines:
+        Nebshift = NebFac*np.asarray(ScalingNeb)[:, None]*DisSpecVector[-1][WaveCalcCond][None, :]
+    else:
+        Nebshift = np.zeros(ShiftSpecs.shape[1:])
+    return ShiftSpecs, Nebshift, np.sum(ShiftSpecs, axis=0) + Nebshift
+
+
+# Plots of CalcDiffsNComp: PLOTFITS = fits of all epochs, PLOTEXTREMES = observations at the extreme RVs of the primary 
+# (and of the third component for >= 3 components)
+def Plot_Diffs(ShiftSpecs, Nebshift, Model, Setup, waves, vradsArr, DisSpecVector, Orbital_Params, MJDs, PhisArr, specnames, Rangestr, StarName, PLOTFITS=False, PLOTEXTREMES=False,  linewidExt=3, NebLines = False, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1, ResizeExtremesFac_min=1, TitleFileName=False, DisLine=None):
+    CompNum = len(vradsArr)
+    WavesCalc = waves[Setup['WaveCalcCond']]
+    RVExtmaxInd, RVExtminInd = np.argmax(vradsArr[0]), np.argmin(vradsArr[0])     
+    if CompNum > 2:
+        RVExtmaxInd_Out, RVExtminInd_Out = np.argmax(vradsArr[2]), np.argmin(vradsArr[2])     
     if PLOTEXTREMES: 
-        plotminyarr=[]
-        plotmaxyarr=[]
-        for ind in np.arange(len(ObsSpecs)):
-            plotminyarr.append(np.amin(interp1d(ObsSpecs[ind][:,0], ObsSpecs[ind][:,1]-1,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])))
-            plotmaxyarr.append(np.amax(interp1d(ObsSpecs[ind][:,0], ObsSpecs[ind][:,1]-1,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])))
-        plotminyarr.append(min(A))
-        plotminyarr.append(min(B)) 
-        plotmaxyarr.append(max(A))
-        plotmaxyarr.append(max(B))        
-        pltExtyMin = min(plotminyarr)*1.1
-        pltExtyMax = max(plotmaxyarr)*1.1
-    ExtremePlotDefined = False           
-    for ind in np.arange(len(ObsSpecs)):
-        vA = vrA[ind]/clight
-        vB = vrB[ind]/clight
-        Facshift1 = np.sqrt( (1 + vA) / (1 - vA))
-        Facshift2 = np.sqrt( (1 + vB) / (1 - vB))
-        Ashift = interp1d(waves*Facshift1, A,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])   
-        Bshift = interp1d(waves*Facshift2, B,bounds_error=False, fill_value=0.)(waves[WaveCalcCond]) 
-        ObsSpec = interp1d(ObsSpecs[ind][:,0], ObsSpecs[ind][:,1]-1,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])   
-        if NebLines:
-            vNeb = 0.                    
-            Nebshift = NebFac*ScalingNeb[ind]*interp1d(waves, NebSpec,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])   
-            specsum = Ashift + Bshift + Nebshift   
-        else:      
-            Nebshift = np.zeros(len(Ashift))
-            specsum = Ashift + Bshift              
-        sigma =  (np.std(ObsSpec[:S2NpixelRange]) +  np.std(ObsSpec[-S2NpixelRange:]))/2.
-
-        if Resid:
-            Residuals.append(ObsSpec - specsum)        
-        Sum +=np.sum( (ObsSpec - specsum)**2/sigma**2)   
+        pltExtyMin = min(np.amin(Setup['Obs']), min(DisSpecVector[0]), min(DisSpecVector[1]))*1.1
+        pltExtyMax = max(np.amax(Setup['Obs']), max(DisSpecVector[0]), max(DisSpecVector[1]))*1.1
+# K values of the components: K1, K2 (+ KOut for triples; + KOut, K3, K4 for quadruples)
+        KNowArr = [Orbital_Params[KName] for KName in ['K1', 'K2', 'KOut', 'K3', 'K4'][:CompNum + (CompNum > 3)]]
+        if CompNum==2:
+            Panels = {min(RVExtminInd, RVExtmaxInd): [0], max(RVExtminInd, RVExtmaxInd): [1]}
+        else:
+            Panels = {}
+            for Extind, Panel in zip([RVExtminInd, RVExtmaxInd, RVExtmaxInd_Out, RVExtminInd_Out], [(0,0), (1,0), (0,1), (1,1)]):
+                Panels[Extind] = Panels.get(Extind, []) + [Panel]
+        fig, axes = plt.subplots(nrows=2, ncols=1 if CompNum==2 else 2, figsize=ExtremesFigSize)  
+        PanelCount = 0                 
+    for ind in np.arange(len(Model)):
         if PLOTFITS:
-# User needs to change kcount==1 condition if a specific K2 is desired for plotting.             
-            if kcount==kcount_usr:      
-                plt.plot(waves[WaveCalcCond], specsum, label='sum')
-                plt.plot(waves[WaveCalcCond], Ashift, label='A')
-                plt.plot(waves[WaveCalcCond], Bshift, label='B')   
-                if NebLines:
-                    plt.plot(waves[WaveCalcCond], Nebshift, label='Neb')   
-                plt.plot(waves[WaveCalcCond], ObsSpec, label=specnames[ind].split('/')[-1]  + r', $\varphi=$' + str(round(phis[ind], 2)))
-                plt.plot([waves[WaveCalcCond][0], waves[WaveCalcCond][-1]], [0., 0.], color='black')
-                plt.legend()
-                plt.show()   
+            plt.plot(WavesCalc, Model[ind], label='sum')
+            for Shifted, Label in zip(ShiftSpecs[:, ind], ['A', 'B', 'C', 'D']):
+                plt.plot(WavesCalc, Shifted, label=Label)
+            if NebLines:
+                plt.plot(WavesCalc, Nebshift[ind], label='Neb')   
+            plt.plot(WavesCalc, Setup['Obs'][ind], label=specnames[ind].split('/')[-1]  + r', $\varphi=$' + str(round(PhisArr[0][ind], 2)))
+            plt.plot([WavesCalc[0], WavesCalc[-1]], [0., 0.], color='black')
+            plt.legend()
+            plt.show()   
         if PLOTEXTREMES:
-            if kcount==kcount_extremeplot:
-                if not ExtremePlotDefined:
-                    fig, axes = plt.subplots(nrows=2, ncols=1, figsize=ExtremesFigSize)  
-                    ExtremePlotDefined = True      
-                    PanelCount = 0                 
-                ShiftSpecArr = [Ashift, Bshift]
-                PhiArr = [phis[ind]]
-                KNowArr = [K1now, K2now]
-                if ind==min(RVExtminInd, RVExtmaxInd):
-                    PanelCount = Prepare_Plot_Extremes(fig, axes, waves[WaveCalcCond], ShiftSpecArr, Nebshift, ObsSpec, specsum, specnames[ind], PhiArr, MJDs[ind], pltExtyMin, pltExtyMax, StarName, Rangestr, KNowArr, PanelCount, linewidth=linewidExt, NebLines=NebLines, ExtremesFigSize=ExtremesFigSize, Panel=0, ResizeExtremesFac_max = ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)                   
-                elif ind==max(RVExtminInd, RVExtmaxInd):
-                    PanelCount = Prepare_Plot_Extremes(fig, axes, waves[WaveCalcCond], ShiftSpecArr, Nebshift, ObsSpec, specsum, specnames[ind], PhiArr, MJDs[ind], pltExtyMin, pltExtyMax, StarName, Rangestr, KNowArr, PanelCount, linewidth=linewidExt, NebLines=NebLines,  ExtremesFigSize=ExtremesFigSize, Panel=1, ResizeExtremesFac_max = ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)  
+            PhiArr = [phis[ind] for phis in PhisArr]
+            for Panel in Panels.get(ind, []):
+                PanelCount = Prepare_Plot_Extremes(fig, axes, WavesCalc, ShiftSpecs[:, ind], Nebshift[ind], Setup['Obs'][ind], Model[ind], specnames[ind], PhiArr, MJDs[ind], pltExtyMin, pltExtyMax, StarName, Rangestr, KNowArr, PanelCount, linewidth=linewidExt, NebLines=NebLines, ExtremesFigSize=ExtremesFigSize, Panel=Panel, ResizeExtremesFac_max = ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)                   
+
+
+# Calculate difference between observations and the sum of the shifted disentangled spectra DisSpecVector (components, nebular spectrum last)
+# for any number of components; vradsArr = list of RV arrays of the components (observer's frame), PhisArr = list of phase arrays shown in the plots
+# All epochs are shifted and compared at once (Chi2_Setup, Chi2_Model); plots (Plot_Diffs) only for kcount = kcount_usr (PLOTFITS) / kcount_extremeplot (PLOTEXTREMES)
+def CalcDiffsNComp(DisSpecVector, vradsArr, waves, ObsSpecs, nusdata,  Orbital_Params, K1s, K2s, MJDs, PhisArr, specnames, Rangestr, StarName, ScalingNeb, Resid=False, Reduce=False, ShowItr=False, PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0,  linewidExt=3, NebLines = False, NebFac=1, S2NpixelRange=5, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1, ResizeExtremesFac_min=1, TitleFileName=False, DisLine=None, kcount=None, PerEpoch=False, VradRange=None):
+    CompNum = len(vradsArr)
+    Setup = Chi2_Setup(waves, ObsSpecs, nusdata, Orbital_Params, K1s[-1], K2s[-1], S2NpixelRange, VradRange)
+    ShiftSpecs, Nebshift, Model = Chi2_Model(DisSpecVector, vradsArr, waves, Setup['WaveCalcCond'], ScalingNeb, NebLines=NebLines, NebFac=NebFac)
+    Residuals = Setup['Obs'] - Model
+    Sum = np.sum(Residuals**2 / Setup['Sigma'][:, None]**2)
+    if (PLOTFITS and kcount==kcount_usr) or (PLOTEXTREMES and kcount==kcount_extremeplot):
+        Plot_Diffs(ShiftSpecs, Nebshift, Model, Setup, waves, vradsArr, DisSpecVector, Orbital_Params, MJDs, PhisArr, specnames, Rangestr, StarName, PLOTFITS=PLOTFITS and kcount==kcount_usr, 
+                   PLOTEXTREMES=PLOTEXTREMES and kcount==kcount_extremeplot, linewidExt=linewidExt, NebLines=NebLines, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, 
+                   ResizeExtremesFac_min=ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)
     print("kcount:", kcount)   
-    if DoFs==0:
-        try:
-            DoFs += len(waves[WaveCalcCond]) * (len(ObsSpecs)-2)
-        except:
-            pass
-    kcount+=1
+    NPix = np.sum(Setup['WaveCalcCond'])
     if not ShowItr:
-        print("chi2:",  Sum/ (len(waves[WaveCalcCond])* len(ObsSpecs) - 2))
+        print("chi2:",  Sum/ (NPix* len(ObsSpecs) - CompNum))
     if Resid:
-        return Residuals
+        return list(Residuals)
+# Chi2 contributions of the individual epochs (e.g. for resampling the epochs, see Grid_Resample)
+    if PerEpoch:
+        return np.sum(Residuals**2 / Setup['Sigma'][:, None]**2, axis=1)
     if Reduce:
-        return Sum/ (len(waves[WaveCalcCond]) * len(ObsSpecs) - 1)
+        return Sum/ (NPix * len(ObsSpecs) - 1)
     else:
         return Sum
+
+
+
+# Calculate difference (binary), see CalcDiffsNComp
+def CalcDiffs(DisSpecVector, vrA, vrB,  waves, ObsSpecs, nusdata,  Orbital_Params, K1s, K2s, MJDs, phis, specnames, Rangestr, StarName, ScalingNeb, **kwargs):
+    return CalcDiffsNComp(DisSpecVector, [vrA, vrB], waves, ObsSpecs, nusdata, Orbital_Params, K1s, K2s, MJDs, [phis], specnames, Rangestr, StarName, ScalingNeb, **kwargs)
     
     
 
-# Calculate difference 
-def CalcDiffs3D(DisSpecVector, vrA, vrB, vrOut, vrBin, waves, ObsSpecs, nusdata, nusdataOut,  Orbital_Params, K1s, K2s, KOuts, MJDs, phis, phisOut, specnames, Rangestr, StarName, ScalingNeb, Resid=False, Reduce=False, ShowItr=False, PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0,  linewidExt=3, NebLines = False, NebFac=1, S2NpixelRange=5, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1, ResizeExtremesFac_min=1, TitleFileName=False, DisLine=None):
-    global kcount, k1, k2, kOut, DoFs, K1now, K2now, K3now
-    RVExtmaxInd, RVExtminInd = np.argmax(vrA), np.argmin(vrA)     
-    RVExtmaxInd_Out, RVExtminInd_Out = np.argmax(vrOut), np.argmin(vrOut)     
-    A, B, C, NebSpec = DisSpecVector
-    if Resid:
-        Residuals = []    
-    if 'DoFs' not in globals():
-        DoFs=1
-    WaveCalcCond = Reduce_Waves(waves, nusdata, Orbital_Params, K1s[-1], K2s[-1])
-    Sum = 0     
-    if 'kcount' not in globals():
-        kcount = 0
-    if PLOTEXTREMES: 
-        plotminyarr=[]
-        plotmaxyarr=[]
-        for ind in np.arange(len(ObsSpecs)):
-            plotminyarr.append(np.amin(interp1d(ObsSpecs[ind][:,0], ObsSpecs[ind][:,1]-1,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])))
-            plotmaxyarr.append(np.amax(interp1d(ObsSpecs[ind][:,0], ObsSpecs[ind][:,1]-1,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])))
-        plotminyarr.append(min(A))
-        plotminyarr.append(min(B)) 
-        plotmaxyarr.append(max(A))
-        plotmaxyarr.append(max(B))        
-        pltExtyMin = min(plotminyarr)*1.1
-        pltExtyMax = max(plotmaxyarr)*1.1
-    ExtremePlotDefined = False        
-    for ind in np.arange(len(ObsSpecs)):
-        vA = (vrA[ind] + vrBin[ind])/clight
-        vB = (vrB[ind] + vrBin[ind])/clight
-        vOut = vrOut[ind]/clight
-        Facshift1 = np.sqrt( (1 + vA) / (1 - vA))
-        Facshift2 = np.sqrt( (1 + vB) / (1 - vB))
-        FacshiftOut = np.sqrt( (1 + vOut) / (1 - vOut))
-        Ashift = interp1d(waves*Facshift1, A,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])   
-        Bshift = interp1d(waves*Facshift2, B,bounds_error=False, fill_value=0.)(waves[WaveCalcCond]) 
-        Cshift = interp1d(waves*FacshiftOut, C,bounds_error=False, fill_value=0.)(waves[WaveCalcCond]) 
-        ObsSpec = interp1d(ObsSpecs[ind][:,0], ObsSpecs[ind][:,1]-1,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])   
-        if NebLines:
-            vNeb = 0.                    
-            Nebshift = NebFac*ScalingNeb[ind]*interp1d(waves, NebSpec,bounds_error=False, fill_value=0.)(waves[WaveCalcCond])   
-            specsum = Ashift + Bshift + Cshift +  Nebshift   
-        else:      
-            Nebshift = np.zeros(len(Ashift))
-        specsum = Ashift + Bshift + Cshift +  Nebshift             
-        sigma =  (np.std(ObsSpec[:S2NpixelRange]) +  np.std(ObsSpec[-S2NpixelRange:]))/2.
-        if Resid:
-            Residuals.append(ObsSpec - specsum)        
-        Sum +=np.sum( (ObsSpec - specsum)**2/sigma**2)   
-        if PLOTFITS:
-# User needs to change kcount==1 condition if a specific K2 is desired for plotting.             
-            if kcount==kcount_usr:      
-                plt.plot(waves[WaveCalcCond], specsum, label='sum')
-                plt.plot(waves[WaveCalcCond], Ashift, label='A')
-                plt.plot(waves[WaveCalcCond], Bshift, label='B')   
-                plt.plot(waves[WaveCalcCond], Cshift, label='C')   
-                if NebLines:
-                    plt.plot(waves[WaveCalcCond], Nebshift, label='Neb')   
-                plt.plot(waves[WaveCalcCond], ObsSpec, label=specnames[ind].split('/')[-1]  + r', $\varphi=$' + str(round(phis[ind], 2)))
-                plt.plot([waves[WaveCalcCond][0], waves[WaveCalcCond][-1]], [0., 0.], color='black')
-                plt.legend()
-                plt.show()   
-        if PLOTEXTREMES:
-            if kcount==kcount_extremeplot:
-                if not ExtremePlotDefined:
-                    fig, axes = plt.subplots(nrows=2, ncols=2, figsize=ExtremesFigSize)  
-                    ExtremePlotDefined = True
-                    PanelCount = 0
-                ShiftSpecArr = [Ashift, Bshift, Cshift]
-                PhiArr = [phis[ind], phisOut[ind]]
-                KNowArr = [K1now, K2now, K3now]    
-                if ind==RVExtminInd:
-                    PanelCount = Prepare_Plot_Extremes(fig, axes, waves[WaveCalcCond], ShiftSpecArr, Nebshift, ObsSpec, specsum, specnames[ind], PhiArr,  MJDs[ind], pltExtyMin, pltExtyMax, StarName, Rangestr, KNowArr, PanelCount, linewidth=linewidExt, NebLines=NebLines, ExtremesFigSize=ExtremesFigSize, Panel=(0,0), ResizeExtremesFac_max = ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)                   
-                if ind==RVExtmaxInd:
-                    PanelCount = Prepare_Plot_Extremes(fig, axes, waves[WaveCalcCond], ShiftSpecArr, Nebshift, ObsSpec, specsum, specnames[ind], PhiArr, MJDs[ind], pltExtyMin, pltExtyMax, StarName, Rangestr, KNowArr, PanelCount, linewidth=linewidExt, NebLines=NebLines,  ExtremesFigSize=ExtremesFigSize, Panel=(1,0), ResizeExtremesFac_max = ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)  
-                if ind==RVExtmaxInd_Out:
-                    PanelCount = Prepare_Plot_Extremes(fig, axes, waves[WaveCalcCond], ShiftSpecArr, Nebshift, ObsSpec, specsum, specnames[ind], PhiArr,  MJDs[ind], pltExtyMin, pltExtyMax, StarName, Rangestr, KNowArr, PanelCount, linewidth=linewidExt, NebLines=NebLines,  ExtremesFigSize=ExtremesFigSize, Panel=(0,1), ResizeExtremesFac_max = ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)  
-                if ind==RVExtminInd_Out:
-                    PanelCount = Prepare_Plot_Extremes(fig, axes, waves[WaveCalcCond], ShiftSpecArr, Nebshift, ObsSpec, specsum, specnames[ind], PhiArr, MJDs[ind], pltExtyMin, pltExtyMax, StarName, Rangestr,KNowArr, PanelCount, linewidth=linewidExt, NebLines=NebLines,  ExtremesFigSize=ExtremesFigSize, Panel=(1,1), ResizeExtremesFac_max = ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)  
-    print("kcount:", kcount)   
-    if DoFs==0:
-        try:
-            DoFs += len(waves[WaveCalcCond]) * (len(ObsSpecs)-3)
-        except:
-            pass
-    kcount+=1
-    if not ShowItr:
-        print("chi2:",  Sum/ (len(waves[WaveCalcCond])* len(ObsSpecs) - 3))
-    if Resid:
-        return Residuals
-    if Reduce:
-        return Sum/ (len(waves[WaveCalcCond]) * len(ObsSpecs) - 1)
+# Calculate difference (triple: inner binary vrA, vrB moving with vrBin on the outer orbit of the tertiary vrOut), see CalcDiffsNComp
+def CalcDiffs3D(DisSpecVector, vrA, vrB, vrOut, vrBin, waves, ObsSpecs, nusdata, nusdataOut,  Orbital_Params, K1s, K2s, KOuts, MJDs, phis, phisOut, specnames, Rangestr, StarName, ScalingNeb, **kwargs):
+    return CalcDiffsNComp(DisSpecVector, [vrA + vrBin, vrB + vrBin, vrOut], waves, ObsSpecs, nusdata, Orbital_Params, K1s, K2s, MJDs, [phis, phisOut], specnames, Rangestr, StarName, ScalingNeb, **kwargs)
+
+
+
+# Linear-interpolation table equivalent to interp1d(SrcWaves[i], y, bounds_error=False, fill_value=0.)(waves) for all epochs i:
+# y_i(waves) = y[inds]*w0 + y[inds+1]*w1, with w0 = w1 = 0 outside SrcWaves[i]. Arrays have shape (epochs x pixels).
+# SrcWaves[i] may differ in length between epochs (e.g. observations).
+def Lerp_Table(SrcWaves, waves):
+    inds = np.zeros((len(SrcWaves), len(waves)), dtype=int)
+    w0, w1 = np.zeros(inds.shape), np.zeros(inds.shape)
+    for i, src in enumerate(SrcWaves):
+        inds[i] = np.clip(np.searchsorted(src, waves, side='right') - 1, 0, len(src)-2)
+        frac = (waves - src[inds[i]]) / (src[inds[i]+1] - src[inds[i]])
+        valid = (waves >= src[0]) * (waves <= src[-1])
+        w0[i], w1[i] = (1. - frac) * valid, frac * valid
+    return inds, w0, w1
+
+
+# Batched gather-and-lerp using a table from Lerp_Table. 
+# values = 1D spectrum (shifted to all epochs) or 2D array (epochs x pixels, row i interpolated with row i of the table)
+def Batch_Lerp(values, Tab):
+    inds, w0, w1 = Tab
+    if np.ndim(values) == 1:
+        return values[inds]*w0 + values[inds+1]*w1
+    rows = np.arange(len(inds))[:, None]
+    return values[rows, inds]*w0 + values[rows, inds+1]*w1
+
+
+# Log-wavelength grid covering waves, with the smallest logarithmic pixel step of waves divided by Oversample
+# On this grid, a Doppler shift by a factor f is a shift by the constant (fractional) number of pixels ln(f)/dlnlam
+def Log_Grid(waves, Oversample=1):
+    dlnlam = np.min(np.diff(np.log(waves))) / Oversample
+    return waves[0] * np.exp(dlnlam * np.arange(int(np.floor(np.log(waves[-1]/waves[0]) / dlnlam + 1e-9)) + 1))
+
+
+# Rounds the K values of a grid to multiples of the pixel velocity step clight*dlnlam of Log_Grid(waves, Oversample), removing duplicates
+# (for Engine='loglam' with integer shifts, K steps below the velocity step cannot be resolved)
+def Snap_K_Grid(Ks, waves, Oversample=1):
+    dv = clight * np.min(np.diff(np.log(waves))) / Oversample
+    return np.unique(np.round(np.asarray(Ks) / dv) * dv)
+
+
+# Two-tap stencil as table of Lerp_Table, for waves = Log_Grid(...) and WavesShift[i] = waves * f_i:
+# the shifted spectrum at pixel j is found at the fractional pixel j - ln(f_i)/dlnlam, i.e. weights are constant per epoch
+# IntShift --> pixel offsets rounded to integers, i.e. pure index shifts without interpolation
+def Log_Shift_Table(WavesShift, waves, IntShift=False):
+    dlnlam = np.log(waves[1]/waves[0])
+    Shifts = np.log(WavesShift[:, 0]/waves[0]) / dlnlam
+    if IntShift:
+        Shifts = np.round(Shifts)
+    Pos = np.arange(len(waves))[None, :] - Shifts[:, None]
+    inds = np.clip(np.floor(Pos).astype(int), 0, len(waves)-2)
+    w1 = Pos - inds
+    w0 = 1. - w1
+    Outside = (Pos < 0) | (Pos > len(waves)-1)
+    w0[Outside], w1[Outside] = 0., 0.
+    return inds, w0, w1
+
+
+# Operator shifting a spectrum sampled on WavesShift[i] (e.g. WavesBA) to waves for all epochs.
+# WavesShift does not change during the iterations, so the operator is built once per K1, K2 pair:
+# Engine='sparse': stacked CSR matrix (rows of epoch i at i*len(waves):(i+1)*len(waves)); Engine='batched': lerp table; 
+# Engine='loglam': table of Log_Shift_Table (waves must be a log-wavelength grid); else None.
+def Shift_Operator(WavesShift, waves, Engine='sparse', IntShift=False):
+    if Engine=='batched':
+        return Lerp_Table(WavesShift, waves)
+    elif Engine=='loglam':
+        return Log_Shift_Table(WavesShift, waves, IntShift)
+    elif Engine=='sparse':
+        inds, w0, w1 = Lerp_Table(WavesShift, waves)
+        rows = np.arange(inds.size).reshape(inds.shape)
+        return csr_matrix((np.append(w0, w1), (np.append(rows, rows), np.append(inds, inds+1))), shape=(inds.size, len(WavesShift[0])))
+    return None
+
+
+# Shifts spec, sampled on WavesShift[i] in the frame of epoch i, to waves for all epochs; returns array (epochs x pixels).
+# Op = operator from Shift_Operator; if None, interp1d objects are constructed per epoch (InterKind='quadratic' / 'cubic': Spline_Shift).
+def Shift_Spec(spec, WavesShift, waves, InterKind='linear', Op=None):
+    if Op is None and InterKind in SplineOrders:
+        return Spline_Shift(spec, WavesShift, waves, SplineOrders[InterKind])
+    elif Op is None:
+        return np.array([interp1d(WavesShift[i], spec, bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in np.arange(len(WavesShift))])
+    elif isinstance(Op, tuple):
+        return Batch_Lerp(spec, Op)
+    return (Op @ spec).reshape(len(WavesShift), len(waves))
+
+
+# Spline interpolation of Shift_Spec for the spline kinds of interp1d, same result as interp1d(WavesShift[i], spec, kind=InterKind) per epoch.
+# The rows of WavesShift are Doppler-scaled copies of one grid (WavesShift[i] = WavesShift[0] * r_i), so the interpolating B-spline of spec is
+# the same for all epochs up to the scaling of its argument: its coefficients are computed once and evaluated at waves / r_i for all epochs at once.
+SplineOrders = {'quadratic': 2, 'cubic': 3}
+
+def Spline_Shift(spec, WavesShift, waves, k=3):
+    Ratios = WavesShift[:, 0] / WavesShift[0, 0]
+    Spline = make_interp_spline(WavesShift[0], spec, k=k, check_finite=False)
+    Inside = (waves[None, :] >= WavesShift[:, :1]) * (waves[None, :] <= WavesShift[:, -1:])
+    return np.where(Inside, Spline(np.clip(waves[None, :] / Ratios[:, None], WavesShift[0, 0], WavesShift[0, -1])), 0.)
+
+
+# Operator shifting the spectra of the components Comps, sampled on WavesShifts[d][i] in the frame of epoch i and scaled per epoch by Scales[d],
+# to waves and summing them, for all epochs. The operators of the components (Shift_Operator) are stacked along a component axis, such that
+# the sum over the components is one gather-and-lerp (Engine='batched' / 'loglam') or one sparse mat-vec (Engine='sparse'); else None.
+def Comp_Shift_Operator(WavesShifts, waves, Scales, Engine='sparse', IntShift=False):
+    Ops = [Shift_Operator(WavesShift, waves, Engine, IntShift) for WavesShift in WavesShifts]
+    if Engine in ['batched', 'loglam']:
+        inds = np.array([Op[0] for Op in Ops])
+        w0 = np.array([Op[1]*Scale[:, None] for Op, Scale in zip(Ops, Scales)])
+        w1 = np.array([Op[2]*Scale[:, None] for Op, Scale in zip(Ops, Scales)])
+        return inds, w0, w1
+    elif Engine=='sparse':
+        return sparse.hstack([sparse.diags(np.repeat(Scale, len(waves))) @ Op for Op, Scale in zip(Ops, Scales)]).tocsr()
+    return None
+
+
+# Sum over the components Comps of the spectra Specs[d] (array components x pixels), shifted with WavesShifts[d] and scaled by Scales[d], 
+# for all epochs; returns array (epochs x pixels). Op = operator from Comp_Shift_Operator; if None, the components are shifted one by one (Shift_Spec).
+def Shift_Comps(Specs, Comps, WavesShifts, waves, Scales, InterKind='linear', Op=None):
+    if Op is None:
+        return sum([Scale[:, None]*Shift_Spec(Specs[d], WavesShift, waves, InterKind) for d, WavesShift, Scale in zip(Comps, WavesShifts, Scales)])
+    elif isinstance(Op, tuple):
+        inds, w0, w1 = Op
+        Rows = np.array(Comps)[:, None, None]
+        return np.sum(Specs[Rows, inds]*w0 + Specs[Rows, inds+1]*w1, axis=0)
+    return (Op @ Specs[Comps].ravel()).reshape(len(WavesShifts[0]), len(waves))
+
+
+# LRU cache of observed spectra shifted to a frame of reference and interpolated onto a wavelength grid (Shift_Obs, shared by all engines and CalcDiffs).
+# Keys: (observed spectrum, velocity of the frame rounded to VelRound km/s, wavelength grid, interpolation); the entries keep a reference to the 
+# observed spectrum, i.e. the spectra must not be changed in place after they were shifted. The cache holds at most MaxBytes (0: no caching);
+# least recently used entries are dropped first. Each process (e.g. worker of a parallel grid) has its own cache.
+ShiftCache = {'Entries': OrderedDict(), 'Bytes': 0, 'MaxBytes': 256 * 2**20, 'VelRound': 1E-6, 'Hits': 0, 'Misses': 0}
+
+# Empties the cache and sets its memory cap [MB] and the velocity rounding [km/s]
+def Shift_Cache_Setup(MaxMB=256, VelRound=1E-6):
+    ShiftCache['Entries'].clear()
+    ShiftCache.update({'Bytes': 0, 'MaxBytes': int(MaxMB * 2**20), 'VelRound': VelRound, 'Hits': 0, 'Misses': 0})
+
+
+# Hits, misses, number of entries and memory [MB] of the cache
+def Shift_Cache_Stats():
+    return {'Hits': ShiftCache['Hits'], 'Misses': ShiftCache['Misses'], 'Entries': len(ShiftCache['Entries']), 'MB': ShiftCache['Bytes'] / 2**20}
+
+
+def Shift_Cache_Get(Key):
+    Entry = ShiftCache['Entries'].get(Key)
+    if Entry is None:
+        ShiftCache['Misses'] += 1
+        return None
+    ShiftCache['Hits'] += 1
+    ShiftCache['Entries'].move_to_end(Key)
+    return Entry[1]
+
+
+def Shift_Cache_Put(Key, ObsSpec, Spec):
+    if Spec.nbytes > ShiftCache['MaxBytes'] or Key in ShiftCache['Entries']:
+        return
+    ShiftCache['Entries'][Key] = (ObsSpec, Spec)
+    ShiftCache['Bytes'] += Spec.nbytes
+    while ShiftCache['Bytes'] > ShiftCache['MaxBytes']:
+        ShiftCache['Bytes'] -= ShiftCache['Entries'].popitem(last=False)[1][1].nbytes
+
+
+# Observed spectra (continuum subtracted) in the frame of reference given by Facshift, interpolated onto waves; returns array (epochs x pixels).
+# Engine='batched' / 'loglam' / 'fourier' / 'lsqr': the observations are stacked in one contiguous (zero-padded) array and interpolated in a single gather-and-lerp.
+# Epochs found in ShiftCache are not interpolated again.
+def Shift_Obs(ObsSpecs, Facshift, waves, InterKind='linear', Engine='classic'):
+    Lerp = Engine in ['batched', 'loglam', 'fourier', 'lsqr']
+    if ShiftCache['MaxBytes'] > 0:
+        GridKey = hashlib.sha1(np.ascontiguousarray(waves).tobytes()).hexdigest()
+        Vels = clight * (np.asarray(Facshift)**2 - 1) / (np.asarray(Facshift)**2 + 1)
+        Keys = [(id(ObsSpecs[i]), int(np.round(Vels[i] / ShiftCache['VelRound'])), GridKey, 'lerp' if Lerp else InterKind) for i in np.arange(len(ObsSpecs))]
+        Shifted = [Shift_Cache_Get(Key) for Key in Keys]
+    else:
+        Shifted = [None] * len(ObsSpecs)
+    Missing = [i for i in np.arange(len(ObsSpecs)) if Shifted[i] is None]
+    if len(Missing) > 0 and Lerp:
+        FluxStack = np.zeros((len(Missing), max([len(ObsSpecs[i]) for i in Missing])))
+        for j, i in enumerate(Missing):
+            FluxStack[j, :len(ObsSpecs[i])] = ObsSpecs[i][:, 1] - 1.
+        New = Batch_Lerp(FluxStack, Lerp_Table([ObsSpecs[i][:, 0] / Facshift[i] for i in Missing], waves))
+    else:
+        New = [interp1d(ObsSpecs[i][:, 0] /Facshift[i], ObsSpecs[i][:, 1]-1.,
+                      bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in Missing]
+    for i, Spec in zip(Missing, New):
+        Shifted[i] = Spec
+        if ShiftCache['MaxBytes'] > 0:
+            Shift_Cache_Put(Keys[i], ObsSpecs[i], np.array(Spec))
+    return np.array(Shifted)
+
+
+
+# Direct disentangling in Fourier space (cf. Hadrava 1995, A&AS, 114, 393): on a zero-padded log-wavelength grid (Log_Grid), the Doppler shifts
+# by Facshifts[c][i] are phase factors P_ic(k), and minimising sum_i weights_i |O_i(k) - sum_c P_ic(k) S_c(k)|^2 decouples into one small
+# (components x components) system per Fourier mode k. The systems are solved with a pseudo-inverse: at k=0 (and for modes not constrained 
+# by the phase coverage) only the sum of the components is defined, and the minimum-norm solution is returned.
+# Facshifts = list of shift-factor arrays (one per component); NebScaling = per-epoch scaling of a stationary nebular component (None: none)
+# Returns the continuum-subtracted component spectra on waves, in the order of Facshifts (followed by the nebular spectrum)
+def Fourier_Disentangle(ObsSpecs, Facshifts, waves, weights, NebScaling=None, Oversample=1, rcond=1E-8):
+    LogWaves = Log_Grid(waves, Oversample)
+    dlnlam = np.log(LogWaves[1]/LogWaves[0])
+    N = len(LogWaves)
+    Shifts = np.array([np.log(Facshift) / dlnlam for Facshift in Facshifts])
+# Zero padding (= continuum) beyond the largest shift avoids wrap-around of the periodic Fourier shifts
+    M = next_fast_len(N + 2*int(np.ceil(np.amax(np.abs(Shifts)))) + 2, real=True)
+    ObsLog = np.zeros((len(ObsSpecs), M))
+    ObsLog[:, :N] = Shift_Obs(ObsSpecs, np.ones(len(ObsSpecs)), LogWaves, Engine='batched')
+    ObsFT = np.fft.rfft(ObsLog, axis=1)
+    k = np.arange(ObsFT.shape[1])
+    P = np.exp(-2j*np.pi * Shifts[:, :, None] * k[None, None, :] / M)
+    if NebScaling is not None:
+        P = np.concatenate([P, np.ones((1,) + P.shape[1:]) * np.asarray(NebScaling)[None, :, None]], axis=0)
+    PW = P.conj() * weights[None, :, None]
+    Normal = np.einsum('cik,dik->kcd', PW, P)
+    Rhs = np.einsum('cik,ik->kc', PW, ObsFT)
+    SpecsFT = np.einsum('kcd,kd->ck', np.linalg.pinv(Normal, rcond=rcond, hermitian=True), Rhs)
+    SpecsLog = Level_Continua(np.fft.irfft(SpecsFT, n=M, axis=1)[:, :N], len(Facshifts), NebScaling)
+    return [interp1d(LogWaves, Spec, bounds_error=False, fill_value=0.)(waves) for Spec in SpecsLog]
+
+
+# Direct least-squares solution of obs_i = sum_c S_c(shifted by Facshifts[c][i]) (+ NebScaling_i * Neb) for all epochs i, weighted by weights:
+# the system is assembled as one sparse matrix from the per-epoch shift operators (Shift_Operator) and solved with LSQR
+# (Damp = Tikhonov damping, e.g. for poor phase coverage; IterLim = maximum number of LSQR iterations; x0 = initial guess, components stacked)
+# Returns the continuum-subtracted component spectra on waves (followed by the nebular spectrum) and the number of LSQR iterations
+def Lsqr_Disentangle(ObsSpecs, Facshifts, waves, weights, NebScaling=None, Damp=0., IterLim=100, x0=None, Tol=1E-8):
+    Ops = [Shift_Operator(np.array([waves*F for F in Facshift]), waves, 'sparse') for Facshift in Facshifts]
+    if NebScaling is not None:
+        Ops.append(sparse.vstack([NebFacEpoch*sparse.identity(len(waves)) for NebFacEpoch in NebScaling]))
+    RowWeights = sparse.diags(np.repeat(np.sqrt(weights), len(waves)))
+    Mat = (RowWeights @ sparse.hstack(Ops)).tocsr()
+    Obs = Shift_Obs(ObsSpecs, np.ones(len(ObsSpecs)), waves, Engine='batched')
+    Res = lsqr(Mat, RowWeights @ Obs.ravel(), damp=Damp, atol=Tol, btol=Tol, iter_lim=IterLim, x0=x0)
+    Specs = Level_Continua(Res[0].reshape(len(Ops), len(waves)), len(Facshifts), NebScaling)
+    return list(Specs), Res[2]
+
+
+# Constant offsets between the (shifted) components are not constrained by the data (e.g. Fourier_Disentangle, Lsqr_Disentangle): 
+# shift the first NumComps spectra of Specs such that they have the same continuum level (median), leaving their sum unchanged.
+# NebScaling (not None, constant) --> Specs[NumComps] is a nebular spectrum scaled by NebScaling, whose continuum level is moved to the components
+def Level_Continua(Specs, NumComps, NebScaling=None):
+    if NebScaling is not None and np.ptp(NebScaling)==0:
+        NebLevel = np.median(Specs[NumComps])
+        Specs[NumComps] -= NebLevel
+        Specs[:NumComps] += NebLevel * NebScaling[0] / NumComps
+    Levels = np.median(Specs[:NumComps], axis=1)
+    Specs[:NumComps] -= (Levels - np.mean(Levels))[:, None]
+    return Specs
+
+
+
+# Extrapolates the fixed-point iteration x --> G(x) performed by one shift-and-add sweep (x = B, (C), NebSpec stacked; A follows from them).
+# x, Gx: state before and after the sweep. History: list kept by the caller between sweeps (start with []).
+# 'Aitken': vector Aitken (Irons-Tuck) extrapolation from every three consecutive iterates.
+# 'Anderson': Anderson mixing over the last Depth sweeps.
+def Accelerate_Step(x, Gx, History, Method='Anderson', Depth=5):
+    if Method=='Aitken':
+        if len(History)==0:
+            History.append(x)
+        History.append(Gx)
+        if len(History) < 3:
+            return Gx
+        x0, x1, x2 = History
+        d1, d2 = x2 - x1, x2 - 2*x1 + x0
+        History.clear()
+        if np.sum(d2**2) == 0:
+            xnew = x2
+        else:
+            xnew = x2 - np.sum(d1*d2) / np.sum(d2**2) * d1
+        History.append(xnew)
+        return xnew
+    elif Method=='Anderson':
+        History.append((x, Gx))
+        del History[:-Depth-1]
+        if len(History) < 2:
+            return Gx
+        Fs = np.array([gx - xx for xx, gx in History]).T
+        Gs = np.array([gx for xx, gx in History]).T
+        gamma = np.linalg.lstsq(np.diff(Fs, axis=1), Fs[:,-1], rcond=None)[0]
+        xnew = Gx - np.diff(Gs, axis=1) @ gamma
+        if not np.all(np.isfinite(xnew)):
+            History.clear()
+            return Gx
+        return xnew
     else:
-        return Sum    
+        sys.exit("Acceleration method " + str(Method) + " not defined -- error in subroutine Accelerate_Step...")
 
 
 
-# Documentation: 
-# "B" = array, initial guess for flux of "secondary"
-# vrads1, vrads2 = RVs of primary, secondary
-# waves: wavelength grid on which disentanglement should take place
-#NOTE: If initial guess for primary is preferred, roles of primary should change, i.e., one should call:
-# disentangle(Aini, vrads2, vrads1, waves)
-# Resid --> returns array of residual spectra between obs and dis1+dis2
-# Reduce --> Returns reduced chi2
-def disentangle(B, vrads1, vrads2, waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  nusdata, Orbital_Params, K1s, K2s, MJDs, phis, specnames,  Rangestr, StarName, ScalingNeb, NebSpec, Resid=False, Reduce=False, ShowItr=False, Once=False,  InterKind='linear', itrnumlim=100, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0, linewidExt=3,  N_Iteration_Plot=50, NebLines = False, NebFac=1, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1, TitleFileName=False, DisLine=None):    
-    global kcount, k1, k2, DoFs, kcount, K1now, K2now
-    StrictNegA, StrictNegB, StrictNegC, StrictNegD = StrictNeg
+# Shift-and-add engine for any number of components: vradsArr = list of RV arrays (one per component, in the observer's frame, i.e. including
+# any motion of an outer orbit), Inis = initial guesses for components 2, 3, ... (continuum subtracted); NebLines --> additional stationary
+# nebular component (NebSpec = initial guess), scaled per epoch by NebFac*ScalingNeb.
+# The components are updated in turn (primary, secondary, ..., nebular); the other components are shifted into the frame of the updated one
+# by one stacked operator per component (Comp_Shift_Operator), i.e. the cost of a component is one array operation.
+# StrictNeg[c], PosLimCond[c] = positivity conditions of component c (PosLimCond[-1] for the nebular component)
+# Engine, EpsTol, Accelerate, LogOversample, LogIntShift, LsqrDamp --> see disentangle
+# Returns the continuum-subtracted spectra (components x pixels, nebular spectrum last) on waves and the number of iterations used
+def Shift_And_Add(Inis, vradsArr, waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, ScalingNeb, NebSpec, ShowItr=False, InterKind='linear', itrnumlim=100, PLOTCONV=False, PLOTITR=False, N_Iteration_Plot=50, NebLines=False, NebFac=1, Engine='classic', EpsTol=0., Accelerate=None, LogOversample=1, LogIntShift=False, LsqrDamp=0.):
+    CompNum = len(vradsArr)
+    StrictNeg = list(StrictNeg[:CompNum])
 # If convergence plot: allow spectra to be positive for sensible convergence plot:
     if PLOTCONV:
-        StrictNegA, StrictNegB, StrictNegC, StrictNegD = False, False, False, False    
-    PosLimCondA, PosLimCondB, PosLimCondC, PosLimCondD, PosLimCondNeb = PosLimCond
-    if (not Once):
-        try:
-            K1now = K1s[k1]
-            K2now = K2s[k2]   
-            print("Disentangeling..... K1, K2=", K1now, K2now)
-        except:
-            pass
-    else:
-        k1, k2 = 0, 0
-    Facshift1 = np.sqrt( (1 + vrads1/clight) / (1 - vrads1/clight))
-    Facshift2 = np.sqrt( (1 + vrads2/clight) / (1 - vrads2/clight))
-    Ss1 = [interp1d(ObsSpecs[i][:, 0] /Facshift1[i], ObsSpecs[i][:, 1]-1.,
-                      bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in np.arange(len(ObsSpecs))] 
-    Ss2 = [interp1d(ObsSpecs[i][:, 0] /Facshift2[i], ObsSpecs[i][:, 1]-1.,
-                      bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in np.arange(len(ObsSpecs))]      
-#Frame of Refernce star 1:    
-    WavesBA = np.array([waves * Facshift2[i] /Facshift1[i] for i in np.arange(len(vrads1))])  
-#Frame of Refernce star 2:        
-    WavesAB = np.array([waves * Facshift1[i] /Facshift2[i] for i in np.arange(len(vrads1))])  
-    if NebLines:
-        FacshiftNeb = np.ones(len(vrads1))
-        SsNeb = [interp1d(ObsSpecs[i][:, 0] / FacshiftNeb[i], ObsSpecs[i][:, 1]-1.,
-                      bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in np.arange(len(ObsSpecs))]             
-        WavesNebA = np.array([waves *FacshiftNeb[i]/Facshift1[i] for i in np.arange(len(vrads1))])  
-        WavesNebB = np.array([waves * FacshiftNeb[i] /Facshift2[i] for i in np.arange(len(vrads1))])         
-        WavesANeb = np.array([waves *Facshift1[i] /FacshiftNeb[i] for i in np.arange(len(vrads1))])  
-        WavesBNeb = np.array([waves * Facshift2[i] /FacshiftNeb[i] for i in np.arange(len(vrads1))])   
+        StrictNeg = [False]*CompNum
+# Engines other than 'classic' interpolate linearly:
+    if Engine in ['sparse', 'batched', 'loglam'] and InterKind!='linear':
+        print("WARNING: Engine='" + Engine + "' requires InterKind='linear', using Engine='classic' instead")
+        Engine = 'classic'
+# Engine='loglam': iterate on a log-wavelength grid; results are interpolated back to the user grid at the end
+    if Engine=='loglam':
+        UserWaves = waves
+        waves = Log_Grid(UserWaves, LogOversample)
+        Inis, NebSpec = [interp1d(UserWaves, Spec, bounds_error=False, fill_value=0.)(waves) for Spec in Inis], interp1d(UserWaves, NebSpec, bounds_error=False, fill_value=0.)(waves)
+# Specs: components followed by the nebular spectrum; Facshifts / Scales: shift factors and per-epoch scaling of each row of Specs
+    Specs = np.array([waves*0.] + [np.copy(Ini) for Ini in Inis] + [np.copy(NebSpec)])
+    Facshifts = [np.sqrt( (1 + vrads/clight) / (1 - vrads/clight)) for vrads in vradsArr] + [np.ones(len(ObsSpecs))]
+    Scales = [np.ones(len(ObsSpecs))]*CompNum + [NebFac*ScalingNeb*np.ones(len(ObsSpecs))]
+    Frames = np.arange(CompNum + 1) if NebLines else np.arange(CompNum)
+    Ss, Ops, Others, WavesOthers = {}, {}, {}, {}
+    if Engine not in ['fourier', 'lsqr']:
+        for c in Frames:
+            Ss[c] = Shift_Obs(ObsSpecs, Facshifts[c], waves, InterKind, Engine)
+# Frame of reference of component c: grids of all other components; fixed during the iterations --> operators built only once
+            Others[c] = [d for d in Frames if d!=c]
+            WavesOthers[c] = [np.array([waves * Facshifts[d][i] /Facshifts[c][i] for i in np.arange(len(ObsSpecs))]) for d in Others[c]]
+            Ops[c] = Comp_Shift_Operator(WavesOthers[c], waves, [Scales[d] if c < CompNum else np.ones(len(ObsSpecs)) for d in Others[c]], Engine, LogIntShift)
     itr = 0
-    while itr<itrnumlim:
-        itr+=1
-        BAshifts = [interp1d(WavesBA[i], B,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]    
-        if NebLines:
-            NebAshifts = [interp1d(WavesNebA[i], NebSpec,bounds_error=False, fill_value=0., kind=InterKind) for i in np.arange(len(ObsSpecs))]    
-            SpecMean = np.sum(np.array([[i]*(Ss1[i] - BAshifts[i](waves) - NebFac*ScalingNeb[i]*NebAshifts[i](waves)) for i in np.arange(len(Ss1))]), axis=0)      
-        else:
-            SpecMean = np.sum(np.array([weights[i]*(Ss1[i] - BAshifts[i](waves) ) for i in np.arange(len(Ss1))]), axis=0)          
-        Anew = interp1d(waves, SpecMean, bounds_error=False, fill_value=0., kind=InterKind)(waves)  
-        if StrictNegA:
-            Anew = Limit(waves, Anew, Poslimall, PosLimCondA)        
-        if 'A' in locals():
-            Epsnew = np.amax((A - Anew)**2)        
-        else:
-            Epsnew = 0.
-        A = np.copy(Anew)   
-        ABshifts = [interp1d(WavesAB[i], A,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-        if NebLines:
-            NebBshifts = [interp1d(WavesNebB[i], NebSpec,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-            SpecMean = np.sum(np.array([weights[i]*(Ss2[i] - ABshifts[i](waves) - NebFac*ScalingNeb[i]*NebBshifts[i](waves)) for i in np.arange(len(Ss1))]), axis=0)
-        else:
-            SpecMean = np.sum(np.array([weights[i]*(Ss2[i] - ABshifts[i](waves)) for i in np.arange(len(Ss1))]), axis=0)                    
-        Bnew = interp1d(waves, SpecMean, bounds_error=False, fill_value=0., kind=InterKind)(waves) 
-        if StrictNegB:
-            Bnew = Limit(waves, Bnew, Poslimall, PosLimCondB)            
-        Epsnew = max(Epsnew, np.sum((B - Bnew)**2))
-        B = Bnew 
+    AccHistory = []
+# Engine='fourier' / 'lsqr': direct solution instead of the iterations; positivity conditions applied afterwards
+    if Engine=='fourier':
+        Sol = Fourier_Disentangle(ObsSpecs, Facshifts[:CompNum], waves, weights, NebScaling=Scales[-1] if NebLines else None, Oversample=LogOversample)
+        itr = 1
+    elif Engine=='lsqr':
+        Sol, itr = Lsqr_Disentangle(ObsSpecs, Facshifts[:CompNum], waves, weights, NebScaling=Scales[-1] if NebLines else None, Damp=LsqrDamp, IterLim=itrnumlim, x0=np.concatenate(Specs[:len(Frames)]))
+    if Engine in ['fourier', 'lsqr']:
+        Specs[Frames] = Sol
+        for c in np.arange(CompNum):
+            if StrictNeg[c]:
+                Specs[c] = Limit(waves, Specs[c], Poslimall, PosLimCond[c])
         if NebLines:
-            ANebshifts = [interp1d(WavesANeb[i], A,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-            BNebshifts = [interp1d(WavesBNeb[i], B,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]                 
-            SpecMean = np.sum(np.array([weights[i]*Limit(waves, SsNeb[i] - ANebshifts[i](waves) - BNebshifts[i](waves), Poslimall, PosLimCondNeb) for i in np.arange(len(Ss1))]), axis=0)   
-            NebSpecnew = interp1d(waves, SpecMean, bounds_error=False, fill_value=0., kind=InterKind)(waves)
-            NebSpecnew[NebSpecnew<Poslimall[0]] = 0.
-            Epsnew = max(Epsnew, np.sum(np.abs(NebSpec - NebSpecnew))) 
-            NebSpec = NebSpecnew           
+            Specs[-1][Specs[-1]<np.atleast_1d(Poslimall)[0]] = 0.
+    while itr<itrnumlim and Engine not in ['fourier', 'lsqr']:
+        itr+=1
+        StateOld = np.concatenate(Specs[1:])
+        for c in Frames:
+            Residuals = Ss[c] - Shift_Comps(Specs, Others[c], WavesOthers[c], waves, [Scales[d] if c < CompNum else np.ones(len(ObsSpecs)) for d in Others[c]], InterKind, Ops[c])
+            if c < CompNum:
+                SpecMean = weights @ Residuals
+            else:
+                SpecMean = weights @ Limit(waves, Residuals, Poslimall, PosLimCond[-1])
+            Specnew = interp1d(waves, SpecMean, bounds_error=False, fill_value=0., kind=InterKind)(waves)
+            if c < CompNum and StrictNeg[c]:
+                Specnew = Limit(waves, Specnew, Poslimall, PosLimCond[c])
+            elif c==CompNum:
+                Specnew[Specnew<np.atleast_1d(Poslimall)[0]] = 0.
+# Convergence: maximum change of the primary per pixel, summed squared changes of the other components, summed absolute change of the nebular spectrum
+            if c==0:
+                Epsnew = np.amax((Specs[c] - Specnew)**2) if itr > 1 else 0.
+            elif c < CompNum:
+                Epsnew = max(Epsnew, np.sum((Specs[c] - Specnew)**2))
+            else:
+                Epsnew = max(Epsnew, np.sum(np.abs(Specs[c] - Specnew)))
+            Specs[c] = Specnew
         if ShowItr:
             if (itr/itrnumlim*100)%10==0:
                 print("Finished " + str(itr) + " out of " + str(itrnumlim) + " iterations (" +str(np.round(itr/itrnumlim*100.,3)) + "%)")
-                #print("Convergence Epsilon:", Epsnew)
         if PLOTCONV:
             plt.scatter(itr, np.log10(Epsnew), color='blue')
         if PLOTITR:
             if itr%N_Iteration_Plot==0:
-                plt.plot(waves, A, label=itr)
-                plt.plot(waves, B, label=itr)
-                if NebLines:
-                    plt.plot(waves, NebSpec, label=itr)
+                for c in Frames:
+                    plt.plot(waves, Specs[c], label=itr)
+        if EpsTol > 0 and itr > 1 and Epsnew < EpsTol:
+            break
+        if Accelerate:
+            Specs[1:] = np.split(Accelerate_Step(StateOld, np.concatenate(Specs[1:]), AccHistory, Method=Accelerate), CompNum)
     print("Finished after ", itr, " iterations")
     if PLOTCONV or PLOTITR:
         if PLOTITR:
@@ -610,8 +1064,109 @@ def disentangle(B, vrads1, vrads2, waves, ObsSpecs, weights, StrictNeg, PosLimCo
             plt.ylabel('log(Eps)')
             plt.xlabel('iteration number')
         plt.show()  
-    DisSpecVector = np.array([A, B , NebSpec])
-    return DisSpecVector+1.,  CalcDiffs(DisSpecVector, vrads1,  vrads2,  waves, ObsSpecs, nusdata, Orbital_Params, K1s, K2s, MJDs, phis, specnames, Rangestr, StarName, ScalingNeb, Resid=Resid, Reduce=Reduce, ShowItr=ShowItr,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot,  linewidExt=linewidExt, NebLines = NebLines, NebFac=NebFac, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)    
+    if Engine=='loglam':
+        Specs = np.array([interp1d(waves, Spec, bounds_error=False, fill_value=0.)(UserWaves) for Spec in Specs])
+    return Specs, itr
+
+
+
+# Lerp_Table for a block of grid points: WavesShift has shape (grid points x epochs x pixels), the indices refer to the flattened 
+# (grid points x pixels) array of the spectra of all grid points (use with Batch_Lerp); Scale = optional per-epoch factor included in the weights
+def Block_Lerp_Table(WavesShift, waves, Scale=None):
+    NK, NE, NP = WavesShift.shape
+    inds, w0, w1 = [Arr.reshape(NK, NE, len(waves)) for Arr in Lerp_Table(WavesShift.reshape(NK*NE, NP), waves)]
+    inds = inds + (np.arange(NK) * NP)[:, None, None]
+    if Scale is not None:
+        w0, w1 = w0*Scale[:, None], w1*Scale[:, None]
+    return inds, w0, w1
+
+
+# Shift-and-add iterations of a binary (see Shift_And_Add) for a block of K grid points at once: vrads1Block, vrads2Block = RVs of primary
+# and secondary (grid points x epochs), Inis = initial guesses of the secondary (grid points x pixels). The grid points are iterated together
+# along a leading array axis with gather-and-lerp tables (linear interpolation). Observations are shifted to the frame of a component and co-added
+# only once if its RVs are the same for the whole block (e.g. the primary along the K2 axis). With EpsTol > 0, converged grid points are frozen.
+# Returns the continuum-subtracted spectra (grid points x [A, B, NebSpec] x pixels) and the number of iterations used per grid point
+def Shift_And_Add_Block(Inis, vrads1Block, vrads2Block, waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, ScalingNeb, NebSpec, itrnumlim=100, NebLines=False, NebFac=1, EpsTol=0.):
+    NK = len(Inis)
+    Facshift1, Facshift2 = [np.sqrt( (1 + vrads/clight) / (1 - vrads/clight)) for vrads in [vrads1Block, vrads2Block]]
+    FacshiftNeb = np.ones(Facshift1.shape)
+    Ss = []
+    for Facshift in [Facshift1, Facshift2, FacshiftNeb][:3 if NebLines else 2]:
+        if np.all(Facshift == Facshift[0]):
+            Ss.append(Shift_Obs(ObsSpecs, Facshift[0], waves, Engine='batched')[None])
+        else:
+            Ss.append(np.array([Shift_Obs(ObsSpecs, Fk, waves, Engine='batched') for Fk in Facshift]))
+    SsMean1, SsMean2 = weights @ Ss[0], weights @ Ss[1]
+    TabBA = Block_Lerp_Table(waves[None, None, :] * (Facshift2/Facshift1)[:, :, None], waves)
+    TabAB = Block_Lerp_Table(waves[None, None, :] * (Facshift1/Facshift2)[:, :, None], waves)
+    if NebLines:
+        TabNebA = Block_Lerp_Table(waves[None, None, :] * (FacshiftNeb/Facshift1)[:, :, None], waves, NebFac*ScalingNeb)
+        TabNebB = Block_Lerp_Table(waves[None, None, :] * (FacshiftNeb/Facshift2)[:, :, None], waves, NebFac*ScalingNeb)
+        TabANeb = Block_Lerp_Table(waves[None, None, :] * (Facshift1/FacshiftNeb)[:, :, None], waves)
+        TabBNeb = Block_Lerp_Table(waves[None, None, :] * (Facshift2/FacshiftNeb)[:, :, None], waves)
+    A, B, Neb = np.zeros((NK, len(waves))), np.array(Inis, dtype=float), np.tile(NebSpec, (NK, 1))
+    Itrs = np.zeros(NK, dtype=int)
+    Active = np.ones(NK, dtype=bool)
+    itr = 0
+    while itr<itrnumlim and np.any(Active):
+        itr+=1
+        Itrs[Active] = itr
+        Anew = SsMean1 - weights @ Batch_Lerp(B.ravel(), TabBA)
+        if NebLines:
+            Anew -= weights @ Batch_Lerp(Neb.ravel(), TabNebA)
+        if StrictNeg[0]:
+            Anew = Limit(waves, Anew, Poslimall, PosLimCond[0])
+        Eps = np.amax((A - Anew)**2, axis=1) if itr > 1 else np.zeros(NK)
+        A[Active] = Anew[Active]
+        Bnew = SsMean2 - weights @ Batch_Lerp(A.ravel(), TabAB)
+        if NebLines:
+            Bnew -= weights @ Batch_Lerp(Neb.ravel(), TabNebB)
+        if StrictNeg[1]:
+            Bnew = Limit(waves, Bnew, Poslimall, PosLimCond[1])
+        Eps = np.maximum(Eps, np.sum((B - Bnew)**2, axis=1))
+        B[Active] = Bnew[Active]
+        if NebLines:
+            Nebnew = weights @ Limit(waves, Ss[2] - Batch_Lerp(A.ravel(), TabANeb) - Batch_Lerp(B.ravel(), TabBNeb), Poslimall, PosLimCond[-1])
+            Nebnew[Nebnew<np.atleast_1d(Poslimall)[0]] = 0.
+            Eps = np.maximum(Eps, np.sum(np.abs(Neb - Nebnew), axis=1))
+            Neb[Active] = Nebnew[Active]
+        if EpsTol > 0 and itr > 1:
+            Active *= Eps >= EpsTol
+    return np.stack([A, B, Neb], axis=1), Itrs
+
+
+
+# Documentation: 
+# "B" = array, initial guess for flux of "secondary"
+# vrads1, vrads2 = RVs of primary, secondary
+# waves: wavelength grid on which disentanglement should take place
+#NOTE: If initial guess for primary is preferred, roles of primary should change, i.e., one should call:
+# disentangle(Aini, vrads2, vrads1, waves)
+# Resid --> returns array of residual spectra between obs and dis1+dis2
+# Reduce --> Returns reduced chi2
+# Engine --> 'classic': interp1d per epoch and iteration; 'sparse': precomputed sparse shift operators;
+#            'batched': (epochs x pixels) arrays with precomputed gather-and-lerp tables;
+#            'loglam': as 'batched', but iterating on a log-wavelength grid (Log_Grid, LogOversample) on which shifts are constant pixel offsets
+#            (two-tap stencils, or pure index shifts if LogIntShift); output on waves ('sparse', 'batched', 'loglam' only for InterKind='linear');
+#            'fourier': no iterations, direct least-squares solution in Fourier space (Fourier_Disentangle, log grid with LogOversample); 
+#            StrictNeg / PosLimCond applied to the solution; InterKind, itrnumlim, EpsTol and Accelerate are not used;
+#            'lsqr': no shift-and-add iterations, direct sparse least-squares solution (Lsqr_Disentangle) with at most itrnumlim LSQR iterations
+#            and Tikhonov damping LsqrDamp; StrictNeg / PosLimCond applied to the solution; InterKind, EpsTol and Accelerate are not used
+# EpsTol --> stop iterating once Eps < EpsTol (0: always perform itrnumlim iterations)
+# Accelerate --> None, 'Aitken' or 'Anderson': extrapolation of the iterates, see Accelerate_Step
+# kcount --> index of the K grid point (None outside of a grid); selects the plots of PLOTEXTREMES / PLOTFITS
+# ReturnItr --> additionally return the number of iterations used
+# PerEpoch --> chi2 is returned as array of the (non-reduced) contributions of the individual epochs
+# VradRange --> (min, max) RV defining the pixels of the chi2 (see Reduce_Waves); None: extreme RVs of Orbital_Params with K1s[-1], K2s[-1]
+# The spectra are computed by the general engine Shift_And_Add, chi2 by CalcDiffs
+def disentangle(B, vrads1, vrads2, waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  nusdata, Orbital_Params, K1s, K2s, MJDs, phis, specnames,  Rangestr, StarName, ScalingNeb, NebSpec, Resid=False, Reduce=False, ShowItr=False, Once=False,  InterKind='linear', itrnumlim=100, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0, linewidExt=3,  N_Iteration_Plot=50, NebLines = False, NebFac=1, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1, TitleFileName=False, DisLine=None, Engine='classic', EpsTol=0., Accelerate=None, kcount=None, ReturnItr=False, LogOversample=1, LogIntShift=False, LsqrDamp=0., PerEpoch=False, VradRange=None):    
+    if (not Once):
+        print("Disentangeling..... K1, K2=", Orbital_Params['K1'], Orbital_Params['K2'])
+    DisSpecVector, itr = Shift_And_Add([B], [vrads1, vrads2], waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, ScalingNeb, NebSpec, ShowItr=ShowItr, InterKind=InterKind, itrnumlim=itrnumlim, PLOTCONV=PLOTCONV, PLOTITR=PLOTITR, N_Iteration_Plot=N_Iteration_Plot, NebLines=NebLines, NebFac=NebFac, Engine=Engine, EpsTol=EpsTol, Accelerate=Accelerate, LogOversample=LogOversample, LogIntShift=LogIntShift, LsqrDamp=LsqrDamp)
+    chi2 = CalcDiffs(DisSpecVector, vrads1,  vrads2,  waves, ObsSpecs, nusdata, Orbital_Params, K1s, K2s, MJDs, phis, specnames, Rangestr, StarName, ScalingNeb, Resid=Resid, Reduce=Reduce, ShowItr=ShowItr,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot,  linewidExt=linewidExt, NebLines = NebLines, NebFac=NebFac, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine, kcount=kcount, PerEpoch=PerEpoch, VradRange=VradRange)    
+    if ReturnItr:
+        return DisSpecVector+1., chi2, itr
+    return DisSpecVector+1., chi2
 
 
 
@@ -622,168 +1177,580 @@ def disentangle(B, vrads1, vrads2, waves, ObsSpecs, weights, StrictNeg, PosLimCo
 # waves: wavelength grid on which disentanglement should take place
 # Resid --> returns array of residual spectra between obs and dis1+dis2
 # Reduce --> Returns reduced chi2
-def disentangle3Comp(B, vrads1, vrads2, vradsOut, vradsBin, waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  nusdata, nusdataOut, Orbital_Params, K1s, K2s, KOuts, MJDs, phis, phisOut, specnames,  Rangestr, StarName, ScalingNeb, NebSpec, Resid=False, Reduce=False, ShowItr=False, Once=False,  InterKind='linear', itrnumlim=100, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0, linewidExt=3,  N_Iteration_Plot=50, NebLines = False, NebFac=1, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1, TitleFileName=False, DisLine=None):    
-    global kcount, k1, k2, kOut, DoFs, kcount, K1now, K2now, K3now
-    C = waves*0.
-    StrictNegA, StrictNegB, StrictNegC, StrictNegD = StrictNeg
-# If convergence plot: allow spectra to be positive for sensible convergence plot:
-    if PLOTCONV:
-        StrictNegA, StrictNegB, StrictNegC, StrictNegD = False, False, False, False    
-    PosLimCondA, PosLimCondB, PosLimCondC, PosLimCondD, PosLimCondNeb = PosLimCond
+# Engine, EpsTol, Accelerate, kcount, ReturnItr, LogOversample, LogIntShift, LsqrDamp, PerEpoch, VradRange --> see disentangle
+# Cini --> initial guess for tertiary (default: flat)
+# The spectra are computed by the general engine Shift_And_Add, chi2 by CalcDiffs3D
+def disentangle3Comp(B, vrads1, vrads2, vradsOut, vradsBin, waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  nusdata, nusdataOut, Orbital_Params, K1s, K2s, KOuts, MJDs, phis, phisOut, specnames,  Rangestr, StarName, ScalingNeb, NebSpec, Resid=False, Reduce=False, ShowItr=False, Once=False,  InterKind='linear', itrnumlim=100, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0, linewidExt=3,  N_Iteration_Plot=50, NebLines = False, NebFac=1, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1, TitleFileName=False, DisLine=None, Engine='classic', EpsTol=0., Accelerate=None, Cini=None, kcount=None, ReturnItr=False, LogOversample=1, LogIntShift=False, LsqrDamp=0., PerEpoch=False, VradRange=None):    
+    if Cini is None:
+        Cini = waves*0.
     if (not Once):
+        print("Disentangeling..... K1, K2, K3=", Orbital_Params['K1'], Orbital_Params['K2'], Orbital_Params['KOut'])
+    DisSpecVector, itr = Shift_And_Add([B, Cini], [vrads1+vradsBin, vrads2+vradsBin, vradsOut], waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, ScalingNeb, NebSpec, ShowItr=ShowItr, InterKind=InterKind, itrnumlim=itrnumlim, PLOTCONV=PLOTCONV, PLOTITR=PLOTITR, N_Iteration_Plot=N_Iteration_Plot, NebLines=NebLines, NebFac=NebFac, Engine=Engine, EpsTol=EpsTol, Accelerate=Accelerate, LogOversample=LogOversample, LogIntShift=LogIntShift, LsqrDamp=LsqrDamp)
+    chi2 = CalcDiffs3D(DisSpecVector, vrads1,  vrads2,  vradsOut, vradsBin, waves, ObsSpecs, nusdata, nusdataOut, Orbital_Params, K1s, K2s, KOuts, MJDs, phis, phisOut, specnames, Rangestr, StarName, ScalingNeb, Resid=Resid, Reduce=Reduce, ShowItr=ShowItr,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot,  linewidExt=linewidExt, NebLines = NebLines, NebFac=NebFac, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine, kcount=kcount, PerEpoch=PerEpoch, VradRange=VradRange)    
+    if ReturnItr:
+        return DisSpecVector+1., chi2, itr
+    return DisSpecVector+1., chi2
+
+
+
+# Documentation: 
+# Disentangling of any number of components (e.g. quadruples), see disentangle
+# Inis = list of initial guesses for components 2, 3, ... (e.g. [B, C, D])
+# vradsArr = list of RV arrays of all components in the observer's frame (see Comp_Vrads)
+# PhisArr = list of phase arrays, shown in the plots (e.g. [phis, phisOut])
+def disentangleNComp(Inis, vradsArr, waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  nusdata, Orbital_Params, K1s, K2s, MJDs, PhisArr, specnames,  Rangestr, StarName, ScalingNeb, NebSpec, Resid=False, Reduce=False, ShowItr=False, Once=False,  InterKind='linear', itrnumlim=100, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0, linewidExt=3,  N_Iteration_Plot=50, NebLines = False, NebFac=1, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1, TitleFileName=False, DisLine=None, Engine='classic', EpsTol=0., Accelerate=None, kcount=None, ReturnItr=False, LogOversample=1, LogIntShift=False, LsqrDamp=0., PerEpoch=False, VradRange=None):    
+    if (not Once):
+        print("Disentangeling..... K=", [Orbital_Params[KName] for KName in ['K1', 'K2', 'KOut', 'K3', 'K4'][:len(vradsArr) + (len(vradsArr) > 3)]])
+    DisSpecVector, itr = Shift_And_Add(Inis, vradsArr, waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, ScalingNeb, NebSpec, ShowItr=ShowItr, InterKind=InterKind, itrnumlim=itrnumlim, PLOTCONV=PLOTCONV, PLOTITR=PLOTITR, N_Iteration_Plot=N_Iteration_Plot, NebLines=NebLines, NebFac=NebFac, Engine=Engine, EpsTol=EpsTol, Accelerate=Accelerate, LogOversample=LogOversample, LogIntShift=LogIntShift, LsqrDamp=LsqrDamp)
+    chi2 = CalcDiffsNComp(DisSpecVector, vradsArr, waves, ObsSpecs, nusdata, Orbital_Params, K1s, K2s, MJDs, PhisArr, specnames, Rangestr, StarName, ScalingNeb, Resid=Resid, Reduce=Reduce, ShowItr=ShowItr,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot,  linewidExt=linewidExt, NebLines = NebLines, NebFac=NebFac, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine, kcount=kcount, PerEpoch=PerEpoch, VradRange=VradRange)    
+    if ReturnItr:
+        return DisSpecVector+1., chi2, itr
+    return DisSpecVector+1., chi2
+
+    
+# Order in which a grid of given shape is walked such that consecutive grid points are neighbours (boustrophedon / serpentine).
+# Returns list of index tuples.
+def Serpentine_Order(shape):
+    if len(shape)==1:
+        return [(k,) for k in np.arange(shape[0])]
+    SubOrder = Serpentine_Order(shape[1:])
+    Order = []
+    for k in np.arange(shape[0]):
+        Order += [(k,) + inds for inds in (SubOrder if k%2==0 else SubOrder[::-1])]
+    return Order
+
+
+# Degrees of freedom of the K grid: number of pixels entering the chi2 (see CalcDiffs, Reduce_Waves) * (number of epochs - number of components)
+# Independent of the grid point, so it is computed once before the grid is evaluated
+def Grid_DoFs(waves, nusdata, Orbital_Params, K1s, K2s, NumEpochs, CompNum, VradRange=None):
+    WaveCalcCond = Reduce_Waves(waves, nusdata, Orbital_Params, K1s[-1], K2s[-1], VradRange)
+    return len(waves[WaveCalcCond]) * (NumEpochs - CompNum)
+
+
+# Disentangles the K grid point with index tuple inds on the wavelength grid waves
+# GridData = dict with the grid axes ('Ks' = [K1s, K2s] or [K1s, K2s, KOuts]), 'Ini', 'Bini', 'Orbital_Params' and the remaining arguments of disentangle / disentangle3Comp ('DisArgs')
+# Grids over other orbital parameters: 'Keys' = names of the parameters of the axes 'Ks', 'CompNum' = 2 or 3; the anomalies are computed per point (Orbit_DisArgs)
+# Seed = disentangled spectra (DisSpecVector - 1) used as initial guess instead of Bini (warm start)
+# Returns chi2, iterations used and DisSpecVector; chi2 = DisSpecVector = None if the RVs could not be computed for that point
+def Grid_Point(inds, waves, GridData, Seed=None):
+    Ks, Ini, Bini, DisArgs = GridData['Ks'], GridData['Ini'], GridData['Bini'], GridData['DisArgs']
+    CompNum = GridData.get('CompNum', len(Ks))
+    kcount = int(np.ravel_multi_index(inds, [len(K) for K in Ks]))
+    Orbital_Params_Updated = GridData['Orbital_Params'].copy()
+    for KName, KArr, k in zip(GridData.get('Keys', ['K1', 'K2', 'KOut']), Ks, inds):
+        Orbital_Params_Updated[KName] = KArr[k]
+    try:
+        if 'Keys' in GridData:
+            DisArgs = Orbit_DisArgs(DisArgs, Orbital_Params_Updated, CompNum)
+        vrads1, vrads2 = v1andv2(DisArgs['nusdata'], Orbital_Params_Updated)  
+        if CompNum==3:
+            vradsOut, vradsBin = v1andv2(DisArgs['nusdataOut'], Orbital_Params_Updated, Config='Tertiary')  
+    except:
+        return None, 0, None
+    if Ini=='A' or Ini=='B':
+        print("Initial guess provided for component " + Ini)        
+        BiniNow = Bini(waves)
+    else:
+        print("No initial approximation given, assuming flat spectrum for secondary...")
+        BiniNow = np.ones(len(waves))
+    CiniNow, NebSpec = None, waves * 0.
+    if Seed is not None:
+        BiniNow, NebSpec = Seed[1], Seed[-1]
+        if CompNum==3:
+            CiniNow = Seed[2]
+# Initial guess for primary: roles of primary and secondary are swapped
+    if Ini!='B':
+        vrads1, vrads2 = vrads2, vrads1
+    if CompNum==2:
+        DisSpecVector, chi2, itr = disentangle(BiniNow, vrads1, vrads2,  waves, Orbital_Params=Orbital_Params_Updated, NebSpec=NebSpec, kcount=kcount, ReturnItr=True, **DisArgs)
+    else:
+        DisSpecVector, chi2, itr = disentangle3Comp(BiniNow, vrads1, vrads2, vradsOut, vradsBin,  waves, Orbital_Params=Orbital_Params_Updated, NebSpec=NebSpec, Cini=CiniNow, kcount=kcount, ReturnItr=True, **DisArgs)
+    return chi2, itr, DisSpecVector
+
+
+# Disentangles the grid points Block (list of index tuples of a 2D grid with the same K1 index) together with Shift_And_Add_Block;
+# initial guesses and chi2 as in Grid_Point. Returns list of (chi2, iterations used, DisSpecVector) of the grid points
+def Grid_Block(Block, waves, GridData, Seed=None):
+    Ks, Ini, Bini, DisArgs = GridData['Ks'], GridData['Ini'], GridData['Bini'], GridData['DisArgs']
+    Results = {}
+    Points = []
+    for inds in Block:
+        Orbital_Params_Updated = GridData['Orbital_Params'].copy()
+        for KName, KArr, k in zip(['K1', 'K2'], Ks, inds):
+            Orbital_Params_Updated[KName] = KArr[k]
         try:
-            K1now = K1s[k1]
-            K2now = K2s[k2]   
-            K3now = KOuts[kOut]   
-            print("Disentangeling..... K1, K2, K3=", K1now, K2now, K3now)
+            vrads1, vrads2 = v1andv2(DisArgs['nusdata'], Orbital_Params_Updated)  
         except:
-            pass
+            Results[inds] = (None, 0, None)
+            continue
+# Initial guess for primary: roles of primary and secondary are swapped
+        if Ini!='B':
+            vrads1, vrads2 = vrads2, vrads1
+        Points.append((inds, int(np.ravel_multi_index(inds, [len(K) for K in Ks])), Orbital_Params_Updated, vrads1, vrads2))
+    if Ini=='A' or Ini=='B':
+        BiniNow = Bini(waves)
     else:
-        k1, k2, kOut = 0, 0, 0
-    Facshift1 = np.sqrt( (1 + (vrads1+vradsBin)/clight) / (1 - (vrads1+vradsBin)/clight))
-    Facshift2 = np.sqrt( (1 + (vrads2+vradsBin)/clight) / (1 - (vrads2+vradsBin)/clight))
-    FacshiftOut = np.sqrt( (1 + vradsOut/clight) / (1 - vradsOut/clight))
-    Ss1 = [interp1d(ObsSpecs[i][:, 0] /Facshift1[i], ObsSpecs[i][:, 1]-1.,
-                      bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in np.arange(len(ObsSpecs))] 
-    Ss2 = [interp1d(ObsSpecs[i][:, 0] /Facshift2[i], ObsSpecs[i][:, 1]-1.,
-                      bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in np.arange(len(ObsSpecs))]      
-    SsOut = [interp1d(ObsSpecs[i][:, 0] /FacshiftOut[i], ObsSpecs[i][:, 1]-1.,
-                      bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in np.arange(len(ObsSpecs))]      
-#Frame of Refernce star 1:    
-    WavesBA = np.array([waves * Facshift2[i] /Facshift1[i] for i in np.arange(len(vrads1))])  
-    WavesCA = np.array([waves * FacshiftOut[i] /Facshift1[i] for i in np.arange(len(vrads1))])  
-#Frame of Refernce star 2:        
-    WavesAB = np.array([waves * Facshift1[i] /Facshift2[i] for i in np.arange(len(vrads1))])  
-    WavesCB = np.array([waves * FacshiftOut[i] /Facshift2[i] for i in np.arange(len(vrads1))])  
-#Frame of Refernce star 3:        
-    WavesAC = np.array([waves * Facshift1[i] /FacshiftOut[i] for i in np.arange(len(vrads1))])  
-    WavesBC = np.array([waves * Facshift2[i] /FacshiftOut[i] for i in np.arange(len(vrads1))])  
-    if NebLines:
-        FacshiftNeb = np.ones(len(vrads1))
-        SsNeb = [interp1d(ObsSpecs[i][:, 0] / FacshiftNeb[i], ObsSpecs[i][:, 1]-1.,
-                      bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in np.arange(len(ObsSpecs))]             
-        WavesNebA = np.array([waves *FacshiftNeb[i]/Facshift1[i] for i in np.arange(len(vrads1))])  
-        WavesNebB = np.array([waves * FacshiftNeb[i] /Facshift2[i] for i in np.arange(len(vrads1))])         
-        WavesNebC = np.array([waves * FacshiftNeb[i] /FacshiftOut[i] for i in np.arange(len(vrads1))])         
-        WavesANeb = np.array([waves *Facshift1[i] /FacshiftNeb[i] for i in np.arange(len(vrads1))])  
-        WavesBNeb = np.array([waves * Facshift2[i] /FacshiftNeb[i] for i in np.arange(len(vrads1))])   
-        WavesCNeb = np.array([waves * FacshiftOut[i] /FacshiftNeb[i] for i in np.arange(len(vrads1))])   
-    itr = 0
-    while itr<itrnumlim:
-        itr+=1
-        BAshifts = [interp1d(WavesBA[i], B,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]    
-        CAshifts = [interp1d(WavesCA[i], C,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]    
-        if NebLines:
-            NebAshifts = [interp1d(WavesNebA[i], NebSpec,bounds_error=False, fill_value=0., kind=InterKind) for i in np.arange(len(ObsSpecs))]    
-            SpecMean = np.sum(np.array([[i]*(Ss1[i] - BAshifts[i](waves) - CAshifts[i](waves) - NebFac*ScalingNeb[i]*NebAshifts[i](waves)) for i in np.arange(len(Ss1))]), axis=0)      
+        BiniNow = np.ones(len(waves))
+    NebSpec = waves * 0.
+    if Seed is not None:
+        BiniNow, NebSpec = Seed[1], Seed[-1]
+    if len(Points) > 0:
+        print("Disentangeling..... K1, K2=", [[Point[2]['K1'], Point[2]['K2']] for Point in Points])
+        Specs, Itrs = Shift_And_Add_Block(np.tile(BiniNow, (len(Points), 1)), np.array([Point[3] for Point in Points]), np.array([Point[4] for Point in Points]), waves, DisArgs['ObsSpecs'], DisArgs['weights'], DisArgs['StrictNeg'], DisArgs['PosLimCond'], DisArgs['Poslimall'], DisArgs['ScalingNeb'], NebSpec, itrnumlim=DisArgs['itrnumlim'], NebLines=DisArgs['NebLines'], NebFac=DisArgs['NebFac'], EpsTol=DisArgs['EpsTol'])
+        PlotArgs = {key: DisArgs[key] for key in ['PLOTEXTREMES', 'PLOTFITS', 'kcount_extremeplot', 'linewidExt', 'NebLines', 'NebFac', 'kcount_usr', 'ExtremesFigSize', 'ResizeExtremesFac_max', 'ResizeExtremesFac_min', 'TitleFileName', 'DisLine']}
+        for (inds, kcount, Orbital_Params_Updated, vrads1, vrads2), DisSpecVector, itr in zip(Points, Specs, Itrs):
+            chi2 = CalcDiffs(DisSpecVector, vrads1, vrads2, waves, DisArgs['ObsSpecs'], DisArgs['nusdata'], Orbital_Params_Updated, DisArgs['K1s'], DisArgs['K2s'], DisArgs['MJDs'], DisArgs['phis'], DisArgs['specnames'], DisArgs['Rangestr'], DisArgs['StarName'], DisArgs['ScalingNeb'], kcount=kcount, PerEpoch=DisArgs.get('PerEpoch', False), VradRange=DisArgs.get('VradRange'), **PlotArgs)
+            Results[inds] = (chi2, itr, DisSpecVector + 1.)
+    return [Results[inds] for inds in Block]
+
+
+# Splits GridPoints (walked in the given order) into blocks for Grid_Block: runs of up to GridData['KBlock'] consecutive points of a 2D grid 
+# with the same K1 index. Blocks of single points (KBlock < 2, other grids or settings not supported by Shift_And_Add_Block) go to Grid_Point.
+def Grid_Blocks(GridPoints, GridData):
+    DisArgs = GridData['DisArgs']
+    KBlock = GridData.get('KBlock', 0)
+    if KBlock < 2 or len(GridData['Ks'])!=2 or 'Keys' in GridData or DisArgs['Engine'] not in ['classic', 'sparse', 'batched'] or DisArgs['InterKind']!='linear' or DisArgs['Accelerate'] or DisArgs['PLOTCONV'] or DisArgs['PLOTITR']:
+        return [[inds] for inds in GridPoints]
+    Blocks = []
+    for inds in GridPoints:
+        if len(Blocks) > 0 and len(Blocks[-1]) < KBlock and Blocks[-1][-1][0]==inds[0]:
+            Blocks[-1].append(inds)
         else:
-            SpecMean = np.sum(np.array([weights[i]*(Ss1[i] - BAshifts[i](waves) - CAshifts[i](waves) ) for i in np.arange(len(Ss1))]), axis=0)          
-        Anew = interp1d(waves, SpecMean, bounds_error=False, fill_value=0., kind=InterKind)(waves)  
-        if StrictNegA:
-            Anew = Limit(waves, Anew, Poslimall, PosLimCondA)        
-        if 'A' in locals():
-            Epsnew = np.amax((A - Anew)**2)        
+            Blocks.append([inds])
+    return Blocks
+
+
+# Disentangles the K grid points GridPoints (list of index tuples, walked in the given order) on the wavelength grid waves, see Grid_Point
+# (GridData['KBlock'] > 1: blocks of K2 values are disentangled together, see Grid_Blocks)
+# WarmStart = start each grid point from the converged spectra of the previous one
+# OnResult = function called with (index tuple, chi2, iterations used) as soon as a point is done (e.g. for checkpointing)
+# Returns list of (index tuple, chi2, iterations used); chi2 = None if the RVs could not be computed for that point
+def Grid_Chunk(GridPoints, waves, GridData, WarmStart=False, OnResult=None):
+    Results = []
+    Seed = None
+    for Block in Grid_Blocks(GridPoints, GridData):
+        if len(Block)==1:
+            BlockResults = [Grid_Point(Block[0], waves, GridData, Seed=Seed)]
         else:
-            Epsnew = 0.
-        A = np.copy(Anew)
-        ABshifts = [interp1d(WavesAB[i], A,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-        CBshifts = [interp1d(WavesCB[i], C,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-        if NebLines:
-            NebBshifts = [interp1d(WavesNebB[i], NebSpec,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-            SpecMean = np.sum(np.array([weights[i]*(Ss2[i] - ABshifts[i](waves) - CBshifts[i](waves) -  NebFac*ScalingNeb[i]*NebBshifts[i](waves)) for i in np.arange(len(Ss1))]), axis=0)
+            BlockResults = Grid_Block(Block, waves, GridData, Seed=Seed)
+        for inds, (chi2, itr, DisSpecVector) in zip(Block, BlockResults):
+            Results.append((inds, chi2, itr))
+            if OnResult is not None:
+                OnResult(inds, chi2, itr)
+# Warm start: initial guess = converged spectra of previous (neighbouring) grid point (of the last point of the previous block)
+            if WarmStart and DisSpecVector is not None:
+                Seed = DisSpecVector - 1.
+    return Results
+
+
+# Grid data of a worker process, set once per worker by Init_Grid_Worker (i.e. spectra are not sent with every task)
+GridWorkerData = None
+
+def Init_Grid_Worker(GridData):
+    global GridWorkerData
+    GridWorkerData = GridData
+
+
+def Grid_Chunk_Worker(Task):
+    GridPoints, waves, WarmStart = Task
+    return Grid_Chunk(GridPoints, waves, GridWorkerData, WarmStart)
+
+
+# Updates hash object h with obj (arrays, lists / tuples / dicts thereof, numbers, strings)
+def Hash_Update(h, obj):
+    if isinstance(obj, dict):
+        for key in sorted(obj):
+            h.update(str(key).encode())
+            Hash_Update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(str(len(obj)).encode())
+        for el in obj:
+            Hash_Update(h, el)
+    elif isinstance(obj, np.ndarray):
+        h.update(str(obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    else:
+        h.update(repr(obj).encode())
+
+
+# Hash of all inputs that determine the chi2 of the grid points (spectra, weights, wavelength ranges, orbit, initial guess, disentangling settings)
+def Grid_Input_Hash(waveRanges, GridData):
+    PlotKeys = ['PLOTCONV', 'PLOTITR', 'PLOTEXTREMES', 'PLOTFITS', 'kcount_extremeplot', 'kcount_usr', 'linewidExt', 'N_Iteration_Plot', 'ExtremesFigSize', 'ResizeExtremesFac_max', 'ResizeExtremesFac_min', 'TitleFileName', 'DisLine', 'StarName']
+    h = hashlib.sha1()
+    Hash_Update(h, list(waveRanges))
+    Hash_Update(h, {key: val for key, val in GridData['DisArgs'].items() if key not in PlotKeys})
+    Hash_Update(h, {key: val for key, val in GridData['Orbital_Params'].items() if key not in GridData.get('Keys', ['K1', 'K2', 'KOut'])})
+    if 'Keys' in GridData:
+        Hash_Update(h, GridData['Keys'])
+    Hash_Update(h, GridData['Ini'])
+    if GridData['Ini']=='A' or GridData['Ini']=='B':
+        Hash_Update(h, [GridData['Bini'](waves) for waves in waveRanges])
+    return h.hexdigest()
+
+
+# Opens the on-disk chi2 store of a K grid in directory StoreDir, or creates it if it does not exist or does not match KAxes / InputHash.
+# The store consists of memory-mapped arrays chi2.npy, itrs.npy, done.npy (shape = (number of wavelength ranges,) + grid shape; chi2 = nan for
+# points whose RVs could not be computed) and Meta.json (K axes, DoF, input hash), and is updated as each grid point finishes (Store_Result)
+# NumEpochs > 0: additionally chi2ep.npy, the chi2 contributions of the NumEpochs epochs (shape + (NumEpochs,))
+def Open_Grid_Store(StoreDir, KAxes, NumRanges, DoFs, InputHash, NumEpochs=0):
+    Meta = {'KAxes': [[float(K) for K in KAxis] for KAxis in KAxes], 'NumRanges': NumRanges, 'DoF': int(DoFs), 'InputHash': InputHash}
+    Shape = (NumRanges,) + tuple(len(K) for K in KAxes)
+    Arrays = [('chi2', float, Shape), ('itrs', int, Shape), ('done', bool, Shape)]
+    if NumEpochs > 0:
+        Meta['NumEpochs'] = NumEpochs
+        Arrays.append(('chi2ep', float, Shape + (NumEpochs,)))
+    MetaFile = os.path.join(StoreDir, 'Meta.json')
+    Store = {}
+    try:
+        if json.load(open(MetaFile)) != Meta:
+            print("WARNING: grid store " + StoreDir + " was created for a different grid or different input; starting a new grid")
+            raise ValueError
+        for key, dtype, ArrShape in Arrays:
+            Store[key] = np.lib.format.open_memmap(os.path.join(StoreDir, key + '.npy'), mode='r+')
+            if Store[key].shape != ArrShape:
+                raise ValueError
+        print("Resuming grid from " + StoreDir + ": " + str(np.sum(np.all(Store['done'], axis=0))) + " of " + str(np.prod(Shape[1:])) + " grid points done")
+    except (OSError, ValueError):
+        os.makedirs(StoreDir, exist_ok=True)
+        for key, dtype, ArrShape in Arrays:
+            Store[key] = np.lib.format.open_memmap(os.path.join(StoreDir, key + '.npy'), mode='w+', dtype=dtype, shape=ArrShape)
+        json.dump(Meta, open(MetaFile, 'w'), indent=1)
+    return Store
+
+
+# Writes the result of grid point inds of wavelength range r to the store (on-disk or in-memory); the point is flagged as done only once its chi2 is on disk
+# chi2 = array of the contributions of the epochs (PerEpoch): stored in 'chi2ep', their sum in 'chi2'
+def Store_Result(Store, r, inds, chi2, itr):
+    if 'chi2ep' in Store:
+        Store['chi2ep'][(r,) + tuple(inds)] = np.nan if chi2 is None else chi2
+    if chi2 is not None and np.ndim(chi2) > 0:
+        chi2 = np.sum(chi2)
+    Store['chi2'][(r,) + tuple(inds)] = np.nan if chi2 is None else chi2
+    Store['itrs'][(r,) + tuple(inds)] = itr
+    OnDisk = isinstance(Store['done'], np.memmap)
+    if OnDisk:
+        for key in ['chi2', 'itrs', 'chi2ep']:
+            if key in Store:
+                Store[key].flush()
+    Store['done'][(r,) + tuple(inds)] = True
+    if OnDisk:
+        Store['done'].flush()
+
+
+# Evaluates the chi2 of all K grid points, summed over waveRanges (see Grid_Chunk for GridData)
+# NumWorkers > 1: grid points are spread over a pool of NumWorkers processes; chi2 map identical to the serial one.
+# WarmStart is not used for a parallel grid (chunks of the serpentine path could not start from their serial predecessors)
+# StoreDir: results are kept in an on-disk store (see Open_Grid_Store) that is updated as points finish; grid points already in the store are skipped
+# Plots (PLOTEXTREMES / PLOTFITS) of a parallel or resumed grid are not made during the grid; the selected grid points are re-done afterwards in the main process
+# GridData['Valid'] (optional boolean array with the shape of the grid): False = point is not disentangled (e.g. non-physical orbit), chi2 as for failed RVs
+# Returns chi2 and iteration arrays with the shape of the grid; chi2 = 1E5 where the RVs could not be computed
+# PerEpoch: additionally returns the chi2 contributions of the epochs (grid shape + (epochs,); nan where the RVs could not be computed)
+def Grid_Run(waveRanges, GridData, WarmStart=False, NumWorkers=1, StoreDir=None, DoFs=0, PerEpoch=False):
+    Shape = tuple(len(K) for K in GridData['Ks'])
+    NumEpochs = len(GridData['DisArgs']['ObsSpecs']) if PerEpoch else 0
+    if PerEpoch:
+        GridData = dict(GridData, DisArgs=dict(GridData['DisArgs'], PerEpoch=True))
+    DisArgs = GridData['DisArgs']
+    if StoreDir is None:
+        Store = {'chi2': np.zeros((len(waveRanges),) + Shape), 'itrs': np.zeros((len(waveRanges),) + Shape, dtype=int), 'done': np.zeros((len(waveRanges),) + Shape, dtype=bool)}
+        if PerEpoch:
+            Store['chi2ep'] = np.zeros((len(waveRanges),) + Shape + (NumEpochs,))
+    else:
+        Store = Open_Grid_Store(StoreDir, GridData['Ks'], len(waveRanges), DoFs, Grid_Input_Hash(waveRanges, GridData), NumEpochs)
+    Resumed = np.any(Store['done'])
+    if NumWorkers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print("WARNING: parallel grid requires the 'fork' start method, which is not available; running serially")
+        NumWorkers = 1
+    if WarmStart and NumWorkers > 1:
+        print("NOTE: WarmStart is not used for a parallel grid; all grid points start from the initial guess (use NumWorkers = 1 for warm starts)")
+        WarmStart = False
+    if WarmStart:
+        GridOrder = Serpentine_Order(Shape)
+    else:
+        GridOrder = list(np.ndindex(Shape))
+    if 'Valid' in GridData:
+        Skipped = [inds for inds in GridOrder if not GridData['Valid'][inds]]
+        print("Skipping " + str(len(Skipped)) + " non-physical grid points of " + str(len(GridOrder)))
+        for r in np.arange(len(waveRanges)):
+            for inds in Skipped:
+                if not Store['done'][(r,) + tuple(inds)]:
+                    Store_Result(Store, r, inds, None, 0)
+    Todo = [[inds for inds in GridOrder if not Store['done'][(r,) + tuple(inds)]] for r in np.arange(len(waveRanges))]
+    DeferPlots = NumWorkers > 1 or Resumed
+    if DeferPlots:
+        RunData = dict(GridData, DisArgs=dict(DisArgs, PLOTEXTREMES=False, PLOTFITS=False))
+    else:
+        RunData = GridData
+    if NumWorkers <= 1:
+        for r, waves in enumerate(waveRanges):
+            Grid_Chunk(Todo[r], waves, RunData, WarmStart, OnResult=lambda inds, chi2, itr: Store_Result(Store, r, inds, chi2, itr))
+    else:
+        if DisArgs['PLOTCONV'] or DisArgs['PLOTITR']:
+            print("WARNING: PLOTCONV / PLOTITR are ignored for a parallel grid")
+        WorkerData = dict(RunData, DisArgs=dict(RunData['DisArgs'], PLOTCONV=False, PLOTITR=False))
+        Tasks = []
+        for r, waves in enumerate(waveRanges):
+            if len(Todo[r])==0:
+                continue
+            NumChunks = min(len(Todo[r]), 4*NumWorkers)
+            Tasks += [(r, [Todo[r][i] for i in ChunkInds]) for ChunkInds in np.array_split(np.arange(len(Todo[r])), NumChunks)]
+        with ProcessPoolExecutor(max_workers=NumWorkers, mp_context=multiprocessing.get_context('fork'), initializer=Init_Grid_Worker, initargs=(WorkerData,)) as Pool:
+            Futures = {Pool.submit(Grid_Chunk_Worker, (Chunk, waveRanges[r], WarmStart)): r for r, Chunk in Tasks}
+            for Future in as_completed(Futures):
+                for inds, chi2, itr in Future.result():
+                    Store_Result(Store, Futures[Future], inds, chi2, itr)
+    Diffs = np.zeros(Shape)
+    Itrs = np.zeros(Shape, dtype=int)
+    for r in np.arange(len(waveRanges)):
+        Diffs += Store['chi2'][r]
+        Itrs += Store['itrs'][r]
+    Diffs[np.isnan(Diffs)] = 1E5
+    if DeferPlots:
+        Grid_Plot_Points(waveRanges, dict(GridData, DisArgs=dict(DisArgs, PerEpoch=False)))
+    if PerEpoch:
+        return Diffs, Itrs, np.sum(Store['chi2ep'], axis=0)
+    return Diffs, Itrs
+
+
+# Re-does the grid points selected for plotting (kcount_extremeplot if PLOTEXTREMES, kcount_usr if PLOTFITS) in the current process
+def Grid_Plot_Points(waveRanges, GridData):
+    Shape = tuple(len(K) for K in GridData['Ks'])
+    DisArgs = GridData['DisArgs']
+    PlotKcounts = []
+    if DisArgs['PLOTEXTREMES']:
+        PlotKcounts.append(DisArgs['kcount_extremeplot'])
+    if DisArgs['PLOTFITS']:
+        PlotKcounts.append(DisArgs['kcount_usr'])
+    PlotPoints = [np.unravel_index(kc, Shape) for kc in PlotKcounts if 0 <= kc < np.prod(Shape)]
+    if len(PlotPoints) > 0:
+        for waves in waveRanges:
+            Grid_Chunk(PlotPoints, waves, GridData)
+
+
+# Index of the grid point of KsNew closest to grid point kcount of KsOld (e.g. to keep the plotted K values when the grid is changed)
+def Regrid_kcount(kcount, KsOld, KsNew):
+    inds = np.unravel_index(kcount, [len(K) for K in KsOld])
+    return int(np.ravel_multi_index([np.argmin(np.abs(KNew - KOld[k])) for KOld, KNew, k in zip(KsOld, KsNew, inds)], [len(K) for K in KsNew]))
+
+
+# Adaptive (coarse-to-fine) version of Grid_Run: 
+# 1. the grid GridData['Ks'] is evaluated with ItrCoarse iterations;
+# 2. a finer grid with 2*max(ParbSize,2)+1 points per axis, spanning +- one old step around the current minimum, is evaluated with the full number of iterations;
+# 3. step 2 is repeated until the steps of all axes are < KTol (and the minimum does not lie on the edge of the grid, otherwise the grid is re-centred).
+# Axes with a single K are kept fixed. Plots (PLOTEXTREMES / PLOTFITS) are made for the final grid only, at the grid point closest to the originally selected K values.
+# Returns the final K axes, chi2 and iteration arrays
+def Grid_Adaptive(waveRanges, GridData, KTol=1., ItrCoarse=10, ParbSize=3, WarmStart=False, NumWorkers=1, MaxPasses=20):
+    DisArgs = GridData['DisArgs']
+    KsCoarse = GridData['Ks']
+    NoPlotArgs = dict(DisArgs, PLOTCONV=False, PLOTITR=False, PLOTEXTREMES=False, PLOTFITS=False)
+    Ks = KsCoarse
+    Steps = [K[1] - K[0] if len(K) > 1 else 0. for K in Ks]
+    NumHalf = max(ParbSize, 2)
+    print("Adaptive grid, coarse pass: steps =", Steps)
+    Diffs, Itrs = Grid_Run(waveRanges, dict(GridData, DisArgs=dict(NoPlotArgs, itrnumlim=min(ItrCoarse, DisArgs['itrnumlim']))), WarmStart=WarmStart, NumWorkers=NumWorkers)
+    for Pass in np.arange(MaxPasses):
+        inds = np.unravel_index(np.argmin(Diffs), Diffs.shape)
+        OnEdge = [len(K) > 1 and (k==0 or k==len(K)-1) for K, k in zip(Ks, inds)]
+        if Pass > 0 and max(Steps) < KTol and not any(OnEdge):
+            break
+        KsNew = []
+        for K, k, Step, Edge in zip(Ks, inds, Steps, OnEdge):
+            if Step == 0:
+                KsNew.append(K)
+                continue
+            StepNew = Step if (Pass > 0 and Edge) else Step / NumHalf
+            Center = max(K[k], NumHalf*StepNew)
+            KsNew.append(Center + StepNew*np.arange(-NumHalf, NumHalf+1))
+        Ks = KsNew
+        Steps = [K[1] - K[0] if len(K) > 1 else 0. for K in Ks]
+        print("Adaptive grid, pass " + str(Pass+1) + ": K ranges =", [[K[0], K[-1]] for K in Ks], ", steps =", Steps)
+        Diffs, Itrs = Grid_Run(waveRanges, dict(GridData, Ks=Ks, DisArgs=NoPlotArgs), WarmStart=WarmStart, NumWorkers=NumWorkers)
+    else:
+        print("WARNING: adaptive grid did not reach KTol within " + str(MaxPasses) + " passes")
+    PlotArgs = dict(DisArgs, kcount_extremeplot=Regrid_kcount(DisArgs['kcount_extremeplot'], KsCoarse, Ks), kcount_usr=Regrid_kcount(DisArgs['kcount_usr'], KsCoarse, Ks))
+    Grid_Plot_Points(waveRanges, dict(GridData, Ks=Ks, DisArgs=PlotArgs))
+    return Ks, Diffs, Itrs
+
+
+# Direct minimisation of the chi2 (summed over waveRanges, divided by DoFs, as in the grid) over the K axes of GridData['Ks'] with more than one value,
+# within the range of these axes: bounded Brent search for one free K, Nelder-Mead for several. Axes with a single K are kept fixed.
+# Starting point: K values of GridData['Orbital_Params']. Each evaluation starts from the spectra of the best evaluation so far (use EpsTol > 0).
+# KTol = tolerance on K [km/s]; MaxEval = maximum number of chi2 evaluations
+# Errors: parabola through chi2(K - dK), chi2(K), chi2(K + dK) along each free axis, dK = step of the input grid; same confidence level as Chi2con (see Parabola_Error)
+# Evaluated K values and chi2 are saved to 'disentangled/' + Rangestr + '_optimize_K.txt'; returns the best K values and their errors
+def Optimize_K(waveRanges, GridData, DoFs, Rangestr, KTol=0.5, MaxEval=200, P1=0.68):
+    DisArgs = dict(GridData['DisArgs'], PLOTCONV=False, PLOTITR=False, PLOTEXTREMES=False, PLOTFITS=False)
+    KsGrid = GridData['Ks']
+    KNames = ['K1', 'K2', 'KOut'][:len(KsGrid)]
+    Free = [i for i in np.arange(len(KsGrid)) if len(KsGrid[i]) > 1]
+    KStart = [min(max(GridData['Orbital_Params'][KNames[i]], KsGrid[i][0]), KsGrid[i][-1]) if i in Free else KsGrid[i][0] for i in np.arange(len(KsGrid))]
+    Seeds = [None] * len(waveRanges)
+    Evals = {}
+    def Chi2_K(KFree):
+        KVec = list(KStart)
+        for i, K in zip(Free, np.atleast_1d(KFree)):
+            KVec[i] = float(K)
+        if tuple(KVec) in Evals:
+            return Evals[tuple(KVec)]
+        PointData = dict(GridData, Ks=[np.array([K]) for K in KVec], DisArgs=DisArgs)
+        chi2, Spectra = 0., []
+        for waves, Seed in zip(waveRanges, Seeds):
+            chi2Range, itr, DisSpecVector = Grid_Point((0,)*len(KVec), waves, PointData, Seed=Seed)
+            if chi2Range is None:
+                chi2 = 1E5 * DoFs
+                break
+            chi2 += chi2Range
+            Spectra.append(DisSpecVector - 1.)
+        chi2 /= DoFs
+        if len(Evals)==0 or chi2 < min(Evals.values()):
+            Seeds[:len(Spectra)] = Spectra
+        Evals[tuple(KVec)] = chi2
+        print("Optimize K:", KVec, "chi2:", chi2)
+        return chi2
+    KFreeStart = np.array([KStart[i] for i in Free])
+    Bounds = [(KsGrid[i][0], KsGrid[i][-1]) for i in Free]
+    if len(Free)==1:
+        Res = minimize_scalar(Chi2_K, bounds=Bounds[0], method='bounded', options={'xatol': KTol, 'maxiter': MaxEval})
+        KFreeBest = np.array([Res.x])
+    elif len(Free) > 1:
+        Simplex = [KFreeStart]
+        for j in np.arange(len(Free)):
+            dK = (Bounds[j][1] - Bounds[j][0]) / 4.
+            Vertex = np.copy(KFreeStart)
+            Vertex[j] += dK if Vertex[j] + dK <= Bounds[j][1] else -dK
+            Simplex.append(Vertex)
+        Res = minimize(Chi2_K, KFreeStart, method='Nelder-Mead', bounds=Bounds, options={'initial_simplex': np.array(Simplex), 'xatol': KTol, 'fatol': np.inf, 'maxfev': MaxEval})
+        KFreeBest = Res.x
+    else:
+        KFreeBest = KFreeStart
+    KBest = list(KStart)
+    for i, K in zip(Free, KFreeBest):
+        KBest[i] = float(K)
+    chi2Best = Chi2_K([KBest[i] for i in Free])
+    KErrs = [0.] * len(KsGrid)
+    for j, i in enumerate(Free):
+        dK = KsGrid[i][1] - KsGrid[i][0]
+        KsLocal = KBest[i] + np.array([-dK, 0., dK])
+        chi2Local = []
+        for K in KsLocal:
+            KFree = np.copy(KFreeBest)
+            KFree[j] = K
+            chi2Local.append(Chi2_K(KFree))
+        a,b,c = np.polyfit(KsLocal, chi2Local, 2)
+        if a <= 0:
+            print("Could not fit sensible parabola (a < 0) for " + KNames[i] + "; no error estimate")
         else:
-            SpecMean = np.sum(np.array([weights[i]*(Ss2[i] - ABshifts[i](waves) - CBshifts[i](waves)) for i in np.arange(len(Ss1))]), axis=0)                    
-        Bnew = interp1d(waves, SpecMean, bounds_error=False, fill_value=0., kind=InterKind)(waves) 
-        if StrictNegB:
-            Bnew = Limit(waves, Bnew, Poslimall, PosLimCondB)            
-        Epsnew = max(Epsnew, np.sum((B - Bnew)**2))
-        B = np.copy(Bnew)
-        ACshifts = [interp1d(WavesAC[i], A,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-        BCshifts = [interp1d(WavesBC[i], B,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-        if NebLines:
-            NebCshifts = [interp1d(WavesNebC[i], NebSpec,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-            SpecMean = np.sum(np.array([weights[i]*(SsOut[i] - ACshifts[i](waves) - BCshifts[i](waves) -  NebFac*ScalingNeb[i]*NebCshifts[i](waves)) for i in np.arange(len(Ss1))]), axis=0)
+            KErrs[i] = Parabola_Error(a, b, c, DoFs, P1)
+    np.savetxt('disentangled/' + Rangestr + '_' + 'optimize_K.txt', np.array([list(K) + [chi2] for K, chi2 in Evals.items()]), header='#' + ', '.join(KNames) + ', reduced chi2; DoF = ' + str(DoFs) + '; best: ' + ', '.join([str(K) + ' +- ' + str(KErr) for K, KErr in zip(KBest, KErrs)]))
+    print("Optimize K: " + str(len(Evals)) + " chi2 evaluations, best chi2:", chi2Best)
+    PlotArgs = dict(GridData['DisArgs'], kcount_extremeplot=0, kcount_usr=0)
+    Grid_Plot_Points(waveRanges, dict(GridData, Ks=[np.array([K]) for K in KBest], DisArgs=PlotArgs))
+    return KBest, KErrs
+
+
+# Best values of the grid axes Axes for the chi2 map Chi2 (grid shape; nan / inf = not available): grid minimum, refined along each axis by the
+# vertex of a parabola through the (at most ParbSize on each side) points around the minimum; grid value if the parabola opens downwards
+def Grid_Best(Chi2, Axes, ParbSize=3):
+    Chi2 = np.where(np.isfinite(Chi2), Chi2, np.inf)
+    indsmin = np.unravel_index(np.argmin(Chi2), Chi2.shape)
+    Best = np.array([Axis[k] for Axis, k in zip(Axes, indsmin)], dtype=float)
+    for j, Axis in enumerate(Axes):
+        Cut = Chi2[indsmin[:j] + (slice(None),) + indsmin[j+1:]]
+        Sel = np.arange(max(0, indsmin[j] - ParbSize), min(len(Axis), indsmin[j] + ParbSize + 1))
+        Sel = Sel[np.isfinite(Cut[Sel])]
+        if len(Sel) < 3:
+            continue
+        a, b, c = np.polyfit(Axis[Sel], Cut[Sel], 2)
+        if a > 0:
+            Best[j] = np.clip(-b/2./a, Axis[Sel[0]], Axis[Sel[-1]])
+    return Best
+
+
+# GridData restricted to the epochs Inds (may contain repeated epochs): per-epoch arguments of disentangle are resampled, weights renormalised; no plots
+def Resample_Grid_Data(GridData, Inds):
+    DisArgs = dict(GridData['DisArgs'], PLOTCONV=False, PLOTITR=False, PLOTEXTREMES=False, PLOTFITS=False, PerEpoch=False)
+    for key in ['ObsSpecs', 'specnames']:
+        DisArgs[key] = [DisArgs[key][i] for i in Inds]
+    for key in ['MJDs', 'nusdata', 'phis', 'nusdataOut', 'phisOut', 'ScalingNeb']:
+        if key in DisArgs:
+            DisArgs[key] = np.asarray(DisArgs[key])[Inds]
+    DisArgs['weights'] = np.asarray(DisArgs['weights'])[Inds] / np.sum(np.asarray(DisArgs['weights'])[Inds])
+    return dict(GridData, DisArgs=DisArgs)
+
+
+def Grid_Resample_Worker(Task):
+    waveRanges, Inds, WarmStart, ParbSize = Task
+    Diffs, Itrs = Grid_Run(waveRanges, Resample_Grid_Data(GridWorkerData, Inds), WarmStart=WarmStart)
+    return Grid_Best(Diffs, GridWorkerData['Ks'], ParbSize)
+
+
+# Jackknife (leave one epoch out) and bootstrap (NumBoot resamples of the epochs, drawn with replacement; seed Seed) errors on the grid axes.
+# Chi2Ep = chi2 contributions of the epochs at each grid point (Grid_Run with PerEpoch): the chi2 map of a resample is the sum of the
+# contributions weighted by the number of times each epoch is drawn, i.e. the disentangled spectra of the full data set are kept (approximation).
+# NumFull > 0: the first NumFull bootstrap resamples are also evaluated by a full grid disentangling of the resampled epochs (NumWorkers processes),
+# to check the approximation. Best values per resample from Grid_Best. All values are saved to 'disentangled/' + Rangestr + '_grid_resample.txt'.
+# Returns the jackknife and bootstrap errors of the axes (0 for axes with a single value)
+def Grid_Resample(waveRanges, GridData, Chi2Ep, Rangestr, NumBoot=200, NumFull=0, NumWorkers=1, ParbSize=3, WarmStart=False, Seed=1):
+    Axes = GridData['Ks']
+    Names = GridData.get('Keys', ['K1', 'K2', 'KOut'][:len(Axes)])
+    NumEpochs = Chi2Ep.shape[-1]
+    rng = np.random.default_rng(Seed)
+    WeightsJack = 1. - np.eye(NumEpochs)
+    WeightsBoot = rng.multinomial(NumEpochs, np.ones(NumEpochs) / NumEpochs, size=NumBoot).astype(float)
+    Full = Grid_Best(np.sum(Chi2Ep, axis=-1), Axes, ParbSize)
+    Jack = np.array([Grid_Best(Chi2Ep @ w, Axes, ParbSize) for w in WeightsJack])
+    Boot = np.array([Grid_Best(Chi2Ep @ w, Axes, ParbSize) for w in WeightsBoot])
+    JackErr = np.sqrt((NumEpochs - 1.) / NumEpochs * np.sum((Jack - np.mean(Jack, axis=0))**2, axis=0))
+    BootErr = np.std(Boot, axis=0, ddof=1) if NumBoot > 1 else np.zeros(len(Axes))
+    Rows = [[0, i] + list(Vals) for i, Vals in enumerate(Jack)] + [[1, i] + list(Vals) for i, Vals in enumerate(Boot)]
+    for Name, Val, JE, BE in zip(Names, Full, JackErr, BootErr):
+        print(Name + ": " + str(Val) + ", jackknife error: " + str(JE) + ", bootstrap error: " + str(BE) + " (" + str(NumBoot) + " resamples)")
+    NumFull = min(NumFull, NumBoot)
+    if NumFull > 0:
+        Tasks = [(waveRanges, np.repeat(np.arange(NumEpochs), WeightsBoot[i].astype(int)), WarmStart, ParbSize) for i in np.arange(NumFull)]
+        RunData = dict(GridData, DisArgs=dict(GridData['DisArgs'], PerEpoch=False))
+        if NumWorkers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            with ProcessPoolExecutor(max_workers=NumWorkers, mp_context=multiprocessing.get_context('fork'), initializer=Init_Grid_Worker, initargs=(RunData,)) as Pool:
+                BootFull = np.array(list(Pool.map(Grid_Resample_Worker, Tasks)))
         else:
-            SpecMean = np.sum(np.array([weights[i]*(SsOut[i] - ACshifts[i](waves) - BCshifts[i](waves) ) for i in np.arange(len(Ss1))]), axis=0)                    
-        Cnew = interp1d(waves, SpecMean, bounds_error=False, fill_value=0., kind=InterKind)(waves) 
-        if StrictNegC:
-            Cnew = Limit(waves, Cnew, Poslimall, PosLimCondC)            
-        Epsnew = max(Epsnew, np.sum((C - Cnew)**2))
-        C = np.copy(Cnew)       
-        if NebLines:
-            ANebshifts = [interp1d(WavesANeb[i], A,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]     
-            BNebshifts = [interp1d(WavesBNeb[i], B,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]    
-            CNebshifts = [interp1d(WavesCNeb[i], C,bounds_error=False, fill_value=0., kind=InterKind)
-                        for i in np.arange(len(ObsSpecs))]                 
-            SpecMean = np.sum(np.array([weights[i]*Limit(waves, SsNeb[i] - ANebshifts[i](waves) - BNebshifts[i](waves) - CNebshifts[i](waves), Poslimall, PosLimCondNeb) for i in np.arange(len(Ss1))]), axis=0)   
-            NebSpecnew = interp1d(waves, SpecMean, bounds_error=False, fill_value=0., kind=InterKind)(waves)
-            NebSpecnew[NebSpecnew<Poslimall[0]] = 0.
-            Epsnew = max(Epsnew, np.sum(np.abs(NebSpec - NebSpecnew))) 
-            NebSpec = NebSpecnew               
-        if ShowItr:
-            if (itr/itrnumlim*100)%10==0:
-                print("Finished " + str(itr) + " out of " + str(itrnumlim) + " iterations (" +str(np.round(itr/itrnumlim*100.,3)) + "%)")
-        if PLOTCONV:
-            plt.scatter(itr, np.log10(Epsnew), color='blue')
-        if PLOTITR:
-            if itr%N_Iteration_Plot==0:
-                plt.plot(waves, A, label=itr)
-                plt.plot(waves, B, label=itr)
-                plt.plot(waves, C, label=itr)
-                if NebLines:
-                    plt.plot(waves, NebSpec, label=itr)
-    print("Finished after ", itr, " iterations")
-    if PLOTCONV or PLOTITR:
-        if PLOTITR:
-            plt.ylabel('Normalised flux')
-            plt.xlabel('Wavelength')
-            plt.legend()
-        if PLOTCONV:
-            plt.ylabel('log(Eps)')
-            plt.xlabel('iteration number')
-        plt.show()  
-    DisSpecVector = np.array([A, B , C, NebSpec])
-    return DisSpecVector+1.,  CalcDiffs3D(DisSpecVector, vrads1,  vrads2,  vradsOut, vradsBin, waves, ObsSpecs, nusdata, nusdataOut, Orbital_Params, K1s, K2s, KOuts, MJDs, phis, phisOut, specnames, Rangestr, StarName, ScalingNeb, Resid=Resid, Reduce=Reduce, ShowItr=ShowItr,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot,  linewidExt=linewidExt, NebLines = NebLines, NebFac=NebFac, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)    
+            Init_Grid_Worker(RunData)
+            BootFull = np.array(list(map(Grid_Resample_Worker, Tasks)))
+        Rows += [[2, i] + list(Vals) for i, Vals in enumerate(BootFull)]
+        for j, Name in enumerate(Names):
+            print(Name + ", fully re-disentangled bootstrap resamples: " + str(BootFull[:, j]) + ", reweighted chi2: " + str(Boot[:NumFull, j]) 
+                  + ", rms difference: " + str(np.sqrt(np.mean((BootFull[:, j] - Boot[:NumFull, j])**2))))
+    np.savetxt('disentangled/' + Rangestr + '_grid_resample.txt', np.array(Rows), header='Type (0 = jackknife, 1 = bootstrap, 2 = bootstrap, fully re-disentangled), resample, ' + ', '.join(Names) 
+               + '\nFull data: ' + str(Full.tolist()) + '; jackknife errors: ' + str(JackErr.tolist()) + '; bootstrap errors: ' + str(BootErr.tolist()))
+    return JackErr, BootErr
+
 
-    
 # Assuming spectrum for secondary (Bini) and vrads1, gamma, and K1, explore K2s array for best-fitting K2
 # Ini = determines initial assumption for 0'th iteration
 # ShowItr = determines whether 
-def Grid_disentangling2D(waveRanges, nusdata, Bini, Orbital_Params, K1s, K2s,  ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  MJDs, phis, specnames,  Rangestr, StarName, ScalingNeb, Ini=None, ShowItr=False,  InterKind='linear', itrnumlim = 100, NebOff=True, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0, linewidExt=3,ParbSize=3, N_Iteration_Plot=50,  NebLines = False, NebFac=1, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1., TitleFileName=False, DisLine=None):
-    global kcount, k1, k2, DoFs
-    N = 0
-    Diffs=np.zeros(len(K1s)*len(K2s)).reshape(len(K1s), len(K2s))  
-    DoFs=0 
-    for waves in waveRanges:       
-        kcount = 0
-        for k1, K1 in enumerate(K1s):
-            for k2, K2 in enumerate(K2s):
-                Orbital_Params_Updated = Orbital_Params.copy()
-                Orbital_Params_Updated['K1'] = K1
-                Orbital_Params_Updated['K2'] = K2
-                vrads1, vrads2 = v1andv2(nusdata, Orbital_Params_Updated)  
-                NebSpec = waves * 0.
-                if Ini=='A':
-                    print("Initial guess provided for component " + Ini)      
-                    #print Bini(waves)
-                    Diffs[k1,k2] += disentangle(Bini(waves), vrads2, vrads1,  waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, nusdata, Orbital_Params_Updated, K1s, K2s, MJDs, phis, specnames, Rangestr, StarName,  ScalingNeb, NebSpec, InterKind=InterKind, itrnumlim = itrnumlim,  PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt,  N_Iteration_Plot=N_Iteration_Plot, NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)[-1]      
-                elif Ini=='B':
-                    print("Initial guess provided for component " + Ini)        
-                    Diffs[k1,k2] += disentangle(Bini(waves), vrads1, vrads2,  waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, nusdata, Orbital_Params_Updated, K1s, K2s, MJDs, phis, specnames, Rangestr, StarName,  ScalingNeb, NebSpec, InterKind=InterKind, itrnumlim = itrnumlim,  PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt, N_Iteration_Plot=N_Iteration_Plot, NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)[-1]              
-                else:
-                    print("No initial approximation given, assuming flat spectrum for secondary...")
-                    Bini = interp1d(waves, np.ones(len(waves)),bounds_error=False, fill_value=1.)  
-                    Diffs[k1,k2] += disentangle(Bini(waves), vrads2, vrads1,  waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, nusdata, Orbital_Params_Updated, K1s, K2s, MJDs, phis, specnames, Rangestr, StarName,  ScalingNeb, NebSpec, InterKind=InterKind, itrnumlim = itrnumlim,  PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt,  N_Iteration_Plot=N_Iteration_Plot, NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min=ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)[-1]         
+# WarmStart = walk the grid in serpentine order and start each grid point from the converged spectra of the previous (neighbouring) one (serial grids only)
+# NumWorkers = number of processes over which the grid points are spread (1: serial), see Grid_Run
+# Adaptive = coarse-to-fine search (see Grid_Adaptive) instead of evaluating the full grid K1s x K2s; the final (fine) grid is saved and used for the K errors
+# Optimize = minimise chi2 directly within the range of K1s, K2s (see Optimize_K) instead of evaluating a grid
+# Checkpoint = keep the chi2 of the (non-adaptive) grid in an on-disk store, updated after each grid point; a rerun skips points already done (see Open_Grid_Store)
+# KBlock = number of K2 values disentangled together in one array pass (see Shift_And_Add_Block; 0 / 1: one by one)
+# Resample = jackknife / bootstrap errors over the epochs from the per-epoch chi2 of the (non-adaptive) grid (see Grid_Resample; NumBoot resamples, NumFullResample of them fully re-disentangled)
+def Grid_disentangling2D(waveRanges, nusdata, Bini, Orbital_Params, K1s, K2s,  ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  MJDs, phis, specnames,  Rangestr, StarName, ScalingNeb, Ini=None, ShowItr=False,  InterKind='linear', itrnumlim = 100, NebOff=True, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0, linewidExt=3,ParbSize=3, N_Iteration_Plot=50,  NebLines = False, NebFac=1, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1., TitleFileName=False, DisLine=None, Engine='classic', EpsTol=0., Accelerate=None, WarmStart=False, NumWorkers=1, Adaptive=False, KTol=1., ItrCoarse=10, Optimize=False, OptKTol=0.5, OptMaxEval=200, Checkpoint=False, LogOversample=1, LogIntShift=False, LsqrDamp=0., KBlock=0, Resample=False, NumBoot=200, NumFullResample=0):
+    DisArgs = {'ObsSpecs': ObsSpecs, 'weights': weights, 'StrictNeg': StrictNeg, 'PosLimCond': PosLimCond, 'Poslimall': Poslimall, 'nusdata': nusdata, 'K1s': K1s, 'K2s': K2s, 'MJDs': MJDs, 'phis': phis, 'specnames': specnames, 'Rangestr': Rangestr, 'StarName': StarName, 'ScalingNeb': ScalingNeb, 
+               'InterKind': InterKind, 'itrnumlim': itrnumlim, 'PLOTCONV': PLOTCONV, 'PLOTITR': PLOTITR, 'PLOTEXTREMES': PLOTEXTREMES, 'PLOTFITS': PLOTFITS, 'kcount_extremeplot': kcount_extremeplot, 'linewidExt': linewidExt, 'N_Iteration_Plot': N_Iteration_Plot, 'NebLines': NebLines, 'NebFac': 1, 'kcount_usr': kcount_usr, 'ExtremesFigSize': ExtremesFigSize, 'ResizeExtremesFac_max': ResizeExtremesFac_max, 'ResizeExtremesFac_min': ResizeExtremesFac_min, 'TitleFileName': TitleFileName, 'DisLine': DisLine, 'Engine': Engine, 'EpsTol': EpsTol, 'Accelerate': Accelerate, 'LogOversample': LogOversample, 'LogIntShift': LogIntShift, 'LsqrDamp': LsqrDamp}
+    GridData = {'Ks': [K1s, K2s], 'Ini': Ini, 'Bini': Bini, 'Orbital_Params': Orbital_Params, 'DisArgs': DisArgs, 'KBlock': KBlock}
+    if KBlock > 1 and (Engine not in ['classic', 'sparse', 'batched'] or InterKind!='linear' or Accelerate or PLOTCONV or PLOTITR):
+        print("WARNING: KBlock requires Engine='classic' / 'sparse' / 'batched', InterKind='linear', no Accelerate and no PLOTCONV / PLOTITR; K2 values are disentangled one by one")
+    DoFs = Grid_DoFs(waveRanges[0], nusdata, Orbital_Params, K1s, K2s, len(ObsSpecs), 2)
+    if Optimize:
+        [K1, K2], [K1err, K2err] = Optimize_K(waveRanges, GridData, DoFs, Rangestr, KTol=OptKTol, MaxEval=OptMaxEval)
+        print("K1, K1 min error:", K1, K1err)         
+        print("K2, K2 min error:", K2, K2err) 
+        return K1, K2
+    if Adaptive:
+        [K1s, K2s], Diffs, Itrs = Grid_Adaptive(waveRanges, GridData, KTol=KTol, ItrCoarse=ItrCoarse, ParbSize=ParbSize, WarmStart=WarmStart, NumWorkers=NumWorkers)
+    else:
+        GridOut = Grid_Run(waveRanges, GridData, WarmStart=WarmStart, NumWorkers=NumWorkers, StoreDir='disentangled/' + Rangestr + '_grid_store_K1K2' if Checkpoint else None, DoFs=DoFs, PerEpoch=Resample)
+        Diffs, Itrs = GridOut[0], GridOut[1]
     Diffs /= (DoFs)  
     try:
         StepSize1 = K1s[1] - K1s[0]
@@ -794,6 +1761,9 @@ def Grid_disentangling2D(waveRanges, nusdata, Bini, Orbital_Params, K1s, K2s,  O
     except:
         StepSize2 = 0        
     np.savetxt('disentangled/' + Rangestr + '_' + 'grid_dis_K1K2.txt', np.array(Diffs), header='#K1min, K2min, stepK1, stepK2, DoF = ' + str(K1s[0]) + ', ' + str(K2s[0]) + ', ' + str(StepSize1) + ', ' + str(StepSize2)   + ', ' + str(DoFs) ) 
+    np.savetxt('disentangled/' + Rangestr + '_' + 'grid_dis_itrs_K1K2.txt', Itrs, fmt='%d', header='#Iterations used per K1, K2 pair (summed over ranges), EpsTol = ' + str(EpsTol))
+    print("Iterations used per grid point (min, mean, max):", np.amin(Itrs), np.mean(Itrs), np.amax(Itrs))
+    print("Shifted-spectra cache (this process):", Shift_Cache_Stats())
     k1min, k2min = np.argwhere(Diffs == np.min(Diffs))[0]
     #print Diffs
     print("True velocities: ", k1min, k2min, K1s[k1min], K2s[k2min])
@@ -810,6 +1780,10 @@ def Grid_disentangling2D(waveRanges, nusdata, Bini, Orbital_Params, K1s, K2s,  O
         K1err = 0
     print("K1, K1 min error:", K1, K1err)         
     print("K2, K2 min error:", K2, K2err) 
+    if Resample and Adaptive:
+        print("WARNING: resampling of the epochs is not available for the adaptive grid")
+    elif Resample:
+        Grid_Resample(waveRanges, GridData, GridOut[2], Rangestr, NumBoot=NumBoot, NumFull=NumFullResample, NumWorkers=NumWorkers, ParbSize=ParbSize, WarmStart=WarmStart)
     return K1, K2
 
 
@@ -818,39 +1792,23 @@ def Grid_disentangling2D(waveRanges, nusdata, Bini, Orbital_Params, K1s, K2s,  O
 # Assuming spectrum for secondary (Bini) and vrads1, gamma, and K1, explore K2s array for best-fitting K2
 # Ini = determines initial assumption for 0'th iteration
 # ShowItr = determines whether 
-def Grid_disentangling3D(waveRanges, nusdata, nusdataOut, Bini, Orbital_Params, K1s, K2s,  KOuts, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  MJDs, phis, phisOut, specnames,  Rangestr, StarName, ScalingNeb, Ini=None, ShowItr=False,  InterKind='linear', itrnumlim = 100, NebOff=True, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0, linewidExt=3,  ParbSize=3, N_Iteration_Plot=50,  NebLines = False, NebFac=1, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1., TitleFileName=False, DisLine=None):
-    global kcount, k1, k2, kOut, DoFs
-    N = 0
-    Diffs=np.zeros(len(K1s)*len(K2s)*len(KOuts)).reshape(len(K1s), len(K2s), len(KOuts))  
-    DoFs=0 
-    for waves in waveRanges:       
-        kcount = 0
-        for k1, K1 in enumerate(K1s):
-            for k2, K2 in enumerate(K2s):
-                for kOut, KOut in enumerate(KOuts):
-                    Orbital_Params_Updated = Orbital_Params.copy()
-                    Orbital_Params_Updated['K1'] = K1
-                    Orbital_Params_Updated['K2'] = K2
-                    Orbital_Params_Updated['KOut'] = KOut
-                    try:
-                        vrads1, vrads2 = v1andv2(nusdata, Orbital_Params_Updated)  
-                        vradsOut, vradsBin = v1andv2(nusdataOut, Orbital_Params_Updated, Config='Tertiary')  
-                    except:
-                        Diffs[k1,k2,kOut] = 1E5
-                        kcount+=1
-                        continue
-                    NebSpec = waves * 0.
-                    if Ini=='A':
-                        print("Initial guess provided for component " + Ini)      
-                        #print Bini(waves)
-                        Diffs[k1,k2, kOut] += disentangle3Comp(Bini(waves), vrads2, vrads1, vradsOut, vradsBin,  waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, nusdata, nusdataOut, Orbital_Params_Updated, K1s, K2s, KOuts, MJDs, phis, phisOut, specnames, Rangestr, StarName,  ScalingNeb, NebSpec, InterKind=InterKind, itrnumlim = itrnumlim,  PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt,  N_Iteration_Plot=N_Iteration_Plot, NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)[-1]      
-                    elif Ini=='B':
-                        print("Initial guess provided for component " + Ini)        
-                        Diffs[k1,k2, kOut] += disentangle3Comp(Bini(waves), vrads1, vrads2, vradsOut, vradsBin,   waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, nusdata, nusdataOut, Orbital_Params_Updated, K1s, K2s, KOuts, MJDs, phis, phisOut, specnames, Rangestr, StarName,  ScalingNeb, NebSpec, InterKind=InterKind, itrnumlim = itrnumlim,  PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt,  N_Iteration_Plot=N_Iteration_Plot, NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min = ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)[-1]                        
-                    else:
-                        print("No initial approximation given, assuming flat spectrum for secondary...")
-                        Bini = interp1d(waves, np.ones(len(waves)),bounds_error=False, fill_value=1.)  
-                        Diffs[k1,k2] += disentangle3Comp(Bini(waves), vrads2, vrads1, vradsOut, vradsBin,  waves, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, nusdata, nusdataOut, Orbital_Params_Updated, K1s, K2s, KOuts, MJDs, phis, phisOut, specnames, Rangestr, StarName,  ScalingNeb, NebSpec, InterKind=InterKind, itrnumlim = itrnumlim,  PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,   PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt, N_Iteration_Plot=N_Iteration_Plot, NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, ResizeExtremesFac_max=ResizeExtremesFac_max, ResizeExtremesFac_min=ResizeExtremesFac_min, TitleFileName=TitleFileName, DisLine=DisLine)[-1]         
+# WarmStart, NumWorkers, Adaptive, Optimize, Checkpoint, Resample, NumBoot, NumFullResample = see Grid_disentangling2D
+def Grid_disentangling3D(waveRanges, nusdata, nusdataOut, Bini, Orbital_Params, K1s, K2s,  KOuts, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  MJDs, phis, phisOut, specnames,  Rangestr, StarName, ScalingNeb, Ini=None, ShowItr=False,  InterKind='linear', itrnumlim = 100, NebOff=True, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, kcount_extremeplot=0, linewidExt=3,  ParbSize=3, N_Iteration_Plot=50,  NebLines = False, NebFac=1, kcount_usr=0, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1., TitleFileName=False, DisLine=None, Engine='classic', EpsTol=0., Accelerate=None, WarmStart=False, NumWorkers=1, Adaptive=False, KTol=1., ItrCoarse=10, Optimize=False, OptKTol=0.5, OptMaxEval=200, Checkpoint=False, LogOversample=1, LogIntShift=False, LsqrDamp=0., Resample=False, NumBoot=200, NumFullResample=0):
+    DisArgs = {'ObsSpecs': ObsSpecs, 'weights': weights, 'StrictNeg': StrictNeg, 'PosLimCond': PosLimCond, 'Poslimall': Poslimall, 'nusdata': nusdata, 'nusdataOut': nusdataOut, 'K1s': K1s, 'K2s': K2s, 'KOuts': KOuts, 'MJDs': MJDs, 'phis': phis, 'phisOut': phisOut, 'specnames': specnames, 'Rangestr': Rangestr, 'StarName': StarName, 'ScalingNeb': ScalingNeb, 
+               'InterKind': InterKind, 'itrnumlim': itrnumlim, 'PLOTCONV': PLOTCONV, 'PLOTITR': PLOTITR, 'PLOTEXTREMES': PLOTEXTREMES, 'PLOTFITS': PLOTFITS, 'kcount_extremeplot': kcount_extremeplot, 'linewidExt': linewidExt, 'N_Iteration_Plot': N_Iteration_Plot, 'NebLines': NebLines, 'NebFac': 1, 'kcount_usr': kcount_usr, 'ExtremesFigSize': ExtremesFigSize, 'ResizeExtremesFac_max': ResizeExtremesFac_max, 'ResizeExtremesFac_min': ResizeExtremesFac_min, 'TitleFileName': TitleFileName, 'DisLine': DisLine, 'Engine': Engine, 'EpsTol': EpsTol, 'Accelerate': Accelerate, 'LogOversample': LogOversample, 'LogIntShift': LogIntShift, 'LsqrDamp': LsqrDamp}
+    GridData = {'Ks': [K1s, K2s, KOuts], 'Ini': Ini, 'Bini': Bini, 'Orbital_Params': Orbital_Params, 'DisArgs': DisArgs}
+    DoFs = Grid_DoFs(waveRanges[0], nusdata, Orbital_Params, K1s, K2s, len(ObsSpecs), 3)
+    if Optimize:
+        [K1, K2, KOut], [K1err, K2err, KOuterr] = Optimize_K(waveRanges, GridData, DoFs, Rangestr, KTol=OptKTol, MaxEval=OptMaxEval)
+        print("K1, K1 min error:", K1, K1err)         
+        print("K2, K2 min error:", K2, K2err) 
+        print("KOut, KOut min error:", KOut, KOuterr) 
+        return K1, K2, KOut
+    if Adaptive:
+        [K1s, K2s, KOuts], Diffs, Itrs = Grid_Adaptive(waveRanges, GridData, KTol=KTol, ItrCoarse=ItrCoarse, ParbSize=ParbSize, WarmStart=WarmStart, NumWorkers=NumWorkers)
+    else:
+        GridOut = Grid_Run(waveRanges, GridData, WarmStart=WarmStart, NumWorkers=NumWorkers, StoreDir='disentangled/' + Rangestr + '_grid_store_K1K2K3' if Checkpoint else None, DoFs=DoFs, PerEpoch=Resample)
+        Diffs, Itrs = GridOut[0], GridOut[1]
     Diffs /= (DoFs)  
     try:
         StepSize1 = K1s[1] - K1s[0]
@@ -868,8 +1826,13 @@ def Grid_disentangling3D(waveRanges, nusdata, nusdataOut, Bini, Orbital_Params,
                     'Steps': [StepSize1, StepSize2, StepSize3],
                     'DoF' : DoFs }
     Chi2FileName = 'disentangled/' + Rangestr + '_' + 'grid_dis_K1K2K3.pkl'
-    pickle.dump(PickleHeader, open(Chi2FileName, 'wb'))
-    pickle.dump(Diffs, open(Chi2FileName, 'wb'))
+# Header and chi2 array are consecutive pickles in the same file: read with two successive pickle.load calls
+    with open(Chi2FileName, 'wb') as Chi2File:
+        pickle.dump(PickleHeader, Chi2File)
+        pickle.dump(Diffs, Chi2File)
+    pickle.dump(Itrs, open('disentangled/' + Rangestr + '_' + 'grid_dis_itrs_K1K2K3.pkl', 'wb'))
+    print("Iterations used per grid point (min, mean, max):", np.amin(Itrs), np.mean(Itrs), np.amax(Itrs))
+    print("Shifted-spectra cache (this process):", Shift_Cache_Stats())
     #np.savetxt('disentangled/' + Rangestr + '_' + 'grid_dis_K1K2K3.txt', (np.array(Diffs))., header='#K1min, K2min, K3min, stepK1, stepK2, stepK3, DoF = ' + str(K1s[0]) + ', ' + str(K2s[0]) + ', ' + ', ' + str(KOuts[0]) +  ', ' + str(StepSize1) + ', ' + str(StepSize2)   + ', ' + str(StepSize3) + ', ' + str(DoFs) )     
     k1min, k2min, kOutmin = np.argwhere(Diffs == np.min(Diffs))[0]
     #print Diffs
@@ -893,42 +1856,230 @@ def Grid_disentangling3D(waveRanges, nusdata, nusdataOut, Bini, Orbital_Params,
     print("K1, K1 min error:", K1, K1err)         
     print("K2, K2 min error:", K2, K2err) 
     print("KOut, KOut min error:", KOut, KOuterr) 
+    if Resample and Adaptive:
+        print("WARNING: resampling of the epochs is not available for the adaptive grid")
+    elif Resample:
+        Grid_Resample(waveRanges, GridData, GridOut[2], Rangestr, NumBoot=NumBoot, NumFull=NumFullResample, NumWorkers=NumWorkers, ParbSize=ParbSize, WarmStart=WarmStart)
     return K1, K2, KOut
+
+
+
+# Grid disentangling over any orbital parameters of a binary (CompNum=2) or triple (CompNum=3): GridAxes = dict of parameter name 
+# (keys of Orbital_Params, e.g. 'ecc', 'omega', 'T0', 'K2') --> array of values; the other parameters are fixed to Orbital_Params.
+# The anomalies are computed per (P, T0, e) and reused for all values of the other axes (Orbit_Anomalies); non-physical combinations
+# (Orbit_Physical) are skipped before the grid is scheduled. The chi2 of all grid points is computed on the same pixels: those covered at all
+# epochs for every valid orbit of the grid (Orbit_Vrad_Range), which also set the DoF. Plotted point (PLOTEXTREMES / PLOTFITS) = grid point
+# closest to Orbital_Params. The chi2 grid is pickled as for Grid_disentangling3D, with header {'Keys', 'Axes', 'DoF'}.
+# Other arguments (incl. Resample) as in Grid_disentangling2D (no Adaptive / Optimize / KBlock). Returns dicts of the best values and their errors.
+def Grid_disentangling_Orbit(waveRanges, GridAxes, Bini, Orbital_Params, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  MJDs, specnames,  Rangestr, StarName, ScalingNeb, CompNum=2, Ini=None, InterKind='linear', itrnumlim = 100, PLOTCONV=False, PLOTITR=False,   PLOTEXTREMES=False, PLOTFITS=False, linewidExt=3,  ParbSize=3, N_Iteration_Plot=50,  NebLines = False, ExtremesFigSize=(7,8), ResizeExtremesFac_max=1., ResizeExtremesFac_min=1., TitleFileName=False, DisLine=None, Engine='classic', EpsTol=0., Accelerate=None, WarmStart=False, NumWorkers=1, Checkpoint=False, LogOversample=1, LogIntShift=False, LsqrDamp=0., Resample=False, NumBoot=200, NumFullResample=0):
+    Keys = list(GridAxes.keys())
+    if any(Key not in Orbital_Params or Key not in OrbitParamLabels for Key in Keys):
+        sys.exit("Grid over orbital parameters: unknown parameter(s) in " + str(Keys) + "; allowed: " + str(list(OrbitParamLabels.keys())))
+    Axes = [np.atleast_1d(np.asarray(GridAxes[Key], dtype=float)) for Key in Keys]
+    Shape = tuple(len(Axis) for Axis in Axes)
+    kcount = int(np.ravel_multi_index([np.argmin(np.abs(Axis - Orbital_Params[Key])) for Key, Axis in zip(Keys, Axes)], Shape))
+    KArrs = {KName: Axes[Keys.index(KName)] if KName in Keys else np.array([Orbital_Params[KName]]) for KName in ['K1', 'K2', 'KOut']}
+    DisArgs = {'ObsSpecs': ObsSpecs, 'weights': weights, 'StrictNeg': StrictNeg, 'PosLimCond': PosLimCond, 'Poslimall': Poslimall, 'K1s': KArrs['K1'], 'K2s': KArrs['K2'], 'MJDs': MJDs, 'specnames': specnames, 'Rangestr': Rangestr, 'StarName': StarName, 'ScalingNeb': ScalingNeb, 
+               'InterKind': InterKind, 'itrnumlim': itrnumlim, 'PLOTCONV': PLOTCONV, 'PLOTITR': PLOTITR, 'PLOTEXTREMES': PLOTEXTREMES, 'PLOTFITS': PLOTFITS, 'kcount_extremeplot': kcount, 'linewidExt': linewidExt, 'N_Iteration_Plot': N_Iteration_Plot, 'NebLines': NebLines, 'NebFac': 1, 'kcount_usr': kcount, 'ExtremesFigSize': ExtremesFigSize, 'ResizeExtremesFac_max': ResizeExtremesFac_max, 'ResizeExtremesFac_min': ResizeExtremesFac_min, 'TitleFileName': TitleFileName, 'DisLine': DisLine, 'Engine': Engine, 'EpsTol': EpsTol, 'Accelerate': Accelerate, 'LogOversample': LogOversample, 'LogIntShift': LogIntShift, 'LsqrDamp': LsqrDamp}
+    if CompNum==3:
+        DisArgs['KOuts'] = KArrs['KOut']
+    DisArgs = Orbit_DisArgs(DisArgs, Orbital_Params, CompNum)
+    Valid = np.zeros(Shape, dtype=bool)
+    for inds in np.ndindex(Shape):
+        Valid[inds] = Orbit_Physical(dict(Orbital_Params, **{Key: Axis[k] for Key, Axis, k in zip(Keys, Axes, inds)}), CompNum)
+    if not np.any(Valid):
+        print("WARNING: no physical orbit in the grid over " + str(Keys) + "; keeping the input orbit")
+        return {Key: Orbital_Params[Key] for Key in Keys}, {Key: 0. for Key in Keys}
+    DisArgs['VradRange'] = Orbit_Vrad_Range(MJDs, Keys, Axes, Valid, Orbital_Params, KArrs['K1'][-1], KArrs['K2'][-1])
+    print("RV range defining the pixels of the chi2 (all grid points):", DisArgs['VradRange'])
+    GridData = {'Ks': Axes, 'Keys': Keys, 'CompNum': CompNum, 'Valid': Valid, 'Ini': Ini, 'Bini': Bini, 'Orbital_Params': Orbital_Params, 'DisArgs': DisArgs}
+    DoFs = Grid_DoFs(waveRanges[0], DisArgs['nusdata'], Orbital_Params, KArrs['K1'], KArrs['K2'], len(ObsSpecs), CompNum, DisArgs['VradRange'])
+    GridOut = Grid_Run(waveRanges, GridData, WarmStart=WarmStart, NumWorkers=NumWorkers, StoreDir='disentangled/' + Rangestr + '_grid_store_orbit' if Checkpoint else None, DoFs=DoFs, PerEpoch=Resample)
+    Diffs, Itrs = GridOut[0], GridOut[1]
+    Diffs /= (DoFs)  
+    Diffs[~Valid] = np.nan
+    PickleHeader = {'Keys': Keys,
+                    'Axes': Axes,
+                    'DoF' : DoFs }
+    Chi2FileName = 'disentangled/' + Rangestr + '_' + 'grid_dis_orbit.pkl'
+# Header and chi2 array are consecutive pickles in the same file: read with two successive pickle.load calls; chi2 = nan for non-physical points
+    with open(Chi2FileName, 'wb') as Chi2File:
+        pickle.dump(PickleHeader, Chi2File)
+        pickle.dump(Diffs, Chi2File)
+    pickle.dump(Itrs, open('disentangled/' + Rangestr + '_' + 'grid_dis_itrs_orbit.pkl', 'wb'))
+    print("Iterations used per grid point (min, mean, max):", np.amin(Itrs[Valid]), np.mean(Itrs[Valid]), np.amax(Itrs[Valid]))
+    print("Shifted-spectra cache (this process):", Shift_Cache_Stats())
+    indsmin = np.unravel_index(np.nanargmin(Diffs), Shape)
+    print("Best grid point: ", {Key: Axis[k] for Key, Axis, k in zip(Keys, Axes, indsmin)})
+    Best, Errs = {}, {}
+    for j, (Key, Axis) in enumerate(zip(Keys, Axes)):
+        Cut = Diffs[indsmin[:j] + (slice(None),) + indsmin[j+1:]]
+        Fin = np.isfinite(Cut)
+        if np.sum(Fin) < 3:
+            Best[Key], Errs[Key] = Axis[indsmin[j]], 0.
+        elif np.argmin(Cut[Fin]) in [0, np.sum(Fin)-1]:
+            print("WARNING: minimum of " + Key + " on the edge of its grid axis; keeping the grid value (extend the axis to refine it)")
+            Best[Key], Errs[Key] = Axis[indsmin[j]], 0.
+        else:
+            chi2P, Best[Key], Errs[Key] = Chi2con(Cut[Fin], DoFs, Axis[Fin], Rangestr, comp=Key, ParbSize=ParbSize)
+        print(Key + ", " + Key + " min error:", Best[Key], Errs[Key])
+    if Resample:
+        Grid_Resample(waveRanges, GridData, GridOut[2], Rangestr, NumBoot=NumBoot, NumFull=NumFullResample, NumWorkers=NumWorkers, ParbSize=ParbSize, WarmStart=WarmStart)
+    return Best, Errs
     
     
 
-def read_FEROS(infile):
+def read_FEROS(infile, hdul):
     print("%s: Input file is a FEROS file." % infile)
-    header = fits.getheader(infile)
+    header = hdul[0].header
     try:
-        flux = fits.getdata(infile)
+        flux = hdul[0].data
         crval = header['CRVAL1']
         crpix = header['CRPIX1']
         cdelt = header['CDELT1']
 
         wave = crval - (cdelt * crpix - cdelt) + np.arange(flux.shape[0]) * cdelt
     except:
-        table = Table.read(infile)
+        table = Fits_Table(hdul)
         flux = table['FLUX'][0]   
         wave = table['LAMBDA'][0]   
-    return wave, flux
+    return wave, flux, None
 
 
-def read_GIRAFFE(infile):
+def read_GIRAFFE(infile, hdul):
     print(("%s: Input file is a GIRAFFE file." % infile))
-    header = fits.getheader(infile)
-    data = fits.getdata(infile)
+    header = hdul[0].header
+    data = hdul[0].data
     wl0 = header['CRVAL1']  # Starting wl at CRPIX1
     delt = header['CDELT1']  # Stepwidth of wl
     pix = header['CRPIX1']  # Reference Pixel
     wave = wl0 - (delt * pix - delt) + np.arange(data.shape[0]) * delt
-    table = Table.read(infile, hdu=1)
+    table = Fits_Table(hdul, 1)
     flux = table['NORM_SKY_SUB_CR']
-    return wave, flux
+    return wave, flux, None
+
+
+# Ingestion of one observed spectrum: read_file, optional cleaning of cosmics (CleanCos) and renormalisation at NormPoints (Renormalise;
+# NormClipItr / NormClipSigma: sigma-clipping of the continuum windows, see Normalise_Batch), S/N = 1/std of the flux between S2Nblue and S2Nred (before cleaning), and the date from keyword MJDHeader of the FITS header (None: no date).
+# Sidecar: binary copy of ASCII tables (see read_xytable). Returns the spectrum (2D array of waves vs. flux), the date and the S/N
+def Ingest_Spectrum(filepath, S2Nblue, S2Nred, MJDHeader=None, CleanCos=False, Renormalise=False, NormPoints=[], NormClipItr=0, NormClipSigma=3., SkipLines=1, Sidecar=False):
+    spec, MJD = Ingest_Read(filepath, MJDHeader, SkipLines, Sidecar)
+    SpecNorm, S2N = Ingest_Preprocess(spec, S2Nblue, S2Nred, CleanCos, Renormalise, NormPoints, NormClipItr, NormClipSigma)
+    return SpecNorm, MJD, S2N
+
+
+# Reading part of Ingest_Spectrum (file I/O): returns the spectrum and the date
+def Ingest_Read(filepath, MJDHeader=None, SkipLines=1, Sidecar=False):
+    if str(filepath.split('.')[-1]) in ['fits', 'fit']:
+# FITS: spectrum and date from a single opening of the file
+        wave, flux, MJD, err = read_fits_spectrum(filepath, MJDHeader)
+        return np.array([wave, np.nan_to_num(flux,1.)]).T, MJD
+    MJD = None if MJDHeader is None else fits.getheader(filepath)[MJDHeader]
+    return read_file(filepath, SkipLines=SkipLines, Sidecar=Sidecar), MJD
+
+
+# Preprocessing part of Ingest_Spectrum (computation): returns the cleaned / re-normalised spectrum and the S/N
+def Ingest_Preprocess(spec, S2Nblue, S2Nred, CleanCos=False, Renormalise=False, NormPoints=[], NormClipItr=0, NormClipSigma=3.):
+# Small script for cleaning spectra of cosmics; use at own risk!
+    if CleanCos:
+        print("Cleaning Cosmics...")
+        SpecClean = Cosclean(np.copy(spec))
+    else:
+        SpecClean = np.copy(spec)
+    if Renormalise:
+        SpecNorm = Normalise(np.copy(SpecClean), points=NormPoints, ClipItr=NormClipItr, ClipSigma=NormClipSigma)
+    else:
+        SpecNorm = np.copy(SpecClean)
+    S2Nrange = (SpecNorm[:,0] > S2Nblue) * (SpecNorm[:,0] < S2Nred)
+    return SpecNorm, 1./np.std(spec[S2Nrange,1])
+
+
+# Binary cache of ingested spectra in directory CacheDir: <key>.npy = spectrum (memory-mapped when loaded), <key>.json = date and S/N.
+# The key is a hash of the absolute file path, its modification time and size, and the preprocessing settings (arguments of Ingest_Spectrum),
+# i.e. changed files or settings are ingested anew. Increase IngestCacheVersion if the ingestion itself changes.
+IngestCacheVersion = 1
+
+def Ingest_Cache_Key(filepath, Settings):
+    Stat = os.stat(filepath)
+    h = hashlib.sha1()
+    Hash_Update(h, [IngestCacheVersion, os.path.abspath(filepath), Stat.st_mtime_ns, Stat.st_size, Settings])
+    return h.hexdigest()
+
+
+# Returns the cached (spectrum, date, S/N) of filepath, or None if not in the cache
+def Ingest_Cache_Load(filepath, CacheDir, Settings):
+    Key = Ingest_Cache_Key(filepath, Settings)
+    try:
+        Meta = json.load(open(os.path.join(CacheDir, Key + '.json')))
+        return np.load(os.path.join(CacheDir, Key + '.npy'), mmap_mode='r'), Meta['MJD'], Meta['S2N']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def Ingest_Cache_Store(filepath, CacheDir, Settings, spec, MJD, S2N):
+    Key = Ingest_Cache_Key(filepath, Settings)
+    SpecFile, MetaFile = os.path.join(CacheDir, Key + '.npy'), os.path.join(CacheDir, Key + '.json')
+    os.makedirs(CacheDir, exist_ok=True)
+# Written to temporary files first; the entry counts as present once its .json exists
+    with open(SpecFile + '.tmp', 'wb') as f:
+        np.save(f, spec)
+    os.replace(SpecFile + '.tmp', SpecFile)
+    json.dump({'File': os.path.abspath(filepath), 'MJD': None if MJD is None else float(MJD), 'S2N': float(S2N)}, open(MetaFile + '.tmp', 'w'))
+    os.replace(MetaFile + '.tmp', MetaFile)
+
+
+def Ingest_Read_Timed(filepath, MJDHeader, SkipLines, Sidecar=False):
+    t0 = time.perf_counter()
+    return Ingest_Read(filepath, MJDHeader, SkipLines, Sidecar) + (time.perf_counter() - t0,)
+
+
+def Ingest_Preprocess_Timed(Args):
+    t0 = time.perf_counter()
+    return Ingest_Preprocess(*Args) + (time.perf_counter() - t0,)
+
+
+# Ingests all spectra specnames (see Ingest_Spectrum; cached in CacheDir if not None); returns the list of spectra and arrays of dates and S/N,
+# in the order of specnames. Files not in the cache are read by NumThreads threads (I/O) and cleaned of cosmics / renormalised by NumWorkers
+# processes (requires the 'fork' start method); serially, the renormalisation is done for all of them at once (Normalise_Batch). 
+# The time spent per file is printed.
+def Ingest_Spectra(specnames, CacheDir=None, NumThreads=1, NumWorkers=1, **Settings):
+    Ingested = [None if CacheDir is None else Ingest_Cache_Load(filepath, CacheDir, Settings) for filepath in specnames]
+    Todo = [i for i in np.arange(len(specnames)) if Ingested[i] is None]
+    ReadArgs = [[specnames[i] for i in Todo], [Settings.get('MJDHeader')]*len(Todo), [Settings.get('SkipLines', 1)]*len(Todo), [Settings.get('Sidecar', False)]*len(Todo)]
+    if NumThreads > 1:
+        with ThreadPoolExecutor(max_workers=NumThreads) as Pool:
+            Read = list(Pool.map(Ingest_Read_Timed, *ReadArgs))
+    else:
+        Read = list(map(Ingest_Read_Timed, *ReadArgs))
+    Renormalise = Settings.get('Renormalise', False)
+    Parallel = NumWorkers > 1 and len(Todo) > 1 and (Settings.get('CleanCos', False) or Renormalise)
+    if Parallel and 'fork' not in multiprocessing.get_all_start_methods():
+        print("WARNING: parallel preprocessing requires the 'fork' start method, which is not available; running serially")
+        Parallel = False
+    PrepArgs = [(spec, Settings['S2Nblue'], Settings['S2Nred'], Settings.get('CleanCos', False)) for spec, MJD, t in Read]
+    if Parallel:
+        PrepArgs = [Args + (Renormalise, Settings.get('NormPoints', []), Settings.get('NormClipItr', 0), Settings.get('NormClipSigma', 3.)) for Args in PrepArgs]
+        with ProcessPoolExecutor(max_workers=NumWorkers, mp_context=multiprocessing.get_context('fork')) as Pool:
+            Prep = list(Pool.map(Ingest_Preprocess_Timed, PrepArgs))
+    else:
+        Prep = list(map(Ingest_Preprocess_Timed, PrepArgs))
+    if Renormalise and not Parallel and len(Todo) > 0:
+        t0 = time.perf_counter()
+        SpecsNorm = Normalise_Batch([Entry[0] for Entry in Prep], Settings.get('NormPoints', []), Settings.get('NormClipItr', 0), Settings.get('NormClipSigma', 3.))
+        print("Renormalised " + str(len(Todo)) + " spectra: " + str(np.round(time.perf_counter() - t0, 3)) + " s")
+        Prep = [(SpecNorm,) + Entry[1:] for SpecNorm, Entry in zip(SpecsNorm, Prep)]
+    for i, (spec, MJD, tRead), (SpecNorm, S2N, tPrep) in zip(Todo, Read, Prep):
+        Ingested[i] = (SpecNorm, MJD, S2N)
+        print("Ingested " + specnames[i] + ": read " + str(np.round(tRead, 3)) + " s, preprocessed " + str(np.round(tPrep, 3)) + " s")
+        if CacheDir is not None:
+            Ingest_Cache_Store(specnames[i], CacheDir, Settings, SpecNorm, MJD, S2N)
+    print("Ingested " + str(len(specnames)) + " spectra (" + str(len(specnames) - len(Todo)) + " from cache)")
+    return [Entry[0] for Entry in Ingested], np.array([Entry[1] for Entry in Ingested]), np.array([Entry[2] for Entry in Ingested])
 
 
 # Flexible read_file function, credit @ Julia Bodensteiner
-def read_file(infile, SkipLines=0):
+# Sidecar: ASCII tables are also kept as binary .npy copies (see read_xytable)
+def read_file(infile, SkipLines=0, Sidecar=False):
     ext = str(infile.split('.')[-1])
     if (ext == 'fits') or (ext ==  'fit'):
         wave, flux = read_fits(infile)
@@ -937,7 +2088,7 @@ def read_file(infile, SkipLines=0):
         wave, flux = read_tlusty(infile)
 
     elif (ext == 'dat' or ext == 'ascii' or ext == 'txt' or ext == 'nspec'):
-        wave, flux = read_xytable(infile, SkipLines=SkipLines)
+        wave, flux = read_xytable(infile, SkipLines=SkipLines, Sidecar=Sidecar)
 
     elif (ext == 'tfits'):
         wave, flux = read_uvespop(infile)
@@ -945,116 +2096,250 @@ def read_file(infile, SkipLines=0):
     elif (ext == 'hfits'):
         wave, flux = read_hermes_normalized(infile)
 
+    elif (ext == 'npy'):
+        spec = np.load(infile)
+        wave, flux = spec[:,0], spec[:,1]
+
     else:
-        wave, flux = read_xytable(infile, SkipLines=SkipLines)
+        wave, flux = read_xytable(infile, SkipLines=SkipLines, Sidecar=Sidecar)
     return np.array([wave, np.nan_to_num(flux,1.)]).T
 
-def read_fits(infile):
+# Reads a FITS spectrum opening the file only once (memory-mapped): the instrument reader is chosen from the primary header (Fits_Reader), 
+# the date is taken from keyword MJDHeader of the same header (None: no date). Returns wave, flux, date and error (None if not in the file).
+def read_fits_spectrum(infile, MJDHeader=None):
     print("%s: Input file is a fits file." % infile)
+    with fits.open(infile, memmap=True) as hdul:
+        header = hdul[0].header
+        wave, flux, err = Fits_Reader(infile, header)(infile, hdul)
+        MJD = None if MJDHeader is None else header[MJDHeader]
+# Copies, such that the arrays do not refer to the closed file
+        return np.array(wave, dtype=float), np.array(flux, dtype=float), MJD, None if err is None else np.array(err, dtype=float)
 
-    header = fits.getheader(infile)
 
+def read_fits(infile):
+    wave, flux, MJD, err = read_fits_spectrum(infile)
+    return wave, flux
+
+
+# Instrument reader for a FITS file with primary header header; the readers take the file name and the open HDU list and return wave, flux, error
+def Fits_Reader(infile, header):
     if 'HIERARCH SPECTRUM EXTRACTION' in header:
-        wave, flux = read_psfSpec(infile)
+        return read_psfSpec
 
     elif 'INSTRUME' in header:
         ins = header['INSTRUME']
         if (ins == 'MUSE'):
-            wave, flux = read_pampelMUSE(infile)
+            return read_pampelMUSE
 
         elif (ins == 'HERMES'):
-            wave, flux = read_HERMES(infile)
+            return read_HERMES
 
         elif (ins == 'FEROS'):
-            wave, flux = read_FEROS(infile)
+            return read_FEROS
         elif (ins == 'XSHOOTER'):
-            wave, flux = read_XSHOOTER(infile)
+            return read_XSHOOTER
         elif (ins == 'UVES'):
-            wave, flux = read_UVES(infile)
+            return read_UVES
         elif (ins == 'UVES_STITCH'):
-            wave, flux = read_UVES_STITCH(infile)                    
+            return read_UVES_STITCH
         elif (ins == 'GIRAFFE' and 'nLR' in infile):
-            wave, flux = read_GIRAFFE(infile)     
+            return read_GIRAFFE
         elif (ins == 'GIRAFFE'):
-            #wave, flux = read_GIRAFFE(infile)               
-            wave, flux = read_GIRAFFE2(infile)               
+            #return read_GIRAFFE
+            return read_GIRAFFE2
         elif (ins == 'ESPCOUDE'):
-            wave, flux = read_NLA(infile)   
+            return read_NLA
         elif (ins == 'COS'):
-            wave, flux = read_COS(infile)               
+            return read_COS
         elif (ins == 'STIS'):
-            wave, flux = read_STIS(infile)              
+            return read_STIS
         else:
             print('File type unkown, trying HERMES')
-            wave, flux = read_HERMES(infile)                        
+            return read_HERMES
     else:
-        wave, flux = read_HERMES(infile)
+        return read_HERMES
 
-    return wave, flux
 
-def read_xytable(infile, SkipLines=0):
+# Data of table extension hdu of an open FITS file (hdu=None or not a table: first table extension, as Table.read)
+def Fits_Table(hdul, hdu=None):
+    if hdu is not None and isinstance(hdul[hdu], (fits.BinTableHDU, fits.TableHDU)):
+        return hdul[hdu].data
+    return [HDU for HDU in hdul if isinstance(HDU, (fits.BinTableHDU, fits.TableHDU))][0].data
+
+# Reads the columns Columns of a whitespace-separated numeric table (e.g. wave, flux), skipping the first SkipLines lines; returns wave, flux.
+# Sidecar --> the table is also written to infile + '.skip<SkipLines>.npy' and read from there as long as it is newer than infile.
+def read_xytable(infile, SkipLines=0, Columns=(0, 1), Sidecar=False):
     print(("%s: Input file is an xytable file." % infile))    
-    #spec = (pd.read_csv(infile, sep=" ", header=0)).values   
-    spec = (pd.read_csv(infile, header=None, delim_whitespace=True, skiprows=SkipLines)).values    
-    wave = spec[:,0]
-    flux = spec[:,1]    
+    SidecarFile = infile + '.skip' + str(SkipLines) + '.npy'
+    if Sidecar and os.path.exists(SidecarFile) and os.path.getmtime(SidecarFile) >= os.path.getmtime(infile):
+        spec = np.load(SidecarFile, mmap_mode='r')
+    else:
+        spec = Read_Columns(infile, SkipLines=SkipLines)
+        if Sidecar:
+            try:
+                np.save(SidecarFile, spec)
+            except OSError:
+                print("WARNING: could not write " + SidecarFile)
+    wave = np.array(spec[:,Columns[0]])
+    flux = np.array(spec[:,Columns[1]])
     return wave, flux
 
-def read_GIRAFFE2(infile):
+
+# Parser of whitespace-separated numeric tables (read_xytable), read in blocks of about ChunkBytes; returns array (rows x columns).
+# Per block: fixed-width lines --> Parse_Fixed_Width; else, if every line has the same number of columns, all tokens are converted at once;
+# else (e.g. comment lines starting with '#', blank lines, ragged rows) the block is parsed line by line and short rows are padded with nan.
+def Read_Columns(infile, SkipLines=0, ChunkBytes=2**24):
+    Chunks = []
+    with open(infile, 'rb') as f:
+        for i in range(SkipLines):
+            f.readline()
+        while True:
+            Block = f.read(ChunkBytes) + f.readline()
+            if len(Block) == 0:
+                break
+            if not Block.endswith(b'\n'):
+                Block += b'\n'
+            Chunks.append(Parse_Block(Block))
+    Chunks = [Chunk for Chunk in Chunks if len(Chunk) > 0]
+    if len(Chunks) == 0:
+        return np.zeros((0, 2))
+    NumCols = max([Chunk.shape[1] for Chunk in Chunks])
+    return np.concatenate([np.pad(Chunk, ((0, 0), (0, NumCols - Chunk.shape[1])), constant_values=np.nan) for Chunk in Chunks])
+
+
+def Parse_Block(Block):
+    LineLen = Block.index(b'\n') + 1
+    if len(Block) % LineLen == 0:
+        Arr = np.frombuffer(Block, dtype=np.uint8).reshape(-1, LineLen)
+        if np.all(Arr[:, -1] == 10):
+            Tab = Parse_Fixed_Width(Arr)
+            if Tab is not None:
+                return Tab
+    Tokens = Block.split()
+    NumCols = len(Block[:LineLen].split())
+    if NumCols > 0 and len(Tokens) == NumCols * Block.count(b'\n'):
+        try:
+            return np.array(Tokens, dtype=float).reshape(-1, NumCols)
+        except ValueError:
+            pass
+    Rows = [[float(Token) for Token in Line.split()] for Line in Block.splitlines() if Line.strip() and not Line.lstrip().startswith(b'#')]
+    Tab = np.full((len(Rows), max([len(Row) for Row in Rows] + [0])), np.nan)
+    for j, Row in enumerate(Rows):
+        Tab[j, :len(Row)] = Row
+    return Tab
+
+
+# Fast path of Read_Columns for fixed-width tables, Arr = lines as array of bytes (lines x characters; e.g. np.savetxt with fmt='% .14e').
+# If the digits, decimal points and exponent markers of all lines are at the positions of the first line (signs or blanks before the numbers
+# and their exponents, blanks elsewhere), the numbers are assembled from their digit columns with array operations. The result is only exact
+# (identical to float()) for mantissas < 2**53 and decimal exponents within +-22; otherwise (e.g. fmt='% .18e') the block is not parsed here.
+# Returns array (rows x columns), or None if the lines do not share the layout of the first line or a number cannot be assembled exactly.
+def Parse_Fixed_Width(Arr):
+    Text = Arr[0].tobytes()
+    Layout = np.zeros(len(Text), dtype=bool)
+    SignCols, Cols, Pos = [], [], 0
+    for Token in Text.split():
+        Number = Token.lstrip(b'+-')
+        Start = Text.index(Token, Pos) + len(Token) - len(Number)
+        Pos = Start + len(Number)
+        Mant, E, Exp = Number.lower().partition(b'e')
+        Int, Dot, Frac = Mant.partition(b'.')
+        if not (Int + Frac).isdigit() or len(Int + Frac) > 19 or (E and not Exp.lstrip(b'+-').isdigit()) or Start == 0:
+            return None
+        Layout[Start:Pos] = True
+        SignCols.append(Start - 1)
+        ExpSignCol = Start + len(Mant) + 1 if Exp[:1] in [b'+', b'-'] else None
+        if ExpSignCol is not None:
+            Layout[ExpSignCol] = False
+            SignCols.append(ExpSignCol)
+        Cols.append((Start - 1, [Start + j for j, c in enumerate(Mant) if c != ord('.')], len(Frac), 
+                     [Start + len(Mant) + 1 + j for j, c in enumerate(Exp) if c not in b'+-'], ExpSignCol))
+    IsDig = (Arr[0] >= 48) * (Arr[0] <= 57)
+    DigCols, MarkCols = np.where(Layout * IsDig)[0], np.where(Layout * ~IsDig)[0]
+    BlankCols = np.setdiff1d(np.where(~Layout)[0], SignCols)
+    Digits = Arr[:, DigCols].T - 48
+    Signs, Blanks = Arr[:, SignCols], Arr[:, BlankCols]
+    if not (np.all(Digits <= 9) and np.all(Arr[:, MarkCols] == Arr[0, MarkCols]) and np.all(np.isin(Signs, [32, 9, 43, 45]))
+            and np.all(np.isin(Blanks, [32, 9, 10, 13]))):
+        return None
+    Row = {Col: Digits[j] for j, Col in enumerate(DigCols)}
+    Values = []
+    for SignCol, MantCols, NumFrac, ExpCols, ExpSignCol in Cols:
+        Mant = np.zeros(len(Arr), dtype=np.uint64)
+        for Col in MantCols:
+            Mant = Mant*np.uint64(10) + Row[Col]
+        Exp = np.zeros(len(Arr), dtype=np.int64)
+        for Col in ExpCols:
+            Exp = Exp*10 + Row[Col]
+        if ExpSignCol is not None:
+            Exp[Arr[:, ExpSignCol] == 45] *= -1
+        Exp -= NumFrac
+        if np.any(Mant >= np.uint64(2**53)) or np.any(np.abs(Exp) > 22):
+            return None
+        Val = np.where(Exp >= 0, Mant * 10.**np.maximum(Exp, 0), Mant / 10.**np.maximum(-Exp, 0))
+        Val[Arr[:, SignCol] == 45] *= -1
+        Values.append(Val)
+    return np.array(Values).T
+
+
+def read_GIRAFFE2(infile, hdul):
     print("%s: Input file is a GIRAFFE2 file." % infile)
     hdunum=1
-    header = fits.getheader(infile)
-    hdul = fits.open(infile)
-    table = Table.read(infile, hdu=hdunum)
+    table = Fits_Table(hdul, hdunum)
     wave = table['WAVE'][0]*10.
     flux = table['FLUX_REDUCED'][0]    
-    return wave, flux
+    err = table['ERR_REDUCED'][0] if 'ERR_REDUCED' in table.names else None
+    return wave, flux, err
 
 
-def read_UVES_STITCH(infile):
+def read_UVES_STITCH(infile, hdul):
     print("%s: Input file is a stitched UVES file" % infile)
-    table = Table.read(infile, hdu=1)
+    table = Fits_Table(hdul, 1)
     wave = table['WAVE']
     flux = table['FLUX']
-    return wave, flux
+    err = table['ERR'] if 'ERR' in table.names else None
+    return wave, flux, err
         
 
-def read_UVES(infile):
+def read_UVES(infile, hdul):
     print("%s: Input file is a UVES or GIRAFFE file." % infile)
-    header = fits.getheader(infile)
+    header = hdul[0].header
+    err = None
     if 'SPEC_COM' in header:
         print('a')
-        table = Table.read(infile, hdu=1)
+        table = Fits_Table(hdul, 1)
         wave = table['wave']
         flux = table['FLUX_REDUCED']
     elif 'CRVAL1' in header:
         print('b')
-        flux = fits.getdata(infile)
+        flux = hdul[0].data
         crval = header['CRVAL1']
         cdelt = header['CDELT1']
         naxis1 = header['NAXIS1']
         wave = crval + np.arange(0, naxis1) * cdelt
     else:
         print('c')
-        table = Table.read(infile, hdu=0)
+        table = Fits_Table(hdul, 0)
         try:
             wave = table['WAVE'][0]
         except:
             wave = table['LAMBDA'][0] 
         try:
             flux = table['FLUX_REDUCED'][0]
+            err = table['ERR_REDUCED'][0] if 'ERR_REDUCED' in table.names else None
         except:
             flux = table['FLUX'][0]    
+            err = table['ERR'][0] if 'ERR' in table.names else None
     if wave[0] < 1000:  # wavelength is given in nm
         wave = wave * 10 # convert wavelength to A
-    return wave, flux        
+    return wave, flux, err        
         
 
-def read_pampelMUSE(infile):
+def read_pampelMUSE(infile, hdul):
     print(("%s: Input file is a pampelMUSE file." % infile))
-    header = fits.getheader(infile)
-    flux = fits.getdata(infile, ext=0)
-    #err = fits.getdata(infile, ext=1)
+    header = hdul[0].header
+    flux = hdul[0].data
+    err = hdul[1].data if len(hdul) > 1 and isinstance(hdul[1], fits.ImageHDU) else None
     wl0 = header['CRVAL1']  # Starting wl at CRPIX1
     delt = header['CDELT1']  # Stepwidth of wl
     pix = header['CRPIX1']  # Reference Pixel
@@ -1062,7 +2347,6 @@ def read_pampelMUSE(infile):
 
     # because pampelmuse gives the wl in m --> convert to A
     #wave = wave 
-    #flux_out = flux, err
 
-    return wave, flux
+    return wave, flux, err
 
@@ -57,6 +57,19 @@ ObsFormat = 'TXT'
 #Only important if ObsFormat='FITS'
 MJDHeader = 'MJD-OBS'
 
+# Directory for a binary cache of the read (and cleaned / re-normalised) spectra, their dates and S/N; repeated runs on the same files
+# (e.g. for other ranges or orders) load them from the cache. Files that changed, or changed settings, are read anew. None: no cache.
+IngestCacheDir = None
+
+# Keep a binary copy (<file>.skip<N>.npy, next to the file) of ASCII spectra, read instead of the text file as long as it is newer than the file
+ASCIISidecar = False
+
+# Parallel ingestion of the spectra (1 = serial): IngestThreads threads read the files, IngestWorkers processes clean / re-normalise them
+# (only used if CleanCos or Renormalise; requires the 'fork' start method). With IngestWorkers = 1, the spectra are re-normalised all at once
+# (Normalise_Batch). The order of the spectra and dates does not depend on these settings.
+IngestThreads = 1
+IngestWorkers = 1
+
 
 
 ###############################
@@ -175,6 +188,27 @@ DenseKArr = [1, 1, 12, 1]
 IniFacKArr = [0.1, 0.1, 0.1, .3]
 FinFacKArr = [2., 2., 2., 2.]
 
+# Grid over orbital parameters instead of the K grid above (binaries and triples): dict of parameter name (keys of Orbital_Params, 
+# e.g. 'ecc', 'omega', 'T0', 'Gamma', 'K1', 'K2') --> array of values; parameters not in the dict are fixed to Orbital_Params. 
+# Non-physical combinations (e.g. ecc >= 1) are skipped. The best values are used for the final separation. {} = K grid above.
+# Not combined with AdaptiveGrid / OptimizeK / GridKBlock. Example: OrbitGrid = {'ecc': np.linspace(0.2, 0.4, 5), 'omega': np.linspace(40., 80., 5)}
+OrbitGrid = {}
+
+# Adaptive (coarse-to-fine) grid search: the grid above is first evaluated with AdaptiveItrCoarse iterations only; then finer grids 
+# (+- one step around the current minimum) are evaluated with itrnumlim iterations, until the K steps are below AdaptiveKTol [km/s].
+# The final fine grid is saved (grid_dis_K1K2.txt etc.) and used for the K errors. AdaptiveKTol should not be much smaller than the expected K errors.
+AdaptiveGrid = False
+AdaptiveKTol = 1.
+AdaptiveItrCoarse = 10
+
+# Direct minimisation of chi2 over the Ks (Brent for one free K, Nelder-Mead for several) instead of a grid search. 
+# The search is confined to the K ranges defined above and starts at the K values given in Orbital_Params; K errors are derived from the
+# chi2 curvature, with step = grid step above. Each evaluation starts from the best spectra found so far --> use EpsTol > 0.
+# OptimizeKTol = tolerance on K [km/s], OptimizeMaxEval = maximum number of chi2 evaluations. Evaluations are stored in the optimize_K.txt file.
+OptimizeK = False
+OptimizeKTol = 0.5
+OptimizeMaxEval = 200
+
 
 
 # Number of iterations
@@ -189,6 +223,50 @@ FinFacKArr = [2., 2., 2., 2.]
 itrnumlim =30
 NumItrFinal = 1000
 
+# Optional convergence criterion: iterations stop before itrnumlim / NumItrFinal once EPS < EpsTol (EPS as in PLOTCONV below).
+# EpsTol = 0 --> always perform itrnumlim / NumItrFinal iterations. Use PLOTCONV to find a sensible value for your data.
+# Note: with StrictNeg = True, EPS typically levels off at a floor (small oscillations of the clipped pixels); EpsTol must lie above it.
+# The number of iterations used per K1,K2 pair is written to the output directory (grid_dis_itrs files).
+EpsTol = 0.
+
+# Optional extrapolation of the iterations to reduce the number of sweeps: None, 'Aitken' or 'Anderson'.
+# Only useful in combination with EpsTol > 0.
+Accelerate = None
+
+# Warm start for grid disentangling: the K grid is walked in serpentine order, and each grid point starts from the converged
+# spectra of the previous (neighbouring) grid point instead of a flat spectrum. 
+# Only use in combination with EpsTol > 0: with a fixed number of iterations, results would depend on the walking order.
+WarmStart = False
+
+# Number of processes over which the K grid points are distributed (1 = serial). The chi2 map is identical to the serial one.
+# WarmStart is only used for serial grids (GridWorkers = 1).
+# Plots of PLOTEXTREMES / PLOTFITS are produced after the grid is done; PLOTCONV / PLOTITR are ignored for GridWorkers > 1.
+# Requires the 'fork' start method (Linux, macOS); otherwise the grid runs serially.
+GridWorkers = 1
+
+# Checkpointing of the grid: chi2 of each K grid point is written to disk as soon as it is done (directory <Range>_grid_store_K1K2[K3] in the output directory).
+# If the run is interrupted, rerunning with identical input continues where it stopped; changed input (spectra, ranges, settings) starts a new grid.
+# Not used for AdaptiveGrid / OptimizeK.
+GridCheckpoint = False
+
+# Number of K2 values of a K1 row of the (binary) grid that are disentangled together in one array pass (0 or 1: one by one).
+# The primary-frame observations are then shifted only once per block. Requires DisEngine = 'classic' / 'sparse' / 'batched' with 
+# InterKind='linear' and no Accelerate; memory ~ 24 bytes * KBlock * epochs * pixels per shift table.
+GridKBlock = 0
+
+# Jackknife / bootstrap errors over the epochs (K grid or OrbitGrid; not for AdaptiveGrid / OptimizeK): the chi2 contribution of every epoch is stored 
+# at each grid point, and the chi2 maps of the resampled epochs are obtained by reweighting (spectra disentangled from all epochs; approximation).
+# ResampleNumBoot = number of bootstrap resamples; ResampleNumFull = number of them that are also fully re-disentangled (in GridWorkers 
+# processes) to check the approximation. Results: grid_resample.txt in the output directory.
+GridResample = False
+ResampleNumBoot = 200
+ResampleNumFull = 0
+
+# Memory cap [MB] of the cache of observed spectra shifted to the frames of the components (reused across iterations, grid points and chi2; 0: off).
+# Velocities are matched to ShiftCacheVelRound km/s.
+ShiftCacheMB = 256
+ShiftCacheVelRound = 1E-6
+
 
 # If StrictNegA = True, enforce disentangled spectra to be below continuum except for prespecified regions (given in array).
 # Below continuum = ForceNegSigma "sigmas" below continuum. 
@@ -300,6 +378,33 @@ N_Iteration_Plot = 100
 # 'cubic' performs better, but is slower. 
 InterKind='cubic'
 
+# Engine used for the shift-and-add iterations:
+# 'classic': builds interp1d objects for every epoch in every iteration (supports all InterKind options)
+# 'sparse': builds sparse interpolation operators once per K1,K2 pair; each iteration is a sparse mat-vec.
+# 'batched': stores the shifted observations as (epochs x pixels) arrays; all epochs are shifted with one precomputed
+#           gather-and-lerp and co-added with a single weights @ residuals product. Fastest for many epochs.
+# 'loglam': like 'batched', but the iterations run on a log-wavelength grid, on which every RV shift is a constant pixel offset per epoch
+#           (precomputed two-tap stencil). Output spectra and chi2 are on the usual wavelength grid.
+# 'fourier': no iterations; the component spectra are solved for directly (least squares per Fourier mode of the log-wavelength spectra),
+#           StrictNeg / PosLimCond are applied to the solution. Much faster than shift-and-add when many iterations are needed.
+#           itrnumlim, NumItrFinal, EpsTol, Accelerate and InterKind are not used.
+# 'lsqr': no iterations; the whole (weighted) system of all epochs is assembled as one sparse matrix from the shift operators and solved
+#           directly by sparse least squares (LSQR, at most itrnumlim / NumItrFinal LSQR iterations, linear interpolation),
+#           StrictNeg / PosLimCond are applied to the solution. EpsTol, Accelerate and InterKind are not used.
+# 'sparse' and 'batched' give identical results to 'classic' for InterKind='linear' (other InterKind --> falls back to 'classic')
+DisEngine = 'classic'
+
+# Options for DisEngine = 'loglam' (LogOversample also for 'fourier'): 
+# LogOversample: the log grid step is the smallest (relative) pixel step of the wavelength grid divided by LogOversample
+# LogIntShift: round the pixel offsets to integers (pure index shifts, no interpolation; accuracy = half the pixel velocity step,
+#              so combine with LogOversample > 1). The K grids are then snapped to multiples of the pixel velocity step.
+LogOversample = 1
+LogIntShift = False
+
+# Options for DisEngine = 'lsqr':
+# LsqrDamp: Tikhonov damping of the least-squares solution (0 = none; small positive values stabilise poor phase coverage)
+LsqrDamp = 0.
+
 # Region for fitting parabola of chi2 in index steps from minimum
 ParbSize=2
 
@@ -475,11 +580,16 @@ Ranges = Rangelists[Rangestr]
 
 #Clean cosmics?
 CleanCos = False
+# If CleanCos: additionally clean cosmics using the other epochs as reference (median of the other epochs; requires >= 3 epochs)
+CleanCosStack = False
 
 
 #Renormalise spectra at pre-specified points. 
 Renormalise = False
 NormPoints = [3961., 4006., 4016., 4038., 4088., 4116., 4129., 4138., 4154., 4195., 4210., 4328., 4362., 4386., 4400., 4462., 4490., 4494., 4530., 4557., 4560]
+# Sigma-clipping of the continuum windows around NormPoints: number of iterations (0 = no clipping) and threshold in standard deviations
+NormClipItr = 0
+NormClipSigma = 3.
 
 # Nebular line handling?
 NebLines = False
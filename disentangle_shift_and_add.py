@@ -1,11 +1,10 @@
 # shift-and-add & grid disentangling, by Tomer Shenar, with contributions from Matthias Fabry & Julia Bodensteiner
 # 11.09.2023, V2.0; feel free to contact at T.Shenar@uva.nl or tomer.shenar@gmail.com for questions/inquires
 # Algorithm and examples in Gonzales & Levato 2006, A&A, 448, 283; Shenar et al. 2021, A&A, 639, 6; Shenar et al. 2022, A&A, 665, 148
-# Current version only applicable for binaries and triples (no quadruples yet, although structure is there). 
+# Applicable for binaries, triples and 2+2 quadruples (grid search of K only for binaries and triples). 
 # Input: input file and observed spectra.
 # Output: chi2 map on K1,K2,K3 plane (if requested) and separated spectra.
 # See "input file" for more documentation
-# Coming up in upcoming versions: Quadruples and nebular contamination. 
 
 from Input_disentangle import *
 from Disentangling.disentangle_functions import *
@@ -13,6 +12,8 @@ from Disentangling.disentangle_functions import *
 if not os.path.exists(f'{Output_dir}'):
     os.mkdir(f'{Output_dir}')
 
+Shift_Cache_Setup(ShiftCacheMB, ShiftCacheVelRound)
+
 ##################################################################
 ####### READING OF DATA --- USER POTENTIALLY NEEDS TO EDIT #######
 ##################################################################
@@ -38,8 +39,8 @@ if PLOTITR and PLOTCONV:
 if PLOTEXTREMES and PLOTFITS:
     print("ERROR: avoid having both PLOTEXTREMES and PLOTFITS true")
     sys.exit("Exit in disentangle_shift_and_add.py")
-if CompNum > 3:
-    print("ERROR: Can't handle more than three components with current version.")
+if CompNum > 4:
+    print("ERROR: Can't handle more than four components with current version.")
     sys.exit("Exit in disentangle_shift_and_add.py")
 
 # vector of light ratios l1, l2, l3, l4
@@ -58,35 +59,16 @@ elif CompNum==4:
         sys.exit()
         
 
-S2Ns = []
-ObsSpecs = []
-# Read spectra and potentially dates
-for i, filepath in enumerate(specnames):
-# If fits, read dates as well    
-    if ObsFormat=='FITS':
-        header = fits.getheader(filepath)
-        MJDs = np.append(MJDs, header[MJDHeader])
-# read_file returns a 2D array of waves vs. flux for given file path. User can edit "read_file" function if needed.
-    spec = read_file(filepath, SkipLines=1)
-# Small script for cleaning spectra of cosmics; use at own risk!
-    if CleanCos:
-        print("Cleaning Cosmics...")
-        SpecClean = Cosclean(np.copy(spec))
-    else:
-        SpecClean = np.copy(spec)
-# Can also re-normalise spectra... better avoid
-    if Renormalise and GridDis:
-        SpecNorm = Normalise(np.copy(SpecClean), points=NormPoints)
-    else:
-        SpecNorm= np.copy(SpecClean)
-    ObsSpecs.append(SpecNorm)
-# Compute S2N of spectrum in prespecified range
-    waves = SpecNorm[:,0]
-    fluxes = SpecNorm[:,1]
-    S2Nrange  = (waves > S2Nblue) * (waves < S2Nred)
-    S2Ns.append(1./np.std(spec[S2Nrange,1]))
-
-S2Ns = np.array(S2Ns)
+# Read spectra and potentially dates (if fits); read_file (see Ingest_Spectrum) returns a 2D array of waves vs. flux for given file path. 
+# User can edit "read_file" function if needed. Cosmics are cleaned if CleanCos; spectra are re-normalised if Renormalise (better avoid).
+# Ingested spectra are cached in IngestCacheDir (if not None) for later runs; IngestThreads / IngestWorkers = parallel reading / preprocessing.
+ObsSpecs, MJDsHeader, S2Ns = Ingest_Spectra(specnames, CacheDir=IngestCacheDir, NumThreads=IngestThreads, NumWorkers=IngestWorkers, S2Nblue=S2Nblue, S2Nred=S2Nred, MJDHeader=MJDHeader if ObsFormat=='FITS' else None, 
+                                            CleanCos=CleanCos, Renormalise=Renormalise and GridDis, NormPoints=NormPoints, NormClipItr=NormClipItr, NormClipSigma=NormClipSigma, SkipLines=1, Sidecar=ASCIISidecar)
+if ObsFormat=='FITS':
+    MJDs = MJDsHeader
+if CleanCos and CleanCosStack:
+    print("Cleaning Cosmics against the other epochs...")
+    ObsSpecs = Cosclean_Stack(ObsSpecs)
 
 # Form array of "force negativity" conditions
 StrictNeg = [StrictNegA, StrictNegB, StrictNegC, StrictNegD]
@@ -94,18 +76,14 @@ PosLimCond = [PosLimCondA, PosLimCondB, PosLimCondC, PosLimCondD, PosLimCondNeb]
     
     
 # Compute true anomalies of data    
-phisData = (MJDs-Orbital_Params['T0'])/Orbital_Params['Period'] - ((MJDs-Orbital_Params['T0'])/Orbital_Params['Period']).astype(int)
-MsData = 2 * np.pi * phisData
-EsData =  Kepler(1., MsData, Orbital_Params['ecc'])
-eccfac = np.sqrt((1 + Orbital_Params['ecc']) / (1 - Orbital_Params['ecc']))
-nusdata = 2. * np.arctan(eccfac * np.tan(0.5 * EsData))
+phisData, nusdata = Orbit_Anomalies(MJDs, Orbital_Params['Period'], Orbital_Params['T0'], Orbital_Params['ecc'])
 
 #For outer tertiary:
-phisDataOut = (MJDs-Orbital_Params['T0Out'])/Orbital_Params['PeriodOut'] - ((MJDs-Orbital_Params['T0Out'])/Orbital_Params['PeriodOut']).astype(int)
-MsDataOut = 2 * np.pi * phisDataOut
-EsDataOut =  Kepler(1., MsDataOut, Orbital_Params['eccOut'])
-eccfacOut = np.sqrt((1 + Orbital_Params['eccOut']) / (1 - Orbital_Params['eccOut']))
-nusdataOut = 2. * np.arctan(eccfacOut * np.tan(0.5 * EsDataOut))
+phisDataOut, nusdataOut = Orbit_Anomalies(MJDs, Orbital_Params['PeriodOut'], Orbital_Params['T0Out'], Orbital_Params['eccOut'])
+
+#For second binary of quadruples:
+if CompNum==4:
+    phisData2, nusdata2 = Orbit_Anomalies(MJDs, Orbital_Params['Period_2'], Orbital_Params['T0_2'], Orbital_Params['ecc_2'])
 
 
 
@@ -170,6 +148,11 @@ if DenseKArr[3] == 1:
 else:
     K4s = np.linspace(IniFacKArr[3]*Orbital_Params['K4'], FinFacKArr[3]*Orbital_Params['K4'], DenseKArr[3])    
 
+# Integer pixel shifts on the log-wavelength grid: K steps below the pixel velocity step cannot be resolved
+if DisEngine=='loglam' and LogIntShift:
+    K1s, K2s, KOuts = [Snap_K_Grid(Ks, wavegrid, LogOversample) if len(Ks) > 1 else Ks for Ks in [K1s, K2s, KOuts]]
+    print("K grids snapped to the pixel velocity step of the log-wavelength grid:", clight * np.min(np.diff(np.log(wavegrid))) / LogOversample, "km/s")
+
 
 
 # Run main disentangling routine
@@ -178,19 +161,29 @@ if GridDis == True:
 # Compute RVs for comp1, comp2      
    vrads1, vrads2 = v1andv2(nusdata, Orbital_Params)     
    ScalingNeb = np.ones(len(vrads1))
-   if CompNum==2:
+   if len(OrbitGrid) > 0 and CompNum in [2, 3]:
+        Best, Errs = Grid_disentangling_Orbit(waveRanges, OrbitGrid, CompArr[1], Orbital_Params, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, MJDs, specnames, Rangestr, StarName, ScalingNeb, CompNum=CompNum, Ini='B', InterKind=InterKind, itrnumlim = itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, linewidExt=linewidExt,  ParbSize=ParbSize, N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, ExtremesFigSize=ExtremesFigSize, Engine=DisEngine, EpsTol=EpsTol, Accelerate=Accelerate, LogOversample=LogOversample, LogIntShift=LogIntShift, LsqrDamp=LsqrDamp, WarmStart=WarmStart, NumWorkers=GridWorkers, Checkpoint=GridCheckpoint, Resample=GridResample, NumBoot=ResampleNumBoot, NumFullResample=ResampleNumFull)
+        Orbital_Params.update(Best)
+        K1, K2, KOut = Orbital_Params['K1'], Orbital_Params['K2'], Orbital_Params['KOut']
+# Anomalies of the best orbit for the final disentangling
+        phisData, nusdata = Orbit_Anomalies(MJDs, Orbital_Params['Period'], Orbital_Params['T0'], Orbital_Params['ecc'])
+        phisDataOut, nusdataOut = Orbit_Anomalies(MJDs, Orbital_Params['PeriodOut'], Orbital_Params['T0Out'], Orbital_Params['eccOut'])
+   elif CompNum==2:
         kcount_extremeplot = np.argmin(np.abs(K1s - Velo_plot_usrK1_ext)) * len(K2s) + np.argmin(np.abs(K2s - Velo_plot_usrK2_ext))
         kcount_usr = np.argmin(np.abs(K1s - Velo_plot_usrK1)) * len(K2s) + np.argmin(np.abs(K2s - Velo_plot_usrK2))
-        K1, K2 = Grid_disentangling2D(waveRanges, nusdata, CompArr[1], Orbital_Params, K1s, K2s,  ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, MJDs, phisData,  specnames, Rangestr, StarName, ScalingNeb, Ini='B', ShowItr=False,   InterKind=InterKind, itrnumlim = itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt, ParbSize=ParbSize, N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize)
+        K1, K2 = Grid_disentangling2D(waveRanges, nusdata, CompArr[1], Orbital_Params, K1s, K2s,  ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, MJDs, phisData,  specnames, Rangestr, StarName, ScalingNeb, Ini='B', ShowItr=False,   InterKind=InterKind, itrnumlim = itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt, ParbSize=ParbSize, N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, Engine=DisEngine, EpsTol=EpsTol, Accelerate=Accelerate, LogOversample=LogOversample, LogIntShift=LogIntShift, LsqrDamp=LsqrDamp, WarmStart=WarmStart, NumWorkers=GridWorkers, Adaptive=AdaptiveGrid, KTol=AdaptiveKTol, ItrCoarse=AdaptiveItrCoarse, Optimize=OptimizeK, OptKTol=OptimizeKTol, OptMaxEval=OptimizeMaxEval, Checkpoint=GridCheckpoint, KBlock=GridKBlock, Resample=GridResample, NumBoot=ResampleNumBoot, NumFullResample=ResampleNumFull)
         Orbital_Params['K1'] = K1
         Orbital_Params['K2'] = K2        
    elif CompNum==3:
         kcount_extremeplot = np.argmin(np.abs(K1s - Velo_plot_usrK1_ext)) * len(K2s) * len(KOuts) + np.argmin(np.abs(K2s - Velo_plot_usrK2_ext)) * len(KOuts) + np.argmin(np.abs(KOuts - Velo_plot_usrK3_ext))
         kcount_usr = np.argmin(np.abs(K1s - Velo_plot_usrK1)) * len(K2s) * len(KOuts) + np.argmin(np.abs(K2s - Velo_plot_usrK2)) * len(KOuts) + np.argmin(np.abs(KOuts - Velo_plot_usrK3))  
-        K1, K2, KOut = Grid_disentangling3D(waveRanges, nusdata, nusdataOut, CompArr[1], Orbital_Params, K1s, K2s,  KOuts, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  MJDs, phisData, phisDataOut, specnames, Rangestr, StarName, ScalingNeb, Ini='B', ShowItr=False,   InterKind=InterKind, itrnumlim = itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt,  ParbSize=ParbSize, N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize)
+        K1, K2, KOut = Grid_disentangling3D(waveRanges, nusdata, nusdataOut, CompArr[1], Orbital_Params, K1s, K2s,  KOuts, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  MJDs, phisData, phisDataOut, specnames, Rangestr, StarName, ScalingNeb, Ini='B', ShowItr=False,   InterKind=InterKind, itrnumlim = itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=kcount_extremeplot, linewidExt=linewidExt,  ParbSize=ParbSize, N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, NebFac=1, kcount_usr=kcount_usr, ExtremesFigSize=ExtremesFigSize, Engine=DisEngine, EpsTol=EpsTol, Accelerate=Accelerate, LogOversample=LogOversample, LogIntShift=LogIntShift, LsqrDamp=LsqrDamp, WarmStart=WarmStart, NumWorkers=GridWorkers, Adaptive=AdaptiveGrid, KTol=AdaptiveKTol, ItrCoarse=AdaptiveItrCoarse, Optimize=OptimizeK, OptKTol=OptimizeKTol, OptMaxEval=OptimizeMaxEval, Checkpoint=GridCheckpoint, Resample=GridResample, NumBoot=ResampleNumBoot, NumFullResample=ResampleNumFull)
         Orbital_Params['K1'] = K1
         Orbital_Params['K2'] = K2   
         Orbital_Params['KOut'] = KOut
+   elif CompNum==4:
+        print("WARNING: grid disentangling not available for quadruples, using the K values of Orbital_Params")
+        K1, K2, KOut = Orbital_Params['K1'], Orbital_Params['K2'], Orbital_Params['KOut']
 else:  
     PLOTEXTREMES = False
     PLOTFITS = False
@@ -213,14 +206,20 @@ if CompNum==2:
     vrads1, vrads2 = v1andv2(nusdata, Orbital_Params)
     itrnumlim=NumItrFinal
     NebSpec = np.zeros(len(wavegridall))
-    DisSpecVector, redchi2 = disentangle(np.zeros(len(wavegridall)), vrads1, vrads2,  wavegridall, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  nusdata, Orbital_Params, K1s, K2s, MJDs, phisData, specnames, Rangestr, StarName,  ScalingNeb, NebSpec, Resid=False, Reduce=True, ShowItr=True, Once=True,   InterKind=InterKind, itrnumlim=itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=0, linewidExt=linewidExt, N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, NebFac=1, ExtremesFigSize=ExtremesFigSize)
+    DisSpecVector, redchi2 = disentangle(np.zeros(len(wavegridall)), vrads1, vrads2,  wavegridall, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall,  nusdata, Orbital_Params, K1s, K2s, MJDs, phisData, specnames, Rangestr, StarName,  ScalingNeb, NebSpec, Resid=False, Reduce=True, ShowItr=True, Once=True,   InterKind=InterKind, itrnumlim=itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=0, linewidExt=linewidExt, N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, NebFac=1, ExtremesFigSize=ExtremesFigSize, Engine=DisEngine, EpsTol=EpsTol, Accelerate=Accelerate, LogOversample=LogOversample, LogIntShift=LogIntShift, LsqrDamp=LsqrDamp)
 elif CompNum==3:
     print("disentangling...., K1, K2, KOut:", Orbital_Params['K1'], Orbital_Params['K2'],  Orbital_Params['KOut'])
     vrads1, vrads2 = v1andv2(nusdata, Orbital_Params)
     vradsOut, vradsBin = v1andv2(nusdataOut, Orbital_Params, Config='Tertiary')
     itrnumlim=NumItrFinal
     NebSpec = np.zeros(len(wavegridall))
-    DisSpecVector, redchi2 = disentangle3Comp(np.zeros(len(wavegridall)), vrads1, vrads2, vradsOut, vradsBin,  wavegridall, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, nusdata, nusdataOut, Orbital_Params, K1s, K2s, KOuts, MJDs, phisData, phisDataOut, specnames, Rangestr, StarName,  ScalingNeb, NebSpec,  Resid=False, Reduce=True, ShowItr=True, Once=True,   InterKind=InterKind, itrnumlim=itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=0, linewidExt=linewidExt,  N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, NebFac=1, ExtremesFigSize=ExtremesFigSize)      
+    DisSpecVector, redchi2 = disentangle3Comp(np.zeros(len(wavegridall)), vrads1, vrads2, vradsOut, vradsBin,  wavegridall, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, nusdata, nusdataOut, Orbital_Params, K1s, K2s, KOuts, MJDs, phisData, phisDataOut, specnames, Rangestr, StarName,  ScalingNeb, NebSpec,  Resid=False, Reduce=True, ShowItr=True, Once=True,   InterKind=InterKind, itrnumlim=itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=0, linewidExt=linewidExt,  N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, NebFac=1, ExtremesFigSize=ExtremesFigSize, Engine=DisEngine, EpsTol=EpsTol, Accelerate=Accelerate, LogOversample=LogOversample, LogIntShift=LogIntShift, LsqrDamp=LsqrDamp)      
+elif CompNum==4:
+    print("disentangling...., K1, K2, KOut, K3, K4:", Orbital_Params['K1'], Orbital_Params['K2'],  Orbital_Params['KOut'], Orbital_Params['K3'], Orbital_Params['K4'])
+    vradsArr = Comp_Vrads(nusdata, Orbital_Params, CompNum, nusdataOut, nusdata2)
+    itrnumlim=NumItrFinal
+    NebSpec = np.zeros(len(wavegridall))
+    DisSpecVector, redchi2 = disentangleNComp([np.zeros(len(wavegridall))]*3, vradsArr, wavegridall, ObsSpecs, weights, StrictNeg, PosLimCond, Poslimall, nusdata, Orbital_Params, K1s, K2s, MJDs, [phisData, phisDataOut, phisData2], specnames, Rangestr, StarName,  ScalingNeb, NebSpec,  Resid=False, Reduce=True, ShowItr=True, Once=True,   InterKind=InterKind, itrnumlim=itrnumlim,   PLOTCONV=PLOTCONV, PLOTITR=PLOTITR,  PLOTEXTREMES=PLOTEXTREMES, PLOTFITS=PLOTFITS, kcount_extremeplot=0, linewidExt=linewidExt,  N_Iteration_Plot=N_Iteration_Plot,  NebLines = NebLines, NebFac=1, ExtremesFigSize=ExtremesFigSize, Engine=DisEngine, EpsTol=EpsTol, Accelerate=Accelerate, LogOversample=LogOversample, LogIntShift=LogIntShift, LsqrDamp=LsqrDamp)      
     
     
 
@@ -229,6 +228,8 @@ if CompNum==2:
     A, B, NebSpec = DisSpecVector
 elif CompNum==3:
     A, B, C, NebSpec = DisSpecVector
+elif CompNum==4:
+    A, B, C, D, NebSpec = DisSpecVector
     
 A = (A-1)/ lguessVec[0] + 1.    
 B = (B-1)/lguessVec[1] + 1.
@@ -237,8 +238,9 @@ plt.plot(wavegridall, B, label='dis B')
 if CompNum>=3:
     C = (C-1)/lguessVec[2] + 1.
     plt.plot(wavegridall, C, label='dis C')
-# if CompNum==4:
-#     D = (D-1)/lguessVec[3] + 1.
+if CompNum==4:
+    D = (D-1)/lguessVec[3] + 1.
+    plt.plot(wavegridall, D, label='dis D')
 
 
 
@@ -258,6 +260,11 @@ elif CompNum==3:
     np.savetxt('Output/ADIS_lguess2_lguess3_K1K2KOut=' + str(lguessVec[1]) + '_'  + str(lguessVec[2]) + '_' + str(Orbital_Params['K1']) + '_' +  str(Orbital_Params['K2']) +'_' +  str(Orbital_Params['KOut'])  +   '.txt', np.c_[wavegridall, A])
     np.savetxt('Output/BDIS_lguess2_lguess3_K1K2KOut=' + str(lguessVec[1]) + '_'  + str(lguessVec[2]) + '_' + str(Orbital_Params['K1']) + '_' +  str(Orbital_Params['K2']) +'_' +  str(Orbital_Params['KOut'])  +   '.txt', np.c_[wavegridall, B])
     np.savetxt('Output/CDIS_lguess2_lguess3_K1K2KOut=' + str(lguessVec[1]) + '_'  + str(lguessVec[2]) + '_' + str(Orbital_Params['K1']) + '_' +  str(Orbital_Params['K2']) +'_' +  str(Orbital_Params['KOut'])  +   '.txt', np.c_[wavegridall, C])
+elif CompNum==4:
+    np.savetxt(f'{Output_dir}/adis.txt', np.c_[wavegridall, A])
+    np.savetxt(f'{Output_dir}/bdis.txt', np.c_[wavegridall, B])
+    np.savetxt(f'{Output_dir}/cdis.txt', np.c_[wavegridall, C])
+    np.savetxt(f'{Output_dir}/ddis.txt', np.c_[wavegridall, D])
 if NebLines:
     np.savetxt('Output/NebDIS_lguess2_K1K2=' + str(lguessVec[1]) + '_' + str(Orbital_Params['K1']) + '_' + str(Orbital_Params['K2']) + '.txt', np.c_[wavegridall, NebSpec])
     
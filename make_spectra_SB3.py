@@ -16,6 +16,8 @@ from scipy import asarray as ar,exp
 import random
 from astropy.convolution import Gaussian1DKernel
 from astropy.convolution import convolve
+# For converting Mean anomalies to eccentric anomalies (M-->E)
+from Disentangling.disentangle_functions import Kepler
 
 ######################################
 # # # # # # # USER INPUT # # # # # # #
@@ -98,15 +100,6 @@ def v1(nu, Gamma, K1, omega, ecc):
       #return np.column_stack((v1,v2))
       return v1
 
-# For converting Mean anomalies to eccentric anomalies (M-->E)
-def Kepler(E, M, ecc):
-      E2 = (M - ecc*(E*np.cos(E) - np.sin(E))) / (1. - ecc*np.cos(E))
-      eps = np.abs(E2 - E) 
-      if np.all(eps < 1E-10):
-            return E2
-      else:
-            return Kepler(E2, M, ecc)
-        
 def v1v2(nu, Gamma, K1, K2, omega, ecc):  
       v1 = Gamma + K1*(np.cos(omega + nu) + ecc* np.cos(omega))
       v2 = Gamma + K2*(np.cos(np.pi + omega + nu) + ecc* np.cos(np.pi + omega))
@@ -165,9 +158,10 @@ Mask = convolve(Mask, kernel, normalize_kernel=True, boundary='extend')
 Mask2 = convolve(Mask2, kernel, normalize_kernel=True, boundary='extend') 
 Mask3 = convolve(Mask3, kernel, normalize_kernel=True, boundary='extend') 
 
-np.savetxt('obs/Atemp.txt', np.c_[wavegrid, Mask])
-np.savetxt('obs/Btemp.txt', np.c_[wavegrid, Mask2])
-np.savetxt('obs/Ctemp.txt', np.c_[wavegrid, Mask3])
+# Fixed-width columns (blank in place of a + sign) with 15 significant digits are read exactly by the fast path of read_xytable
+np.savetxt('obs/Atemp.txt', np.c_[wavegrid, Mask], fmt='% .14e')
+np.savetxt('obs/Btemp.txt', np.c_[wavegrid, Mask2], fmt='% .14e')
+np.savetxt('obs/Ctemp.txt', np.c_[wavegrid, Mask3], fmt='% .14e')
 
 
 sig = 1/S2N      
@@ -206,7 +200,7 @@ for i in np.arange(specnum):
       #convoluted = convolve(MaskSums, kernel, normalize_kernel=True, boundary='extend')
       noiseobs = MaskSums + np.random.normal(0,sig, len(wavegrid))
       obsname = 'obs/obs_' + str(i) +  "_V1_" + str(v1) + "_V2_" + str(v2) + "_V3_" + str(vTertiary)
-      np.savetxt(obsname, np.c_[wavegrid, noiseobs])
+      np.savetxt(obsname, np.c_[wavegrid, noiseobs], fmt='% .14e')
       phasesfile.write(str(MJD) + ' '  + obsname + '\n')
       #if i==0:
           #np.savetxt('Observation_example.txt', np.c_[wavegrid, noiseobs])
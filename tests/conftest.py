@@ -0,0 +1,38 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+import pytest
+
+from Disentangling import disentangle_functions as D
+
+
+# Synthetic SB2 (Gaussian lines of a primary and a secondary, noise 0.005) observed at NumEpochs random dates;
+# returns the arguments shared by disentangle and the grid functions
+def Synthetic_Binary(NumEpochs=2, Seed=1, **Params):
+    rng = np.random.default_rng(Seed)
+    Orbital_Params = {'Period': 18., 'T0': 0., 'ecc': 0.3, 'omega': 60., 'Gamma': 0., 'K1': 87., 'K2': 135.,
+                      'PeriodOut': 200., 'T0Out': 34., 'eccOut': 0.3, 'omegaOut': 160., 'KOut': 29.,
+                      'Period_2': 0., 'T0_2': 0., 'ecc_2': 0., 'omega_2': 0., 'K3': 0., 'K4': 0.}
+    Orbital_Params.update(Params)
+    waves = np.arange(4460., 4485., 0.05)
+    A = 1 - 0.3*np.exp(-(waves-4471.5)**2/2/1.0**2)
+    B = 1 - 0.2*np.exp(-(waves-4473.)**2/2/0.6**2)
+    MJDs = rng.uniform(0, 200, NumEpochs)
+    phis, nusdata = D.Orbit_Anomalies(MJDs, Orbital_Params['Period'], Orbital_Params['T0'], Orbital_Params['ecc'])
+    vrads1, vrads2 = D.v1andv2(nusdata, Orbital_Params)
+    ObsSpecs = []
+    for v1, v2 in zip(vrads1, vrads2):
+        Flux = 0.6*np.interp(waves, waves*(1 + v1/D.clight), A) + 0.4*np.interp(waves, waves*(1 + v2/D.clight), B)
+        ObsSpecs.append(np.array([waves, Flux + rng.normal(0, 0.005, len(waves))]).T)
+    return {'Orbital_Params': Orbital_Params, 'waves': np.arange(4462., 4483., 0.05), 'ObsSpecs': ObsSpecs, 'weights': np.ones(NumEpochs)/NumEpochs,
+            'StrictNeg': [True]*4, 'PosLimCond': [np.array([[3968., 3969.]])]*5, 'Poslimall': 0.01, 'MJDs': MJDs, 'phis': phis, 'nusdata': nusdata,
+            'specnames': ['spec%d' % i for i in range(NumEpochs)], 'ScalingNeb': np.ones(NumEpochs)}
+
+
+# The grid functions write their output to disentangled/ in the working directory
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'disentangled').mkdir()
+    return tmp_path
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from scipy.interpolate import interp1d
+
+from Disentangling.disentangle_functions import Shift_Operator, Shift_Spec, Spline_Shift, disentangle, v1andv2, clight
+from conftest import Synthetic_Binary
+
+
+def Shifted_Waves(Data):
+    vrads1, vrads2 = v1andv2(Data['nusdata'], Data['Orbital_Params'])
+    Facshift = np.sqrt((1 + vrads1/clight) / (1 - vrads1/clight))
+    return Data['waves'][None, :] * Facshift[:, None]
+
+
+@pytest.mark.parametrize('Engine', ['sparse', 'batched'])
+def test_shift_operator_matches_interp1d(Engine):
+    Data = Synthetic_Binary(NumEpochs=2)
+    WavesShift, waves = Shifted_Waves(Data), Data['waves']
+    spec = np.interp(waves, Data['ObsSpecs'][0][:, 0], Data['ObsSpecs'][0][:, 1]) - 1.
+    Ref = np.array([interp1d(WavesShift[i], spec, bounds_error=False, fill_value=0.)(waves) for i in range(2)])
+    np.testing.assert_allclose(Shift_Spec(spec, WavesShift, waves, Op=Shift_Operator(WavesShift, waves, Engine)), Ref, rtol=0, atol=1E-14)
+
+
+@pytest.mark.parametrize('InterKind', ['quadratic', 'cubic'])
+def test_spline_shift_matches_interp1d(InterKind):
+    Data = Synthetic_Binary(NumEpochs=2)
+    WavesShift, waves = Shifted_Waves(Data), Data['waves']
+    spec = np.interp(waves, Data['ObsSpecs'][0][:, 0], Data['ObsSpecs'][0][:, 1]) - 1.
+    Ref = np.array([interp1d(WavesShift[i], spec, bounds_error=False, fill_value=0., kind=InterKind)(waves) for i in range(2)])
+    np.testing.assert_allclose(Spline_Shift(spec, WavesShift, waves, k={'quadratic': 2, 'cubic': 3}[InterKind]), Ref, rtol=0, atol=1E-12)
+
+
+def Run_Disentangle(Data, **kwargs):
+    OP = Data['Orbital_Params']
+    vrads1, vrads2 = v1andv2(Data['nusdata'], OP)
+    return disentangle(np.zeros(len(Data['waves'])), vrads1, vrads2, Data['waves'], Data['ObsSpecs'], Data['weights'], Data['StrictNeg'], Data['PosLimCond'],
+                       Data['Poslimall'], Data['nusdata'], OP, np.array([OP['K1']]), np.array([OP['K2']]), Data['MJDs'], Data['phis'], Data['specnames'],
+                       'test', 'test', Data['ScalingNeb'], np.zeros(len(Data['waves'])), Once=True, itrnumlim=30, **kwargs)
+
+
+@pytest.mark.parametrize('Engine', ['sparse', 'batched'])
+def test_engines_match_classic(Engine):
+    Data = Synthetic_Binary(NumEpochs=2)
+    DisRef, chi2Ref = Run_Disentangle(Data, Engine='classic')
+    Dis, chi2 = Run_Disentangle(Data, Engine=Engine)
+    np.testing.assert_allclose(Dis, DisRef, rtol=0, atol=1E-12)
+    np.testing.assert_allclose(chi2, chi2Ref, rtol=1E-12)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from Disentangling.disentangle_functions import Grid_disentangling2D, interp1d
+from conftest import Synthetic_Binary
+
+
+K1s, K2s = np.arange(79., 96., 4.), np.arange(123., 148., 4.)
+
+
+# chi2 map of Grid_disentangling2D (reduced; columns K1, K2, chi2 as saved in disentangled/)
+def Run_Grid(Data, **kwargs):
+    OP = Data['Orbital_Params']
+    Bini = interp1d(Data['waves'], np.zeros(len(Data['waves'])), bounds_error=False, fill_value=0.)
+    K1, K2 = Grid_disentangling2D([Data['waves']], Data['nusdata'], Bini, dict(OP), K1s, K2s, Data['ObsSpecs'], Data['weights'], Data['StrictNeg'], Data['PosLimCond'],
+                                  Data['Poslimall'], Data['MJDs'], Data['phis'], Data['specnames'], 'test', 'test', Data['ScalingNeb'], Ini='B', ParbSize=2, itrnumlim=20, **kwargs)
+    return np.loadtxt('disentangled/test_grid_dis_K1K2.txt')
+
+
+@pytest.fixture
+def serial_map(workdir):
+    Data = Synthetic_Binary(NumEpochs=4)
+    return Data, Run_Grid(Data)
+
+
+def test_parallel_grid_matches_serial(serial_map):
+    Data, Ref = serial_map
+    np.testing.assert_allclose(Run_Grid(Data, NumWorkers=2), Ref, rtol=1E-14)
+
+
+# WarmStart is not used for parallel grids: the map is that of the serial grid without WarmStart
+def test_parallel_grid_ignores_warm_start(serial_map):
+    Data, Ref = serial_map
+    np.testing.assert_allclose(Run_Grid(Data, NumWorkers=2, WarmStart=True), Ref, rtol=1E-14)
+
+
+def test_checkpointed_grid_matches_serial(serial_map):
+    Data, Ref = serial_map
+    np.testing.assert_allclose(Run_Grid(Data, Checkpoint=True), Ref, rtol=1E-14)
+# Second run: all grid points are read from the store
+    np.testing.assert_allclose(Run_Grid(Data, Checkpoint=True), Ref, rtol=1E-14)
+
+
+def test_kblock_grid_matches_serial(serial_map):
+    Data, Ref = serial_map
+    np.testing.assert_allclose(Run_Grid(Data, KBlock=3), Ref, rtol=1E-12)
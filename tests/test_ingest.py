@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from Disentangling.disentangle_functions import Ingest_Spectra
+
+
+NormPoints = [4005., 4030., 4070., 4110., 4150., 4190.]
+
+
+# Spectra written as ASCII tables; pairs of epochs share a wavelength grid (normalised together by Normalise_Batch)
+@pytest.fixture
+def spectra(tmp_path):
+    rng = np.random.default_rng(3)
+    specnames = []
+    for i in range(6):
+        waves = np.linspace(4000., 4200., 4000) + 0.01*(i//2)
+        Flux = (1 + 0.1*np.sin(waves/30.)) * (1 - 0.3*np.exp(-(waves-4100.)**2/2.)) * (1 + 0.01*rng.standard_normal(len(waves)))
+        specnames.append(str(tmp_path / ('spec%d.txt' % i)))
+        np.savetxt(specnames[-1], np.array([waves, Flux]).T, header='wave flux')
+    return specnames
+
+
+@pytest.mark.parametrize('CleanCos', [False, True])
+def test_parallel_ingest_matches_serial(spectra, CleanCos):
+    Settings = dict(S2Nblue=4010., S2Nred=4050., CleanCos=CleanCos, Renormalise=True, NormPoints=NormPoints, NormClipItr=2)
+    SpecsRef, MJDsRef, S2NsRef = Ingest_Spectra(spectra, NumWorkers=1, **Settings)
+    Specs, MJDs, S2Ns = Ingest_Spectra(spectra, NumThreads=2, NumWorkers=2, **Settings)
+    for spec, specRef in zip(Specs, SpecsRef):
+        np.testing.assert_allclose(spec, specRef, rtol=1E-14)
+    np.testing.assert_array_equal(S2Ns, S2NsRef)
+# Continuum removed
+    assert np.all(np.abs(np.median([spec[:, 1] for spec in Specs], axis=1) - 1.) < 0.02)
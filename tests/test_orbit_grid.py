@@ -0,0 +1,36 @@
+import pickle
+
+import numpy as np
+
+from Disentangling.disentangle_functions import Grid_disentangling_Orbit, Orbit_Vrad_Range, Reduce_Waves, interp1d
+from conftest import Synthetic_Binary
+
+
+def Run_Orbit_Grid(Data, GridAxes):
+    Bini = interp1d(Data['waves'], np.zeros(len(Data['waves'])), bounds_error=False, fill_value=0.)
+    Best, Errs = Grid_disentangling_Orbit([Data['waves']], GridAxes, Bini, dict(Data['Orbital_Params']), Data['ObsSpecs'], Data['weights'], Data['StrictNeg'],
+                                          Data['PosLimCond'], Data['Poslimall'], Data['MJDs'], Data['specnames'], 'test', 'test', Data['ScalingNeb'], Ini='B', ParbSize=2, itrnumlim=20)
+    with open('disentangled/test_grid_dis_orbit.pkl', 'rb') as Chi2File:
+        Header = pickle.load(Chi2File)
+        Chi2 = pickle.load(Chi2File)
+    return Best, Errs, Header, Chi2
+
+
+def test_orbit_grid_common_pixels(workdir):
+    Data = Synthetic_Binary(NumEpochs=20, Seed=5)
+    Keys, Axes = ['ecc', 'Gamma'], [np.linspace(0.2, 0.4, 5), np.linspace(-100., 100., 5)]
+    VradRange = Orbit_Vrad_Range(Data['MJDs'], Keys, Axes, np.ones((5, 5), dtype=bool), Data['Orbital_Params'], 87., 135.)
+    NumPix = np.sum(Reduce_Waves(Data['waves'], Data['nusdata'], Data['Orbital_Params'], 87., 135., VradRange))
+    Best, Errs, Header, Chi2 = Run_Orbit_Grid(Data, dict(zip(Keys, Axes)))
+    assert Header['DoF'] == NumPix * (20 - 2)
+    assert abs(Best['ecc'] - 0.3) < 0.02
+# Gamma is degenerate with the rest wavelengths of the disentangled spectra: on common pixels, the chi2 does not depend on it
+# (it was pulled towards the grid edge when each point used its own pixels)
+    Row = Chi2[np.argmin(np.abs(Axes[0] - 0.3))]
+    assert np.ptp(Row) < 0.02 * np.amin(Row)
+
+
+def test_orbit_grid_recovers_ecc_with_gamma(workdir):
+    Data = Synthetic_Binary(NumEpochs=20, Seed=5, Gamma=20.)
+    Best, Errs, Header, Chi2 = Run_Orbit_Grid(Data, {'ecc': np.linspace(0.2, 0.4, 5)})
+    assert abs(Best['ecc'] - 0.3) < 0.02
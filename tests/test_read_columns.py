@@ -0,0 +1,44 @@
+import numpy as np
+
+from Disentangling.disentangle_functions import Parse_Fixed_Width, Read_Columns, read_xytable
+
+
+def test_read_columns_exact_18e(tmp_path):
+    rng = np.random.default_rng(0)
+    Data = np.array([np.linspace(3800., 7000., 200000) + rng.uniform(-1E-3, 1E-3, 200000), rng.normal(1., 0.1, 200000)]).T
+    infile = str(tmp_path / 'spec.txt')
+    np.savetxt(infile, Data, fmt='% .18e', header='wave flux')
+    Parsed = Read_Columns(infile, SkipLines=1)
+    Ref = np.loadtxt(infile, skiprows=1)
+    assert Parsed.shape == Ref.shape
+    assert np.array_equal(Parsed.view(np.uint64), Ref.view(np.uint64))
+
+
+# Format of the mock spectra (make_spectra_SB2.py, make_spectra_SB3.py): parsed by the fast path, exactly
+def test_read_columns_fast_path_14e(tmp_path):
+    rng = np.random.default_rng(2)
+    Data = np.array([np.linspace(3800., 7000., 50000), rng.normal(1., 0.1, 50000)]).T
+    infile = str(tmp_path / 'spec.txt')
+    np.savetxt(infile, Data, fmt='% .14e')
+    with open(infile, 'rb') as f:
+        Block = f.read()
+    Arr = np.frombuffer(Block, dtype=np.uint8).reshape(-1, Block.index(b'\n') + 1)
+    assert Parse_Fixed_Width(Arr) is not None
+    assert np.array_equal(Read_Columns(infile).view(np.uint64), np.loadtxt(infile).view(np.uint64))
+
+
+def test_read_columns_exact_fixed_width(tmp_path):
+    rng = np.random.default_rng(1)
+    Data = np.array([np.linspace(3800., 7000., 50000), rng.normal(1., 0.1, 50000)]).T
+    infile = str(tmp_path / 'spec.txt')
+    np.savetxt(infile, Data, fmt='%.8f')
+    assert np.array_equal(Read_Columns(infile).view(np.uint64), np.loadtxt(infile).view(np.uint64))
+
+
+def test_read_xytable_sidecar(tmp_path):
+    infile = str(tmp_path / 'spec.dat')
+    np.savetxt(infile, np.array([[4000., 1.], [4001., 0.9]]), header='wave flux')
+    for i in range(2):
+        wave, flux = read_xytable(infile, SkipLines=1, Sidecar=True)
+        assert np.array_equal(wave, [4000., 4001.]) and np.array_equal(flux, [1., 0.9])
+    assert (tmp_path / 'spec.dat.skip1.npy').exists()